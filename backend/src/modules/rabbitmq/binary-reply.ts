@@ -0,0 +1,81 @@
+/*
+* Decoder of the binary reply format of calc_module (reply header x-reply-format: binary):
+*   "APTB" | uint32 version | uint32 header length | JSON header | array blocks
+* JSON header keeps the reply with numeric arrays replaced by { $block: index },
+* header.blocks[index] describes dtype, shape and offset (from the start of blocks section) of the array,
+* header is padded with spaces so every block starts at a multiple of 8 bytes.
+* Arrays are restored as plain (nested for 2D blocks) number arrays, so the result has the same shape as JSON reply.
+*/
+
+export const JSON_REPLY_FORMAT = 'json';
+export const BINARY_REPLY_FORMAT = 'binary';
+
+const BINARY_MAGIC = 'APTB';
+const BINARY_VERSION = 1;
+
+const TYPED_ARRAYS = {
+  '<f8': Float64Array,
+  '<f4': Float32Array,
+  '<i4': Int32Array,
+  '|u1': Uint8Array,
+};
+
+interface BinaryBlock {
+  dtype: string;
+  shape: number[];
+  offset: number;
+  length: number;
+}
+
+function readBlock(content: Buffer, blocksStart: number, block: BinaryBlock): any[] {
+  const TypedArray = TYPED_ARRAYS[block.dtype];
+  if (!TypedArray) {
+    throw new Error(`Unsupported block dtype: ${block.dtype}`);
+  }
+
+  // Kopia bajtów bloku gwarantuje wyrównanie wymagane przez typed array
+  const start = blocksStart + block.offset;
+  const bytes = Uint8Array.prototype.slice.call(content, start, start + block.length);
+  // NaN zamieniany jest na null, tak jak przy odpowiedzi JSON
+  const values: number[] = Array.from(new TypedArray(bytes.buffer), (value: number) => (Number.isNaN(value) ? null : value));
+
+  return reshape(values, block.shape);
+}
+
+function reshape(values: number[], shape: number[]): any[] {
+  if (shape.length < 2) {
+    return values;
+  }
+  const rowSize = values.length / shape[0];
+  return Array.from({ length: shape[0] }, (_, row) => reshape(values.slice(row * rowSize, (row + 1) * rowSize), shape.slice(1)));
+}
+
+export function decodeBinaryReply(content: Buffer): any {
+  if (content.toString('ascii', 0, 4) !== BINARY_MAGIC) {
+    throw new Error('Not a binary reply');
+  }
+
+  const version = content.readUInt32LE(4);
+  if (version !== BINARY_VERSION) {
+    throw new Error(`Unsupported binary reply version: ${version}`);
+  }
+
+  const headerLength = content.readUInt32LE(8);
+  const header = JSON.parse(content.toString('utf8', 12, 12 + headerLength));
+  const blocksStart = 12 + headerLength;
+
+  const restore = (value: any): any => {
+    if (Array.isArray(value)) {
+      return value.map(restore);
+    }
+    if (value !== null && typeof value === 'object') {
+      if ('$block' in value) {
+        return readBlock(content, blocksStart, header.blocks[value.$block]);
+      }
+      return Object.fromEntries(Object.entries(value).map(([key, item]) => [key, restore(item)]));
+    }
+    return value;
+  };
+
+  return restore(header.data);
+}
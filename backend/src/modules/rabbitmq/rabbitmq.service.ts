@@ -3,6 +3,7 @@ import { ConfigService } from '@nestjs/config';
 import * as amqp from 'amqplib';
 import { SimulationService } from '../simulation/simulation.service';
 import { logWithTime } from '../utils';
+import { BINARY_REPLY_FORMAT, JSON_REPLY_FORMAT, decodeBinaryReply } from './binary-reply';
 import { v4 as uuidv4 } from 'uuid'
 
 @Injectable()
@@ -11,6 +12,7 @@ export class RabbitMQService implements OnModuleInit, OnModuleDestroy {
   private channel: amqp.Channel;
   public requestQueue: string;
   public rabbitmqUrl: string;
+  public replyFormat: string;
 
 
   constructor(
@@ -20,6 +22,7 @@ export class RabbitMQService implements OnModuleInit, OnModuleDestroy {
   ) {
     this.requestQueue = this.configService.get<string>('RABBITMQ_REQUEST_QUEUE');
     this.rabbitmqUrl = this.configService.get<string>('RABBITMQ_URL');
+    this.replyFormat = this.configService.get<string>('SIMULATION_REPLY_FORMAT') || JSON_REPLY_FORMAT;
   }
 
   async onModuleInit() {
@@ -158,6 +161,7 @@ export class RabbitMQService implements OnModuleInit, OnModuleDestroy {
         persistent: false,
         correlationId: correlationId,
         replyTo: replyTo,
+        headers: { 'x-reply-format': this.replyFormat },
       });
 
     } catch(error) {
@@ -195,10 +199,7 @@ export class RabbitMQService implements OnModuleInit, OnModuleDestroy {
           logWithTime(`consumeResults -> Received reply with correlationId: ${correlationId}`);
   
           try {
-            const rawMessage = msg.content.toString();
-            const sanitizedMessage = rawMessage.replace(/\bNaN\b/g, "null");
-
-            const messageContent = JSON.parse(sanitizedMessage);
+            const messageContent = this.parseReply(msg);
             const { status, result } = messageContent;
             logWithTime(`consumeResults -> Status of received reply for simulation ${simulationId}: ${status}`);
             
@@ -222,6 +223,21 @@ export class RabbitMQService implements OnModuleInit, OnModuleDestroy {
   }
 
 
+  /*
+  * calc_module replies with JSON by default, binary format (typed array blocks)
+  * is used when requested by x-reply-format header of the task
+  */
+  private parseReply(msg: amqp.ConsumeMessage): any {
+    if (msg.properties.headers?.['x-reply-format'] === BINARY_REPLY_FORMAT) {
+      return decodeBinaryReply(msg.content);
+    }
+
+    const rawMessage = msg.content.toString();
+    const sanitizedMessage = rawMessage.replace(/\bNaN\b/g, "null");
+    return JSON.parse(sanitizedMessage);
+  }
+
+
   async processMessage(simulationId: number, result: any, status): Promise<void> {
       logWithTime(`processMessage -> Processing result for simulationId: ${simulationId}`);
 
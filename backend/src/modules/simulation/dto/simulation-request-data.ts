@@ -1,4 +1,4 @@
-import { IsArray, IsBoolean, IsNotEmpty, IsNumber, IsOptional, IsPositive, IsString, ValidateNested } from 'class-validator';
+import { IsArray, IsBoolean, IsIn, IsNotEmpty, IsNumber, IsOptional, IsPositive, IsString, ValidateNested } from 'class-validator';
 import { DroneFlightType } from 'src/modules/drone/dto/drone-flight';
 
 
@@ -36,6 +36,27 @@ export class SimulationRequestType {
   @IsNumber()
   snapInterval: number
 
+  @IsOptional()
+  @IsIn(['float64', 'float32'])
+  precision?: string
+
+  @IsOptional()
+  @IsIn(['uniform', 'quadtree'])
+  gridType?: string
+
+  @IsOptional()
+  @IsNumber()
+  maxRefinementLevel?: number
+
+  @IsOptional()
+  @IsIn(['grid', 'kdtree'])
+  interpolation?: string
+
+  @IsOptional()
+  @IsNumber()
+  @IsPositive()
+  timeoutSeconds?: number
+
   @IsOptional()
   simulationId: number
 
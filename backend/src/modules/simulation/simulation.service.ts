@@ -36,6 +36,11 @@ export class SimulationService {
                   snapInterval: simulationData.snapInterval,
                   decayRate: simulationData.decayRate,
                   emissionRate: simulationData.emissionRate,
+                  precision: simulationData.precision,
+                  gridType: simulationData.gridType,
+                  maxRefinementLevel: simulationData.maxRefinementLevel,
+                  interpolation: simulationData.interpolation,
+                  timeoutSeconds: simulationData.timeoutSeconds,
                   simulationId: simulationId
                 });
 
@@ -53,7 +58,7 @@ export class SimulationService {
             
       const processedResult = new SimulationResponseType({
         grid: {
-          boxes: result.grid.boxes.map((box: any) => ({
+          boxes: this.expandGridBoxes(result.grid).map((box: any) => ({
             lat_min: box.lat_min,
             lat_max: box.lat_max,
             lon_min: box.lon_min,
@@ -82,6 +87,42 @@ export class SimulationService {
     }
 
 
+    /*
+    * calc_module sends uniform grid as a descriptor (origin, cell size, shape) instead of the list of boxes,
+    * boxes are expanded here in the same row-major order (latitude index first)
+    */
+    private expandGridBoxes(grid: any): any[] {
+      if (grid.boxes) {
+        return grid.boxes;
+      }
+
+      // Quadtree grid: cell [i, j, size] covers size x size cells of the finest level grid
+      if (grid.cells) {
+        return grid.cells.map(([i, j, size]: number[]) => ({
+          lat_min: grid.origin.lat + i * grid.cellSize.lat,
+          lat_max: grid.origin.lat + (i + size) * grid.cellSize.lat,
+          lon_min: grid.origin.lon + j * grid.cellSize.lon,
+          lon_max: grid.origin.lon + (j + size) * grid.cellSize.lon,
+        }));
+      }
+
+      const [numLatBoxes, numLonBoxes] = grid.shape;
+      const boxes = [];
+
+      for (let i = 0; i < numLatBoxes; i++) {
+        for (let j = 0; j < numLonBoxes; j++) {
+          boxes.push({
+            lat_min: grid.origin.lat + i * grid.cellSize.lat,
+            lat_max: grid.origin.lat + (i + 1) * grid.cellSize.lat,
+            lon_min: grid.origin.lon + j * grid.cellSize.lon,
+            lon_max: grid.origin.lon + (j + 1) * grid.cellSize.lon,
+          });
+        }
+      }
+      return boxes;
+    }
+
+
     /*
     * Database functions
     */
@@ -1,20 +1,30 @@
 import asyncio
 import atexit
 import multiprocessing as mp
-from multiprocessing import Process, Queue, Event
-from queue import Empty
+from multiprocessing import Process, Queue, Event, Pipe, resource_tracker, shared_memory
+from multiprocessing.connection import Connection, wait
+from queue import Empty, Full
+import contextlib
+import itertools
+import math
 import signal
 import sys
+import threading
 import time
 import traceback
 import aio_pika  # type: ignore
 import json
+import numpy as np
 import os
 from typing import Optional
 from dataclasses import dataclass
 
-from utils import serialize_output, log_with_time, set_context_id
-from models.euler_modified_multibox_model.simulation import simulate_pollution_spread
+from utils import BINARY_CONTENT_TYPE, REPLY_FORMATS, serialize_output, serialize_output_binary, log_with_time, set_context_id
+from models.euler_modified_multibox_model.simulation import DEFAULT_MAX_BOXES, PARALLEL_MAX_BOXES, simulate_pollution_spread
+from models.euler_modified_multibox_model.numba_kernels import warmup_numba_kernels
+from models.euler_modified_multibox_model.domain_decomposition import WorkerSlots
+from models.euler_modified_multibox_model.field_cache import FieldCache
+from models.euler_modified_multibox_model.snapshot_codec import encode_snapshots
 from models.euler_modified_multibox_model.simulation_types.input_type import *
 from models.euler_modified_multibox_model.simulation_types.output_type import *
 
@@ -23,18 +33,116 @@ class SimulationTask:
     data: dict
     correlation_id: str
     reply_to: str
+    reply_format: str = 'json'
+    task_id: int = -1
+    timeout: Optional[float] = None
 
 # Sentinel, aby worker mógł się wyłączyć bez blokady
 SENTINEL = None
 
+# Odpowiedzi od tego rozmiaru worker przekazuje przez pamięć współdzieloną zamiast przez potok wyników
+RESULT_SHM_THRESHOLD = int(float(os.getenv("RESULT_SHM_THRESHOLD_KB", 256)) * 1024)
+# Nazwy segmentów odpowiedzi zawierają pid workera - segmenty zabitego workera można odnaleźć i usunąć
+REPLY_SHM_PREFIX = "apt_reply_"
+SHM_DIRECTORY = "/dev/shm"
+_reply_segments = itertools.count()
+# Górny limit maxBoxes z żądania - większe żądania są odrzucane, domyślny limit silnika jest do niego przycinany
+SIMULATION_MAX_BOXES = int(os.getenv("SIMULATION_MAX_BOXES", PARALLEL_MAX_BOXES))
+
+
+def limit_max_boxes(requested, engine: str) -> int:
+    """
+    Grid size limit for a request: maxBoxes when given (up to SIMULATION_MAX_BOXES), otherwise the engine default
+    clamped to SIMULATION_MAX_BOXES.
+    """
+    if requested is None:
+        return min(PARALLEL_MAX_BOXES if engine == 'parallel' else DEFAULT_MAX_BOXES, SIMULATION_MAX_BOXES)
+    if isinstance(requested, bool) or not isinstance(requested, int) or requested <= 0:
+        raise ValueError(f"Invalid maxBoxes: {requested!r}. Expected a positive integer up to {SIMULATION_MAX_BOXES}")
+    if requested > SIMULATION_MAX_BOXES:
+        raise ValueError(f"Requested maxBoxes {requested} exceeds the maximum of {SIMULATION_MAX_BOXES}")
+    return requested
+
+
+def encode_reply(response_data: dict, reply_format: str) -> bytes:
+    if reply_format == 'binary':
+        return serialize_output_binary(response_data)
+    return serialize_output(response_data).encode()
+
+
+def share_reply(body: bytes) -> dict:
+    """
+    Reply body for the result pipe: small bodies as bytes ({'body'}), large ones copied to a shared memory
+    segment ({'shm': name, 'size'}), which is released by take_reply in the main process.
+    """
+    if len(body) < RESULT_SHM_THRESHOLD:
+        return {'body': body}
+    segment = shared_memory.SharedMemory(name=f"{REPLY_SHM_PREFIX}{os.getpid()}_{next(_reply_segments)}", create=True, size=len(body))
+    segment.buf[:len(body)] = body
+    # Segment usuwa proces główny, resource_tracker nie może go usunąć razem z workerem
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    segment.close()
+    return {'shm': segment.name, 'size': len(body)}
+
+
+def take_reply(result: dict) -> bytes:
+    if 'shm' not in result:
+        return result['body']
+    segment = shared_memory.SharedMemory(name=result['shm'])
+    try:
+        return bytes(segment.buf[:result['size']])
+    finally:
+        segment.close()
+        segment.unlink()
+
+
+def release_worker_replies(pid: int):
+    """
+    Removes reply segments of a worker that was killed between creating a segment and sending it.
+    Called after all replies sent by the worker were taken.
+    """
+    if not os.path.isdir(SHM_DIRECTORY):
+        return
+    for name in os.listdir(SHM_DIRECTORY):
+        if name.startswith(f"{REPLY_SHM_PREFIX}{pid}_"):
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(os.path.join(SHM_DIRECTORY, name))
+
 class SimulationWorker(Process):
-    def __init__(self, task_queue: Queue, result_queue: Queue, shutdown_event: Event):
+    def __init__(self, task_queue: Queue, result_connection: Connection, shutdown_event: Event, busy_workers=None, max_workers: int = 1):
         super().__init__()
         self.task_queue = task_queue
-        self.result_queue = result_queue
+        # Każdy worker wysyła wyniki własnym potokiem - zabity worker nie blokuje wyników pozostałych,
+        # a koniec potoku (EOF) proces główny odbiera dopiero po wszystkich wysłanych wynikach
+        self.result_connection = result_connection
         self.shutdown_event = shutdown_event
+        self.busy_workers = busy_workers
+        self.max_workers = max_workers
+        # task_id aktualnie liczonego zadania (-1 gdy worker czeka), pozwala zwrócić zadanie do RabbitMQ gdy worker padnie
+        self.current_task = mp.Value('q', -1)
+        # Termin zakończenia bieżącego zadania (time.time(), inf bez limitu, 0 gdy worker czeka)
+        self.task_deadline = mp.Value('d', 0.0)
+        # Miejsca puli zajęte przez workera (on sam i procesy pasów silnika "parallel"), chronione blokadą busy_workers
+        self.busy_slots = mp.Value('i', 0, lock=False)
+        # Ustawiane w procesie głównym przed zabiciem workera, który przekroczył termin zadania
+        self.deadline_exceeded = False
+        self.field_cache = None
+        
+    def worker_slots(self) -> Optional[WorkerSlots]:
+        # Silnik "parallel" rezerwuje wolne miejsca puli na procesy pasów
+        if self.busy_workers is None:
+            return None
+        return WorkerSlots(self.busy_workers, self.max_workers, self.busy_slots)
         
-    def run_simulation(self, data: dict) -> tuple:
+    def set_deadline(self, deadline: float):
+        # Licznik zajętych workerów i deadline zmieniane są razem, pula odczytuje je pod tą samą blokadą
+        with self.busy_workers.get_lock() if self.busy_workers is not None else contextlib.nullcontext():
+            if self.busy_workers is not None:
+                self.busy_workers.value += 1 if deadline else -1
+            self.busy_slots.value += 1 if deadline else -1
+            self.task_deadline.value = deadline
+        
+    def run_simulation(self, data: dict, snapshot_callback=None) -> tuple:
         try:
             process_id = os.getpid()
             set_context_id(process_id)
@@ -50,8 +158,24 @@ class SimulationWorker(Process):
             decay_rate = data['decayRate']
             emission_rate = data['emissionRate']
             snap_interval = data['snapInterval']
+            engine = data.get('engine', 'vectorized')
+            solver = data.get('solver', 'fixed_point')
+            batch_pollutants = data.get('batchPollutants', False)
+            steady_state_tol = data.get('steadyStateTolerance')
+            steady_state_patience = data.get('steadyStatePatience', 10)
+            max_boxes = limit_max_boxes(data.get('maxBoxes'), engine)
+            precision = data.get('precision', 'float64')
+            legacy_grid = data.get('legacyGrid', False)
+            grid_type = data.get('gridType', 'uniform')
+            max_refinement_level = data.get('maxRefinementLevel', 2)
+            refine_gradient = data.get('refineGradient', 0.1)
+            interpolation = data.get('interpolation', 'grid')
+            interpolation_neighbors = data.get('interpolationNeighbors', 8)
+            snapshot_error_bound = data.get('snapshotErrorBound')
+            snapshot_compression = data.get('snapshotCompression', 'zlib')
+            parallel_workers = self.max_workers if engine == 'parallel' else 1
             
-            log_with_time(f"Starting simulation with parameters: num_steps={num_steps}")
+            log_with_time(f"Starting simulation with parameters: num_steps={num_steps}, solver={solver}, engine={engine}, precision={precision}, grid_type={grid_type}")
             
             start_time = time.time()
             
@@ -65,22 +189,61 @@ class SimulationWorker(Process):
                 initial_distance=initial_distance,
                 decay_rate=decay_rate,
                 emission_rate=emission_rate,
-                snap_interval=snap_interval
+                snap_interval=snap_interval,
+                engine=engine,
+                solver=solver,
+                batch_pollutants=batch_pollutants,
+                steady_state_tol=steady_state_tol,
+                steady_state_patience=steady_state_patience,
+                parallel_workers=parallel_workers,
+                max_boxes=max_boxes,
+                precision=precision,
+                grid_type=grid_type,
+                max_refinement_level=max_refinement_level,
+                refine_gradient=refine_gradient,
+                interpolation=interpolation,
+                interpolation_neighbors=interpolation_neighbors,
+                field_cache=self.field_cache,
+                snapshot_callback=snapshot_callback,
+                worker_slots=self.worker_slots() if engine == 'parallel' else None
             )
             
-            concentrations, snap_concentrations, boxes, temp_values, press_values, u_values, v_values = result
+            concentrations, snap_concentrations, grid, temp_values, press_values, u_values, v_values, equilibrium_steps = result
             
             end_time = time.time()
             log_with_time(f"Simulation completed in {end_time - start_time:.3f} seconds")
             
+            if snapshot_callback is not None:
+                # Snapshoty zostały już wysłane w trakcie symulacji, wynik końcowy zawiera tylko ich liczbę
+                snapshot_counts = {pollutant: len(series) for pollutant, series in snap_concentrations.items()}
+                log_with_time(f"Snapshots streamed during simulation: {snapshot_counts}")
+                snap_concentrations = {pollutant: [] for pollutant in snap_concentrations}
+            
+            encoded_snapshots = None
+            if snapshot_error_bound is not None and snapshot_callback is None:
+                # Błąd bezwzględny może być wspólny lub podany dla każdego zanieczyszczenia {pollutant: bound}
+                encoded_snapshots = {
+                    pollutant: encode_snapshots(
+                        getattr(series, 'array', series),
+                        snapshot_error_bound[pollutant] if isinstance(snapshot_error_bound, dict) else snapshot_error_bound,
+                        compression=snapshot_compression
+                    )
+                    for pollutant, series in snap_concentrations.items()
+                }
+                log_with_time(f"Snapshots encoded with error bound {snapshot_error_bound} ({snapshot_compression}): "
+                              f"{sum(len(encoded['data']) for encoded in encoded_snapshots.values())} bytes")
+            
             final_data: OutputType = convert_to_output_type(
                 concentrations,
                 snap_concentrations,
-                boxes,
+                grid,
                 temp_values,
                 press_values,
                 u_values,
-                v_values
+                v_values,
+                equilibrium_steps,
+                legacy_grid=legacy_grid,
+                encoded_snapshots=encoded_snapshots
             )
             
             return final_data, "completed"
@@ -90,8 +253,45 @@ class SimulationWorker(Process):
             traceback.print_exc()
             return None, "failed"
 
+    def snapshot_publisher(self, task: SimulationTask):
+        # Tryb strumieniowy: każdy snapshot trafia do potoku wyników od razu po wykonaniu, handler publikuje go z numerem sekwencji
+        def publish_snapshot(pollutant, index, values):
+            response_data = {
+                "status": "running",
+                "snapshot": {
+                    "pollutant": pollutant,
+                    "index": index,
+                    "values": np.asarray(values)
+                }
+            }
+            self.result_connection.send({
+                'correlation_id': task.correlation_id,
+                'reply_to': task.reply_to,
+                'reply_format': task.reply_format,
+                'type': 'snapshot',
+                **share_reply(encode_reply(response_data, task.reply_format))
+            })
+        return publish_snapshot
+        
     def run(self):
         try:
+            set_context_id(os.getpid())
+            # Worker dziedziczy obsługę sygnałów pętli asyncio procesu głównego (wakeup fd) - bez przywrócenia domyślnej
+            # SIGTERM wysłany do workera nie zatrzymałby go, za to zamknąłby całą aplikację
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            # Kompilacja (lub odczyt z cache na dysku) kerneli numba przed pierwszym zadaniem
+            if warmup_numba_kernels():
+                log_with_time("Numba kernels loaded, \"numba\" engine available")
+            else:
+                log_with_time("Numba not installed, \"numba\" engine will fall back to \"vectorized\"", 'warning')
+            
+            # Katalog cache jest wspólny dla wszystkich workerów (FIELD_CACHE_DIR), cache włącza FIELD_CACHE_MAX_MB > 0
+            self.field_cache = FieldCache.from_env()
+            if self.field_cache is not None:
+                log_with_time(f"Field cache: {self.field_cache.directory} (max {self.field_cache.max_bytes // 1024**2} MB)")
+            
             while not self.shutdown_event.is_set():
                 try:
                     task = self.task_queue.get(timeout=1)
@@ -106,13 +306,33 @@ class SimulationWorker(Process):
                 if task is SENTINEL:
                     break
 
-                result, status = self.run_simulation(task.data)
-                self.result_queue.put({
+                self.current_task.value = task.task_id
+                self.set_deadline(time.time() + task.timeout if task.timeout else math.inf)
+                snapshot_callback = self.snapshot_publisher(task) if task.data.get('streamSnapshots', False) else None
+                try:
+                    result, status = self.run_simulation(task.data, snapshot_callback)
+                finally:
+                    self.set_deadline(0.0)
+                # Odpowiedź serializuje worker, proces główny tylko publikuje gotowe bajty
+                try:
+                    body = encode_reply({"status": status, "result": result}, task.reply_format)
+                except Exception as e:
+                    log_with_time(f"Result serialization failed: {e}", 'error')
+                    status = "failed"
+                    body = encode_reply({"status": status, "result": None}, task.reply_format)
+                self.result_connection.send({
                     'correlation_id': task.correlation_id,
                     'reply_to': task.reply_to,
+                    'reply_format': task.reply_format,
+                    'type': 'result',
+                    'task_id': task.task_id,
+                    'streamed': snapshot_callback is not None,
                     'status': status,
-                    'result': result
+                    **share_reply(body)
                 })
+                # Gdy worker padnie przed tym przypisaniem, wynik i tak jest przetwarzany przed końcem potoku,
+                # więc zadanie nie jest już oczekujące i nie wraca do RabbitMQ
+                self.current_task.value = -1
         except KeyboardInterrupt:
             pass
         finally:
@@ -122,24 +342,119 @@ class SimulationWorker(Process):
 class SimulationPool:
     def __init__(self, max_workers: int = None):
         self.max_workers = max_workers or mp.cpu_count()
-        self.task_queue = Queue()
-        self.result_queue = Queue()
+        # Lokalna kolejka mieści tyle zadań, ile jest workerów - reszta czeka w RabbitMQ na wolną replikę
+        self.task_queue = Queue(maxsize=self.max_workers)
         self.shutdown_event = Event()
+        self.busy_workers = mp.Value('i', 0)
         self.workers: list[SimulationWorker] = []
+        # Końce potoków wyników do odczytu (po jednym na workera), zmieniane przy wymianie workerów
+        self.result_connections: dict[Connection, SimulationWorker] = {}
+        self._connections_lock = threading.Lock()
+        # Budzi wątek odbierający wyniki, gdy zmieni się lista potoków lub odbiór ma się zakończyć
+        self._wakeup_reader, self._wakeup_writer = Pipe(duplex=False)
+        self._receiving_stopped = threading.Event()
+        
+    def start_worker(self) -> SimulationWorker:
+        reader, writer = Pipe(duplex=False)
+        worker = SimulationWorker(self.task_queue, writer, self.shutdown_event, self.busy_workers, self.max_workers)
+        worker.start()
+        # Kopia końca do zapisu w procesie głównym (dziedziczona też przez kolejne workery) opóźniałaby EOF
+        writer.close()
+        with self._connections_lock:
+            self.result_connections[reader] = worker
+        self._wakeup_writer.send_bytes(b"")
+        return worker
         
     def start(self):
         for _ in range(self.max_workers):
-            worker = SimulationWorker(self.task_queue, self.result_queue, self.shutdown_event)
-            worker.start()
-            self.workers.append(worker)
+            self.workers.append(self.start_worker())
         log_with_time(f"Initialised SimulationPool with {self.max_workers} workers")
+        
+    def receive_results(self) -> Optional[list]:
+        """
+        Blocks until workers send results, returns them (in order of sending for each worker) or None after
+        stop_receiving. Exit of a worker (end of its result pipe) is returned as {'type': 'exit', 'worker': worker}
+        after all results the worker sent.
+        """
+        while not self._receiving_stopped.is_set():
+            with self._connections_lock:
+                connections = list(self.result_connections)
+            
+            results = []
+            for connection in wait([self._wakeup_reader, *connections]):
+                if connection is self._wakeup_reader:
+                    while connection.poll():
+                        connection.recv_bytes()
+                    continue
+                try:
+                    results.append(connection.recv())
+                except (EOFError, OSError):
+                    # Worker zakończył się (również w trakcie wysyłania wyniku, którego reszta nie dotrze)
+                    with self._connections_lock:
+                        worker = self.result_connections.pop(connection)
+                    connection.close()
+                    results.append({'type': 'exit', 'worker': worker})
+            if results:
+                return results
+        return None
+        
+    def stop_receiving(self):
+        self._receiving_stopped.set()
+        self._wakeup_writer.send_bytes(b"")
+        
+    def replace_worker(self, worker: SimulationWorker) -> int:
+        """
+        Releases pool slots of a worker which exited (died, e.g. killed by the OOM killer, or was terminated
+        after its deadline) and starts a new one, returns task_id of the task it was running (-1 when idle).
+        """
+        worker.join()
+        release_worker_replies(worker.pid)
+        with self.busy_workers.get_lock():
+            self.busy_workers.value -= worker.busy_slots.value
+            worker.busy_slots.value = 0
+        
+        task_id = worker.current_task.value
+        if self.shutdown_event.is_set() or worker not in self.workers:
+            return task_id
+        if not worker.deadline_exceeded:
+            log_with_time(f"Worker {worker.pid} died (exit code {worker.exitcode}), starting a new one", 'error')
+        self.workers[self.workers.index(worker)] = self.start_worker()
+        return task_id
+        
+    def terminate_overdue_workers(self) -> list[int]:
+        """
+        Terminates workers running a task past its deadline and waits until they exit (blocking, called in an
+        executor), returns task_id of the terminated tasks. Workers are replaced by replace_worker after
+        the results they sent before termination are received.
+        """
+        overdue = []
+        # Pod blokadą licznika zadanie nie może się zakończyć (set_deadline) - worker jest zatrzymywany przed wysłaniem wyniku
+        with self.busy_workers.get_lock():
+            for worker in list(self.workers):
+                if not time.time() >= worker.task_deadline.value > 0 or not worker.is_alive() or self.shutdown_event.is_set():
+                    continue
+                log_with_time(f"Worker {worker.pid} exceeded the deadline of its simulation, terminating it and starting a new one", 'warning')
+                worker.deadline_exceeded = True
+                worker.terminate()
+                overdue.append((worker, worker.current_task.value))
+        
+        # Procesy pasów silnika "parallel" kończą się razem z workerem i usuwają jego pamięć współdzieloną
+        for worker, _ in overdue:
+            worker.join(timeout=1)
+            if worker.is_alive():
+                worker.kill()
+                worker.join()
+        return [task_id for _, task_id in overdue]
             
     def cleanup(self):
         self.shutdown_event.set()
         # Wysyłamy do kolejki SENTINEL – jeden dla każdego worker’a,
         # dzięki czemu nie zostaną zablokowani przy oczekiwaniu na zadanie.
         for _ in range(len(self.workers)):
-            self.task_queue.put(SENTINEL)
+            try:
+                self.task_queue.put(SENTINEL, timeout=1)
+            except Full:
+                break
         
         for worker in self.workers:
             worker.join(timeout=2)
@@ -154,12 +469,20 @@ class SimulationPool:
                 self.task_queue.get_nowait()
             except Empty:  
                 break
-                
-        while not self.result_queue.empty():
+        
+        # Nieodebrane odpowiedzi w pamięci współdzielonej trzeba zwolnić
+        with self._connections_lock:
+            connections = list(self.result_connections)
+            self.result_connections.clear()
+        for connection in connections:
             try:
-                self.result_queue.get_nowait()
-            except Empty:
-                break
+                while connection.poll():
+                    result = connection.recv()
+                    if 'shm' in result:
+                        take_reply(result)
+            except (EOFError, OSError):
+                pass
+            connection.close()
 
 
 class RabbitMQHandler:
@@ -172,7 +495,18 @@ class RabbitMQHandler:
         self._connection_retry_delay = 5
         self._shutdown_event = asyncio.Event()
         self._active_tasks: set = set()
-        self.SIMULATION_TIMEOUT = 600
+        # Domyślny limit czasu symulacji w sekundach, pojedyncze zlecenie może go zmienić polem timeoutSeconds
+        self.SIMULATION_TIMEOUT = float(os.getenv("SIMULATION_TIMEOUT", 600))
+        self.WORKER_CHECK_INTERVAL = 1
+        # Ponawianie umieszczenia zadania w pełnej lokalnej kolejce (s), odstęp podwajany do maksimum
+        self.ENQUEUE_RETRY_DELAY = 0.1
+        self.ENQUEUE_MAX_RETRY_DELAY = 5
+        self._sequence_numbers: dict = {}
+        # Wiadomości RabbitMQ przekazane workerom, potwierdzane (ack) dopiero po opublikowaniu wyniku
+        self._pending_messages: dict[int, aio_pika.IncomingMessage] = {}
+        self._pending_tasks: dict[int, SimulationTask] = {}
+        self._task_ids = itertools.count()
+        self._result_reader: Optional[threading.Thread] = None
         self._cleanup_lock = asyncio.Lock()
         
     async def cleanup(self):
@@ -194,6 +528,7 @@ class RabbitMQHandler:
                 except Exception as e:
                     log_with_time(f"Error closing connection: {e}", 'error')
 
+            self.stop_result_reader()
             self.simulation_pool.cleanup()
             log_with_time("RabbitMQ handler cleanup complete")
         
@@ -203,6 +538,9 @@ class RabbitMQHandler:
                 if not self._connection or self._connection.is_closed:
                     self._connection = await aio_pika.connect_robust(self.url)
                     self._channel = await self._connection.channel()
+                    # Niepotwierdzone wiadomości poprzedniego kanału wróciły do kolejki, wyniki tych zadań nie są już potwierdzane
+                    self._pending_messages.clear()
+                    self._pending_tasks.clear()
                     await self._channel.set_qos(prefetch_count=self.simulation_pool.max_workers)
                     log_with_time('Successfully connected to RabbitMQ')
                 return True
@@ -216,50 +554,219 @@ class RabbitMQHandler:
             log_with_time(f'Processing message (Correlation ID: {message.correlation_id})')
             data = json.loads(message.body)
             
-            self.simulation_pool.task_queue.put(SimulationTask(
+            # Format odpowiedzi wybierany nagłówkiem x-reply-format, domyślnie JSON
+            reply_format = (message.headers or {}).get('x-reply-format', 'json')
+            if reply_format not in REPLY_FORMATS:
+                log_with_time(f'Unsupported reply format: {reply_format}, available formats: {REPLY_FORMATS}, replying with JSON', 'warning')
+                reply_format = 'json'
+            
+            timeout = data.get('timeoutSeconds', self.SIMULATION_TIMEOUT)
+            # bool jest podklasą int - timeoutSeconds: true nie może oznaczać limitu 1 s
+            if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or not 0 < timeout < math.inf:
+                log_with_time(f'Invalid timeoutSeconds: {timeout}, using default timeout {self.SIMULATION_TIMEOUT} s', 'warning')
+                timeout = self.SIMULATION_TIMEOUT
+            
+            task_id = next(self._task_ids)
+            task = SimulationTask(
                 data=data,
                 correlation_id=message.correlation_id,
-                reply_to=message.reply_to
-            ))
+                reply_to=message.reply_to,
+                reply_format=reply_format,
+                task_id=task_id,
+                timeout=timeout
+            )
+            self._pending_messages[task_id] = message
+            self._pending_tasks[task_id] = task
+            await self.enqueue_task(task)
             
         except Exception as e:
             log_with_time(f'Error processing message: {str(e)}', 'error')
             traceback.print_exc()
-            
-        finally:
             try:
                 await message.ack()
             except Exception:
                 pass
 
+    async def enqueue_task(self, task: SimulationTask):
+        """
+        Puts the task into the local queue of the pool. prefetch_count=max_workers keeps the queue from filling up,
+        except for a moment after reconnection (tasks of the previous channel are still queued). The message then
+        waits unacked and the put is retried with growing delay - nack with requeue would bring it straight back
+        (hot loop). The message is returned to RabbitMQ only on shutdown.
+        """
+        delay = self.ENQUEUE_RETRY_DELAY
+        while True:
+            try:
+                self.simulation_pool.task_queue.put_nowait(task)
+                return
+            except Full:
+                pass
+            
+            if task.task_id not in self._pending_tasks:
+                # Kanał został zamknięty, RabbitMQ już zwrócił wiadomość do kolejki
+                return
+            if self._shutdown_event.is_set():
+                log_with_time(f'Task queue is full during shutdown, message returned to RabbitMQ (Correlation ID: {task.correlation_id})', 'warning')
+                await self.settle_message(task.task_id, requeue=True)
+                return
+            
+            log_with_time(f'Task queue is full, retrying in {delay} s (Correlation ID: {task.correlation_id})', 'warning')
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._shutdown_event.wait(), timeout=delay)
+            delay = min(2 * delay, self.ENQUEUE_MAX_RETRY_DELAY)
+
+    async def settle_message(self, task_id: int, requeue: Optional[bool] = None):
+        # requeue=None: ack (wynik opublikowany), w przeciwnym razie nack z podanym requeue
+        self._pending_tasks.pop(task_id, None)
+        message = self._pending_messages.pop(task_id, None)
+        if message is None:
+            return
+        try:
+            if requeue is None:
+                await message.ack()
+            else:
+                await message.nack(requeue=requeue)
+        except Exception as e:
+            log_with_time(f'Error settling message (Correlation ID: {message.correlation_id}): {e}', 'error')
+
+    def reply_message(self, body: bytes, reply_format: str, correlation_id: str, headers: Optional[dict] = None) -> aio_pika.Message:
+        headers = dict(headers or {})
+        if reply_format == 'binary':
+            headers['x-reply-format'] = 'binary'
+            return aio_pika.Message(
+                body=body,
+                content_type=BINARY_CONTENT_TYPE,
+                headers=headers,
+                correlation_id=correlation_id
+            )
+        return aio_pika.Message(
+            body=body,
+            headers=headers or None,
+            correlation_id=correlation_id
+        )
+    
+    def next_sequence_number(self, correlation_id: str, last: bool = False) -> int:
+        sequence_number = self._sequence_numbers.pop(correlation_id, 0)
+        if not last:
+            self._sequence_numbers[correlation_id] = sequence_number + 1
+        return sequence_number
+
+    def _read_results(self, loop: asyncio.AbstractEventLoop, results: asyncio.Queue):
+        # Wątek czeka (blokująco) na wyniki workerów i przekazuje każdy do pętli asyncio od razu po jego pojawieniu się
+        while True:
+            try:
+                received = self.simulation_pool.receive_results()
+            except Exception as e:
+                log_with_time(f"Error reading result: {e}", 'error')
+                continue
+            try:
+                for result in received if received is not None else [SENTINEL]:
+                    loop.call_soon_threadsafe(results.put_nowait, result)
+            except RuntimeError:
+                break
+            if received is None:
+                break
+
+    def stop_result_reader(self):
+        if self._result_reader is not None and self._result_reader.is_alive():
+            self.simulation_pool.stop_receiving()
+            self._result_reader.join(timeout=2)
+
+    async def publish_result(self, result: dict):
+        body = take_reply(result)
+        if result['reply_to']:
+            if result.get('type') == 'snapshot':
+                # Fragment wyniku w trybie strumieniowym: snapshot jednego zanieczyszczenia
+                headers = {'x-message-type': 'snapshot', 'x-sequence': self.next_sequence_number(result['correlation_id'])}
+            else:
+                headers = None
+                if result.get('streamed'):
+                    # Wynik końcowy zamyka strumień, x-sequence równe liczbie wysłanych wcześniej snapshotów
+                    headers = {'x-message-type': 'result', 'x-sequence': self.next_sequence_number(result['correlation_id'], last=True)}
+            
+            await self._channel.default_exchange.publish(
+                self.reply_message(body, result.get('reply_format', 'json'), result['correlation_id'], headers),
+                routing_key=result['reply_to']
+            )
+        
+        if result.get('type') == 'result':
+            await self.settle_message(result.get('task_id', -1))
+
     async def check_results(self):
-        while not self._shutdown_event.is_set():
+        results: asyncio.Queue = asyncio.Queue()
+        self._result_reader = threading.Thread(target=self._read_results, args=(asyncio.get_running_loop(), results),
+                                               name="result-reader", daemon=True)
+        self._result_reader.start()
+        
+        while True:
+            result = await results.get()
+            if result is SENTINEL:
+                break
             try:
-                result = self.simulation_pool.result_queue.get_nowait()
-                if result['reply_to']:
-                    response_data = {
-                        "status": result['status'],
-                        "result": result['result']
-                    }
-                    await self._channel.default_exchange.publish(
-                        aio_pika.Message(
-                            body=serialize_output(response_data).encode(),
-                            correlation_id=result['correlation_id']
-                        ),
-                        routing_key=result['reply_to']
-                    )
-            except Empty: 
-                await asyncio.sleep(0.1)
+                if result.get('type') == 'exit':
+                    await self.handle_worker_exit(result['worker'])
+                else:
+                    await self.publish_result(result)
             except Exception as e:
                 log_with_time(f"Error processing result: {e}", 'error')
-                await asyncio.sleep(1)
+                if result.get('type') == 'result':
+                    # Wyniku nie da się wysłać - ponowienie zadania dałoby ten sam efekt
+                    await self.settle_message(result.get('task_id', -1), requeue=False)
+
+    async def reply_status(self, task_id: int, status: str):
+        # Odpowiedź bez wyniku (timeExceeded, failed) kończąca zadanie, wiadomość jest potwierdzana po jej wysłaniu
+        task = self._pending_tasks[task_id]
+        await self.publish_result({
+            'correlation_id': task.correlation_id,
+            'reply_to': task.reply_to,
+            'reply_format': task.reply_format,
+            'type': 'result',
+            'task_id': task_id,
+            'streamed': task.data.get('streamSnapshots', False),
+            'status': status,
+            'body': encode_reply({"status": status, "result": None}, task.reply_format)
+        })
+
+    async def handle_worker_exit(self, worker: SimulationWorker):
+        # Wyniki wysłane przez workera przed zakończeniem zostały już opublikowane - zadanie z wynikiem nie jest oczekujące
+        await asyncio.get_running_loop().run_in_executor(None, worker.join)
+        task_id = self.simulation_pool.replace_worker(worker)
+        task = self._pending_tasks.get(task_id)
+        if task is None or self._shutdown_event.is_set():
+            return
+        
+        message = self._pending_messages[task_id]
+        if worker.deadline_exceeded:
+            # Ponowienie zadania skończyłoby się tak samo
+            log_with_time(f'Simulation exceeded its timeout of {task.timeout} s and was stopped (Correlation ID: {task.correlation_id})', 'warning')
+            await self.reply_status(task_id, 'timeExceeded')
+        elif message.redelivered:
+            # Zadanie już raz zakończyło workera (np. OOM) - kolejne ponowienie zabiłoby następny
+            log_with_time(f'Worker died again on a redelivered simulation, replying with failure (Correlation ID: {task.correlation_id})', 'error')
+            await self.reply_status(task_id, 'failed')
+        else:
+            # Zadanie wraca do RabbitMQ (nack z requeue) - może je przejąć inna replika
+            self._sequence_numbers.pop(task.correlation_id, None)
+            await self.settle_message(task_id, requeue=True)
+
+    async def watch_workers(self):
+        # Workery przekraczające limit czasu są zatrzymywane w wątku executora (nie blokują pętli), zadanie kończy się
+        # odpowiedzią timeExceeded po opublikowaniu wyników wysłanych wcześniej przez workera (handle_worker_exit)
+        loop = asyncio.get_running_loop()
+        while not self._shutdown_event.is_set():
+            try:
+                await loop.run_in_executor(None, self.simulation_pool.terminate_overdue_workers)
+            except Exception as e:
+                log_with_time(f"Error checking workers: {e}", 'error')
+            await asyncio.sleep(self.WORKER_CHECK_INTERVAL)
 
     async def start(self):
         self.simulation_pool.start()
         
-        result_checker = asyncio.create_task(self.check_results())
-        self._active_tasks.add(result_checker)
-        result_checker.add_done_callback(self._active_tasks.discard)
+        for coroutine in (self.check_results(), self.watch_workers()):
+            task = asyncio.create_task(coroutine)
+            self._active_tasks.add(task)
+            task.add_done_callback(self._active_tasks.discard)
         
         while not self._shutdown_event.is_set():
             try:
@@ -63,7 +63,7 @@ def plot_values_grid(boxes, values, measurements, values_type=None, image_path=N
     
     Parametry:
     - boxes: lista granic geograficznych pudełek [(lat_min, lat_max, lon_min, lon_max), ...]
-    - values: wartości przypisane do pudełek (None dla pustych pudełek)
+    - values: wartości przypisane do pudełek (NaN dla pustych pudełek)
     - measurements: lista punktów pomiarowych
     - save_image: boolean, jeśli True, zapisuje obraz do pliku
     - image_path: ścieżka do pliku, w którym zapisany zostanie obraz (jeśli save_image=True)
@@ -71,7 +71,7 @@ def plot_values_grid(boxes, values, measurements, values_type=None, image_path=N
     
     fig, ax = plt.subplots(figsize=(10, 8))
 
-    valid_values = [value for value in values if value is not None]
+    valid_values = [value for value in values if value is not None and not np.isnan(value)]
     if valid_values:
         min_value, max_value = min(valid_values), max(valid_values)
     else:
@@ -161,7 +161,7 @@ def plot_wind_grid(boxes, u_values, v_values, measurements, grid_shape, image_pa
     for i, (lat_min, lat_max, lon_min, lon_max) in enumerate(boxes):
         u_value = u_values[i]
         v_value = v_values[i]
-        wind_speed = np.sqrt(u_value**2 + v_value**2) if u_value is not None and v_value is not None else None
+        wind_speed = np.sqrt(u_value**2 + v_value**2) if np.isfinite(u_value) and np.isfinite(v_value) else None
         
         if wind_speed is not None:
             color = plt.cm.viridis(wind_speed / max_speed)
@@ -179,7 +179,7 @@ def plot_wind_grid(boxes, u_values, v_values, measurements, grid_shape, image_pa
         box_size = np.sqrt((lon_max - lon_min)**2 + (lat_max - lat_min)**2)
         arrow_scale = box_size * arrow_scale_factor * wind_speed / max_speed if wind_speed is not None else 1
 
-        if u_value is not None and v_value is not None and (i % step == 0):
+        if wind_speed is not None and (i % step == 0):
             ax.quiver(center_lon, center_lat, u_value, v_value, angles='xy', scale_units='xy', scale=1/arrow_scale, color='black', zorder=5)
 
     latitudes = np.array([point["latitude"] for point in measurements])
@@ -1,4 +1,12 @@
+from functools import partial
+
 import numpy as np
+from scipy import sparse
+from scipy.linalg import solve_banded
+from scipy.sparse.linalg import gmres, splu, spsolve
+
+from utils import log_with_time
+from models.euler_modified_multibox_model.numba_kernels import NUMBA_AVAILABLE, update_concentration_crank_nicolson_numba
 
 
 def extend_grid_with_buffer(C, S_c, K_x, K_y, u, v, nx, ny):
@@ -83,7 +91,399 @@ def update_concentration_crank_nicolson(C, u, v, K_x, K_y, dx, dy, dt, S_c, nx,
     return C_trimmed
 
 
-def calculate_stable_dt(u, v, K_x, K_y, dx, dy):
+PRECISIONS = {"float64": np.float64, "float32": np.float32}
+
+
+def resolve_precision(precision):
+    """
+    Returns numpy dtype of the simulation state for precision name ("float64" | "float32").
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unsupported precision: {precision}. Available precisions: {tuple(PRECISIONS)}")
+    return np.dtype(PRECISIONS[precision])
+
+
+def working_dtype(C):
+    """
+    float32 state is advanced in single precision, any other state in float64.
+    """
+    return np.dtype(np.float32) if np.asarray(C).dtype == np.float32 else np.dtype(np.float64)
+
+
+def upwind_stencil_coefficients(u, v, K_x, K_y, dx, dy, dtype=np.float64):
+    """
+    Expands upwind convection and diffusion into five-point stencil coefficients.
+    Upwind masks for the signs of u and v are evaluated once, so they can be reused in every step.
+    Coefficients are evaluated in float64 and stored as dtype.
+
+    Returns:
+        dict: coefficients of C[i, j], C[i-1, j], C[i+1, j], C[i, j-1], C[i, j+1]
+    """
+    u = np.asarray(u, dtype=np.float64)
+    v = np.asarray(v, dtype=np.float64)
+
+    u_positive = u > 0
+    v_positive = v > 0
+
+    diff_x = np.asarray(K_x, dtype=np.float64) / (dx**2)
+    diff_y = np.asarray(K_y, dtype=np.float64) / (dy**2)
+
+    coefficients = {
+        "center": -2 * diff_x - 2 * diff_y - np.abs(u) / dx - np.abs(v) / dy,
+        "x_minus": diff_x + np.where(u_positive, u, 0) / dx,
+        "x_plus": diff_x - np.where(u_positive, 0, u) / dx,
+        "y_minus": diff_y + np.where(v_positive, v, 0) / dy,
+        "y_plus": diff_y - np.where(v_positive, 0, v) / dy,
+    }
+    return {name: values.astype(dtype, copy=False) for name, values in coefficients.items()}
+
+
+def apply_upwind_stencil(C, coefficients):
+    """
+    Evaluates convection + diffusion for the whole grid at once using slice based differences.
+    Concentration outside of the grid is treated as zero, same as in extend_grid_with_buffer.
+    """
+    result = coefficients["center"] * C
+    result[..., 1:, :] += coefficients["x_minus"][..., 1:, :] * C[..., :-1, :]
+    result[..., :-1, :] += coefficients["x_plus"][..., :-1, :] * C[..., 1:, :]
+    result[..., :, 1:] += coefficients["y_minus"][..., :, 1:] * C[..., :, :-1]
+    result[..., :, :-1] += coefficients["y_plus"][..., :, :-1] * C[..., :, 1:]
+    return result
+
+
+def update_concentration_crank_nicolson_vectorized(C, u, v, K_x, K_y, dx, dy, dt, S_c, nx, ny, max_iter=20, tol=1e-4, decay_rate=0.01, coefficients=None):
+    """
+    Vectorized version of update_concentration_crank_nicolson, gives the same results up to rounding errors.
+    The explicit part (step n) is evaluated once per step, iterations only re-evaluate the n+1 part.
+    float32 state (with float32 coefficients) is advanced without promotion to float64.
+    """
+    dtype = working_dtype(C)
+    if coefficients is None:
+        coefficients = upwind_stencil_coefficients(u, v, K_x, K_y, dx, dy, dtype=dtype)
+
+    C = np.asarray(C, dtype=dtype)
+    half_dt = dtype.type(0.5 * dt)
+    decay_factor = np.asarray(np.exp(-decay_rate * dt / 3600), dtype=dtype)
+
+    explicit_part = C + half_dt * apply_upwind_stencil(C, coefficients)
+    source = np.asarray(S_c * dt, dtype=dtype)
+
+    C_prev = C
+    for it in range(max_iter):
+        C_new = (explicit_part + half_dt * apply_upwind_stencil(C_prev, coefficients)) * decay_factor + source
+
+        # Sprawdzenie konwergencji
+        max_diff = np.max(np.abs(C_new - C_prev))
+        C_prev = C_new
+        if max_diff < tol:
+            break
+
+    return C_new
+
+
+CRANK_NICOLSON_ENGINES = ("loop", "vectorized", "numba")
+
+
+def resolve_engine(engine):
+    """
+    Returns engine that will actually run, "numba" falls back to "vectorized" when numba is not installed.
+    """
+    if engine == "numba" and not NUMBA_AVAILABLE:
+        log_with_time('Numba is not available, "numba" engine falls back to "vectorized"', 'warning')
+        return "vectorized"
+    return engine
+
+
+def get_crank_nicolson_engine(engine, u, v, K_x, K_y, dx, dy, dtype=np.float64):
+    """
+    Returns time step function with the same signature as update_concentration_crank_nicolson.
+    "loop" - reference implementation (loop over cells), "vectorized" - whole-array stencil,
+    "numba" - compiled kernel from numba_kernels (work buffers are reused between steps).
+    dtype - precision of the stencil coefficients (and so of the state) for "vectorized" and "numba".
+    """
+    engine = resolve_engine(engine)
+
+    if engine == "loop":
+        return update_concentration_crank_nicolson
+    elif engine == "vectorized":
+        coefficients = upwind_stencil_coefficients(u, v, K_x, K_y, dx, dy, dtype=dtype)
+        return partial(update_concentration_crank_nicolson_vectorized, coefficients=coefficients)
+    elif engine == "numba":
+        coefficients = upwind_stencil_coefficients(u, v, K_x, K_y, dx, dy, dtype=dtype)
+        return partial(update_concentration_crank_nicolson_numba, coefficients=coefficients, workspace={})
+    else:
+        raise ValueError(f"Unsupported Crank-Nicolson engine: {engine}. Available engines: {CRANK_NICOLSON_ENGINES}")
+
+
+def compare_crank_nicolson_engines(engine, C, u, v, K_x, K_y, dx, dy, dt, S_c, nx, ny, decay_rate=0.01):
+    """
+    Runs a single step with the selected engine and with the reference loop, returns max absolute difference.
+    """
+    reference = update_concentration_crank_nicolson(C, u, v, K_x, K_y, dx, dy, dt, S_c, nx, ny, decay_rate=decay_rate)
+    update_concentration = get_crank_nicolson_engine(engine, u, v, K_x, K_y, dx, dy, dtype=working_dtype(C))
+    result = update_concentration(C, u, v, K_x, K_y, dx, dy, dt, S_c, nx, ny, decay_rate=decay_rate)
+    return np.max(np.abs(result - reference))
+
+
+def build_advection_diffusion_operator(coefficients):
+    """
+    Assembles stencil coefficients into sparse matrix L acting on the flattened (row-major) grid,
+    so that L @ C.flatten() == apply_upwind_stencil(C, coefficients).flatten().
+    """
+    nx, ny = coefficients["center"].shape
+    indices = np.arange(nx * ny).reshape(nx, ny)
+
+    rows = [indices, indices[1:, :], indices[:-1, :], indices[:, 1:], indices[:, :-1]]
+    cols = [indices, indices[:-1, :], indices[1:, :], indices[:, :-1], indices[:, 1:]]
+    values = [
+        coefficients["center"],
+        coefficients["x_minus"][1:, :],
+        coefficients["x_plus"][:-1, :],
+        coefficients["y_minus"][:, 1:],
+        coefficients["y_plus"][:, :-1],
+    ]
+
+    return sparse.csr_matrix(
+        (np.concatenate([value.ravel() for value in values]),
+         (np.concatenate([row.ravel() for row in rows]), np.concatenate([col.ravel() for col in cols]))),
+        shape=(nx * ny, nx * ny)
+    )
+
+
+def build_quadtree_operator(adjacency, size_x, size_y, u, v, K):
+    """
+    Finite volume counterpart of build_advection_diffusion_operator for cells of QuadtreeGrid (see adjacency()).
+    size_x, size_y - cell sizes in meters along axis 0 (with u, K_x) and axis 1 (with v, K_y), the same axes
+    convention as the uniform stencil. For every side of a cell:
+        diffusion  K * share / size / distance * (C_neighbor - C),
+        advection  |velocity| * share / distance * (C_neighbor - C), only on the upwind side of the cell,
+    where distance is measured between cell centers. Sides on the grid boundary see zero concentration in a ghost
+    cell of the same size. Without refinement gives exactly build_advection_diffusion_operator.
+    """
+    size = np.stack([np.asarray(size_x, dtype=np.float64), np.asarray(size_y, dtype=np.float64)])
+    velocity = np.stack([np.asarray(u, dtype=np.float64), np.asarray(v, dtype=np.float64)])
+    K = np.asarray(K, dtype=np.float64)
+    n = size.shape[1]
+
+    cell, neighbor, axis, side = adjacency["cell"], adjacency["neighbor"], adjacency["axis"], adjacency["side"]
+    own_size = size[axis, cell]
+    distance = 0.5 * (own_size + size[axis, neighbor])
+    cell_velocity = velocity[axis, cell]
+    upwind = np.where(side < 0, cell_velocity > 0, cell_velocity < 0)
+
+    coupling = adjacency["share"] * (K[cell] / own_size + np.where(upwind, np.abs(cell_velocity), 0)) / distance
+
+    boundary_cell, boundary_axis, boundary_side = adjacency["boundary_cell"], adjacency["boundary_axis"], adjacency["boundary_side"]
+    boundary_size = size[boundary_axis, boundary_cell]
+    boundary_velocity = velocity[boundary_axis, boundary_cell]
+    boundary_upwind = np.where(boundary_side < 0, boundary_velocity > 0, boundary_velocity < 0)
+    boundary_loss = (K[boundary_cell] / boundary_size + np.where(boundary_upwind, np.abs(boundary_velocity), 0)) / boundary_size
+
+    rows = np.concatenate([cell, cell, boundary_cell])
+    cols = np.concatenate([neighbor, cell, boundary_cell])
+    values = np.concatenate([coupling, -coupling, -boundary_loss])
+
+    return sparse.coo_matrix((values, (rows, cols)), shape=(n, n)).tocsr()
+
+
+def factorize_crank_nicolson(u, v, K_x, K_y, dx, dy, dt, decay_rate=0.01):
+    """
+    Prepares implicit Crank-Nicolson step for constant u, v, K_x, K_y, dx, dy and dt:
+        (I - decay * dt/2 * L) C_n+1 = decay * (I + dt/2 * L) C_n + S_c * dt
+    which is the exact fixed point of the iteration in update_concentration_crank_nicolson.
+    Left hand side operator is factorized once, so each step is a single back-substitution.
+    """
+    operator = build_advection_diffusion_operator(upwind_stencil_coefficients(u, v, K_x, K_y, dx, dy))
+    return factorize_operator(operator, dt, np.shape(u), decay_rate=decay_rate)
+
+
+def factorize_operator(operator, dt, shape, decay_rate=0.01):
+    """
+    Crank-Nicolson factorization for any assembled operator L (uniform stencil or quadtree finite volumes),
+    shape is the shape of a single pollutant state.
+    """
+    decay_factor = np.exp(-decay_rate * dt / 3600)
+    identity = sparse.identity(operator.shape[0], format='csr')
+
+    lhs_operator = (identity - 0.5 * dt * decay_factor * operator).tocsc()
+    rhs_operator = (decay_factor * (identity + 0.5 * dt * operator)).tocsr()
+
+    return {
+        "lu": splu(lhs_operator),
+        "rhs_operator": rhs_operator,
+        "shape": tuple(shape),
+        "dt": dt
+    }
+
+
+def update_concentration_crank_nicolson_implicit(C, S_c, factorization):
+    """
+    Single implicit step, for batched state (n_pollutants, nx, ny) all pollutants are solved
+    with one factorization as multiple right hand sides.
+    """
+    shape = factorization["shape"]
+    size = int(np.prod(shape))
+    C = np.asarray(C, dtype=np.float64)
+    batch_shape = C.shape[:C.ndim - len(shape)]
+
+    C = C.reshape(-1, size).T
+    S_c = np.broadcast_to(S_c, batch_shape + shape).reshape(-1, size).T
+
+    rhs = factorization["rhs_operator"] @ C + S_c * factorization["dt"]
+    C_new = factorization["lu"].solve(np.ascontiguousarray(rhs))
+
+    return C_new.T.reshape(batch_shape + shape)
+
+
+def tridiagonal_line_system(K, spacing, dt, axis):
+    """
+    Builds banded matrix (scipy.linalg.solve_banded format, l=u=1) of (I - dt/2 * D) where D is diffusion
+    along given axis. All lines of the grid (and all pollutants of a batch) are concatenated into one system,
+    couplings between consecutive lines are zero, so a single solve handles every line at once.
+    """
+    coefficient = 0.5 * dt * np.moveaxis(K, axis, -1) / (spacing**2)
+
+    upper = -coefficient.copy()
+    upper[..., -1] = 0
+    lower = -coefficient.copy()
+    lower[..., 0] = 0
+
+    ab = np.zeros((3, coefficient.size))
+    ab[0, 1:] = upper.ravel()[:-1]
+    ab[1, :] = (1 + 2 * coefficient).ravel()
+    ab[2, :-1] = lower.ravel()[1:]
+    return ab
+
+
+def solve_lines(ab, rhs, axis):
+    lines = np.moveaxis(rhs, axis, -1)
+    solution = solve_banded((1, 1), ab, np.ascontiguousarray(lines).ravel(), check_finite=False)
+    return np.moveaxis(solution.reshape(lines.shape), -1, axis)
+
+
+def prepare_adi(u, v, K_x, K_y, dx, dy, dt, batch_shape, decay_rate=0.01):
+    """
+    Prepares Alternating-Direction-Implicit (Peaceman-Rachford) step. Diffusion is split into x and y parts,
+    each half step treats one direction implicitly (tridiagonal line solves) and the other explicitly.
+    Upwind advection is explicit, so only the advection CFL condition limits dt.
+    """
+    zeros = np.zeros(np.shape(u))
+    K_x = np.broadcast_to(K_x, batch_shape)
+    K_y = np.broadcast_to(K_y, batch_shape)
+
+    return {
+        "advection": upwind_stencil_coefficients(u, v, zeros, zeros, dx, dy),
+        "diffusion_x": upwind_stencil_coefficients(zeros, zeros, K_x, np.zeros(batch_shape), dx, dy),
+        "diffusion_y": upwind_stencil_coefficients(zeros, zeros, np.zeros(batch_shape), K_y, dx, dy),
+        "lines_x": tridiagonal_line_system(K_x, dx, dt, axis=-2),
+        "lines_y": tridiagonal_line_system(K_y, dy, dt, axis=-1),
+        "decay_factor": np.exp(-np.asarray(decay_rate) * dt / 3600),
+        "batch_shape": batch_shape,
+        "dt": dt
+    }
+
+
+def update_concentration_adi(C, S_c, scheme):
+    half_dt = 0.5 * scheme["dt"]
+    C = np.asarray(C, dtype=np.float64).reshape(scheme["batch_shape"])
+
+    # x implicit, y explicit
+    rhs = C + half_dt * (apply_upwind_stencil(C, scheme["diffusion_y"]) + apply_upwind_stencil(C, scheme["advection"]))
+    C_half = solve_lines(scheme["lines_x"], rhs, axis=-2)
+
+    # y implicit, x explicit
+    rhs = C_half + half_dt * (apply_upwind_stencil(C_half, scheme["diffusion_x"]) + apply_upwind_stencil(C_half, scheme["advection"]))
+    C_new = solve_lines(scheme["lines_y"], rhs, axis=-1)
+
+    return C_new * scheme["decay_factor"] + S_c * scheme["dt"]
+
+
+def solve_steady_state(u, v, K_x, K_y, dx, dy, dt, S_c, decay_rate=0.01):
+    """
+    Solves directly for equilibrium of the time stepper (C_n+1 == C_n):
+        ((1 - decay) * I - decay * dt * L) C = S_c * dt
+    with the same upwind advection / diffusion operator L, so no time stepping is needed.
+    Sparse direct solver is used, GMRES is a fallback when direct solve does not give finite result.
+    Batched state (n_pollutants, nx, ny) is solved as multiple right hand sides when K and decay are shared.
+    """
+    S_c = np.asarray(S_c, dtype=np.float64)
+
+    if np.ndim(K_x) == 3 or np.ndim(decay_rate) == 3:
+        return np.stack([
+            solve_steady_state(u, v,
+                               K_x[idx] if np.ndim(K_x) == 3 else K_x,
+                               K_y[idx] if np.ndim(K_y) == 3 else K_y,
+                               dx, dy, dt, S_c[idx],
+                               decay_rate=decay_rate[idx, 0, 0] if np.ndim(decay_rate) == 3 else decay_rate)
+            for idx in range(len(S_c))
+        ])
+
+    operator = build_advection_diffusion_operator(upwind_stencil_coefficients(u, v, K_x, K_y, dx, dy))
+    return solve_steady_system(operator, dt, S_c, np.shape(u), decay_rate=decay_rate)
+
+
+def solve_steady_system(operator, dt, S_c, shape, decay_rate=0.01):
+    """
+    Equilibrium for any assembled operator L, S_c of shape (..., *shape).
+    """
+    S_c = np.asarray(S_c, dtype=np.float64)
+    decay_factor = np.exp(-decay_rate * dt / 3600)
+    identity = sparse.identity(operator.shape[0], format='csr')
+    system = ((1 - decay_factor) * identity - decay_factor * dt * operator).tocsc()
+
+    rhs = S_c.reshape(-1, operator.shape[0]).T * dt
+
+    C = spsolve(system, rhs).reshape(rhs.shape)
+
+    if not np.all(np.isfinite(C)):
+        log_with_time("solve_steady_state -> direct solve failed, falling back to GMRES", 'warning')
+        C = np.column_stack([gmres(system, rhs[:, idx])[0] for idx in range(rhs.shape[1])])
+
+    return C.T.reshape(S_c.shape[:S_c.ndim - len(shape)] + tuple(shape))
+
+
+SOLVERS = ("fixed_point", "implicit", "adi", "steady")
+
+
+def get_time_stepper(solver, engine, u, v, K_x, K_y, dx, dy, dt, S_c, nx, ny, decay_rate=0.01, dtype=np.float64):
+    """
+    Returns function advancing concentration grid by one time step (C_n -> C_n+1).
+    "fixed_point" - iterative Crank-Nicolson (max_iter=20, tol=1e-4) executed by selected engine,
+    "implicit" - Crank-Nicolson with operator assembled and factorized once per simulation,
+    "adi" - operator split scheme with implicit diffusion (stable for any dt allowed by advection).
+    dtype - precision of the "fixed_point" stencil, sparse solvers ("implicit", "adi") always work in float64.
+    """
+    if solver == "fixed_point":
+        update_concentration = get_crank_nicolson_engine(engine, u, v, K_x, K_y, dx, dy, dtype=dtype)
+        return lambda C: update_concentration(C, u, v, K_x, K_y, dx, dy, dt, S_c, nx, ny, decay_rate=decay_rate)
+    elif solver == "implicit":
+        if np.ndim(K_x) == 3 or np.ndim(decay_rate) == 3:
+            # Pollutants with their own K / decay need separate operators
+            steppers = [
+                get_time_stepper(solver, engine, u, v,
+                                 K_x[idx] if np.ndim(K_x) == 3 else K_x,
+                                 K_y[idx] if np.ndim(K_y) == 3 else K_y,
+                                 dx, dy, dt, S_c[idx], nx, ny,
+                                 decay_rate=decay_rate[idx, 0, 0] if np.ndim(decay_rate) == 3 else decay_rate)
+                for idx in range(len(S_c))
+            ]
+            return lambda C: np.stack([update_concentration(C[idx]) for idx, update_concentration in enumerate(steppers)])
+
+        factorization = factorize_crank_nicolson(u, v, K_x, K_y, dx, dy, dt, decay_rate=decay_rate)
+        return partial(update_concentration_crank_nicolson_implicit, S_c=S_c, factorization=factorization)
+    elif solver == "adi":
+        scheme = prepare_adi(u, v, K_x, K_y, dx, dy, dt, np.shape(S_c), decay_rate=decay_rate)
+        return partial(update_concentration_adi, S_c=S_c, scheme=scheme)
+    elif solver == "steady":
+        raise ValueError('"steady" solver does not step in time, use solve_steady_state')
+    else:
+        raise ValueError(f"Unsupported solver: {solver}. Available solvers: {SOLVERS}")
+
+
+def calculate_stable_dt(u, v, K_x, K_y, dx, dy, include_diffusion=True):
+    """
+    include_diffusion=False skips diffusion limit, for solvers treating diffusion implicitly (ADI).
+    """
 
     u_max = np.max(np.abs(u))
     v_max = np.max(np.abs(v))
@@ -94,7 +494,10 @@ def calculate_stable_dt(u, v, K_x, K_y, dx, dy):
     dt_diffusion_x = (dx ** 2) / (2 * K_max + 1e-10)
     dt_diffusion_y = (dy ** 2) / (2 * K_max + 1e-10)
 
-    dt_stable = min(dt_advection_x, dt_advection_y, dt_diffusion_x, dt_diffusion_y)
+    if include_diffusion:
+        dt_stable = min(dt_advection_x, dt_advection_y, dt_diffusion_x, dt_diffusion_y)
+    else:
+        dt_stable = min(dt_advection_x, dt_advection_y)
 
     return dt_stable
 
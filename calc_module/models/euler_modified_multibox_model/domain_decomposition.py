@@ -0,0 +1,219 @@
+"""
+Shared-memory domain decomposition of the fixed-point Crank-Nicolson step (engine="parallel").
+
+Grid is split into strips of rows, each strip is advanced by its own process. State and iteration buffers
+live in multiprocessing.shared_memory, every process writes only its own rows and reads one halo row of each
+neighbouring strip, processes are synchronized with barriers after every iteration of the fixed-point loop.
+"""
+import multiprocessing as mp
+import os
+import threading
+from multiprocessing import shared_memory
+from threading import BrokenBarrierError
+
+import numpy as np
+
+from models.euler_modified_multibox_model.diffusion_advection import apply_upwind_stencil
+
+MIN_ROWS_PER_STRIP = 8
+MIN_CELLS_PER_STRIP = 2500
+
+
+def choose_strip_count(grid_shape, available_workers, min_rows_per_strip=MIN_ROWS_PER_STRIP, min_cells_per_strip=MIN_CELLS_PER_STRIP):
+    """
+    Number of strips for the grid, limited by free workers and by minimal strip size
+    (for small strips synchronization costs more than the update itself).
+    """
+    nx, ny = grid_shape
+    n_strips = min(available_workers, nx // min_rows_per_strip, (nx * ny) // min_cells_per_strip)
+    return max(1, n_strips)
+
+
+class WorkerSlots:
+    """
+    Slots of a pool of `total` worker processes counted by shared busy counter (multiprocessing.Value).
+    The "parallel" engine reserves free slots for its strip processes, so tasks started meanwhile see them as busy.
+    held - optional counter of slots taken by the owner (mp.Value without lock, guarded by the lock of busy),
+    lets the pool return slots of a worker that was killed.
+    """
+
+    def __init__(self, busy, total, held=None):
+        self.busy = busy
+        self.total = total
+        self.held = held
+
+    def reserve(self, count):
+        """
+        Reserves up to count free slots, returns number of reserved slots.
+        """
+        with self.busy.get_lock():
+            reserved = max(0, min(count, self.total - self.busy.value))
+            self.busy.value += reserved
+            if self.held is not None:
+                self.held.value += reserved
+        return reserved
+
+    def release(self, count):
+        with self.busy.get_lock():
+            self.busy.value -= count
+            if self.held is not None:
+                self.held.value -= count
+
+
+def _shared_array(shape, dtype=np.float64):
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _exit_with_parent(shared):
+    # daemon=True nie pomaga, gdy proces nadrzędny zostanie zabity (SIGKILL) - proces pasa kończy się sam
+    # i usuwa pamięć współdzieloną, której nadrzędny nie zdążył zwolnić
+    mp.parent_process().join()
+    for shm in shared.values():
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+    os._exit(1)
+
+
+def _strip_worker(index, rows, shared, shapes, coefficients, source, decay_factor, dt, max_iter, tol, barriers, barrier_timeout):
+    threading.Thread(target=_exit_with_parent, args=(shared,), daemon=True).start()
+    start_barrier, iteration_barrier, end_barrier = barriers
+    state = np.ndarray(shapes["state"], dtype=np.float64, buffer=shared["state"].buf)
+    buffers = np.ndarray(shapes["buffers"], dtype=np.float64, buffer=shared["buffers"].buf)
+    diffs = np.ndarray(shapes["diffs"], dtype=np.float64, buffer=shared["diffs"].buf)
+    control = np.ndarray(shapes["control"], dtype=np.int64, buffer=shared["control"].buf)
+
+    nx = state.shape[-2]
+    row_min, row_max = rows
+    window = slice(max(row_min - 1, 0), min(row_max + 1, nx))
+    own = slice(row_min - window.start, row_max - window.start)
+
+    try:
+        while True:
+            start_barrier.wait(barrier_timeout)
+            if control[0]:
+                break
+
+            C_window = state[:, window]
+            explicit_part = C_window[:, own] + 0.5 * dt * apply_upwind_stencil(C_window, coefficients)[:, own]
+            buffers[0, :, row_min:row_max] = state[:, row_min:row_max]
+            current = 0
+            iteration_barrier.wait(barrier_timeout)
+
+            for it in range(max_iter):
+                C_prev = buffers[current][:, window]
+                C_new = (explicit_part + 0.5 * dt * apply_upwind_stencil(C_prev, coefficients)[:, own]) * decay_factor + source
+
+                # Parzystość iteracji rozdziela zapis i odczyt różnic między kolejnymi iteracjami
+                diffs[it % 2, index] = np.max(np.abs(C_new - C_prev[:, own]))
+                buffers[1 - current, :, row_min:row_max] = C_new
+                iteration_barrier.wait(barrier_timeout)
+
+                current = 1 - current
+                if np.max(diffs[it % 2]) < tol:
+                    break
+
+            if index == 0:
+                control[1] = current
+            end_barrier.wait(barrier_timeout)
+    except BrokenBarrierError:
+        pass
+
+
+class ParallelStencilStepper:
+    """
+    Time step function (C_n -> C_n+1) of the fixed-point Crank-Nicolson iteration executed by n_strips processes.
+    Gives the same results as update_concentration_crank_nicolson_vectorized. State may be 2D or batched
+    (n_pollutants, nx, ny). Processes and shared memory live until close() is called, strip processes exit
+    (and remove the shared memory) on their own when the creating process dies.
+    worker_slots - WorkerSlots with n_strips - 1 slots reserved for the stepper, released by close().
+    """
+
+    def __init__(self, coefficients, S_c, dt, n_strips, decay_rate=0.01, max_iter=20, tol=1e-4, barrier_timeout=300, worker_slots=None):
+        self.worker_slots = worker_slots
+        self.reserved_slots = n_strips - 1 if worker_slots is not None else 0
+        batch_shape = np.broadcast_shapes(np.shape(S_c), np.shape(coefficients["center"]))
+        self.state_shape = (int(np.prod(batch_shape[:-2], dtype=int)),) + tuple(batch_shape[-2:])
+        self.barrier_timeout = barrier_timeout
+        self._closed = False
+
+        shapes = {
+            "state": self.state_shape,
+            "buffers": (2,) + self.state_shape,
+            "diffs": (2, n_strips),
+            "control": (2,),
+        }
+        self._shared = {}
+        self._arrays = {}
+        for name, shape in shapes.items():
+            dtype = np.int64 if name == "control" else np.float64
+            self._shared[name], self._arrays[name] = _shared_array(shape, dtype)
+        self._arrays["control"][:] = 0
+
+        self._barriers = (mp.Barrier(n_strips + 1), mp.Barrier(n_strips), mp.Barrier(n_strips + 1))
+
+        as_batch = lambda values: np.broadcast_to(np.asarray(values, dtype=np.float64), batch_shape).reshape(self.state_shape)
+        decay_factor = np.exp(-np.asarray(decay_rate, dtype=np.float64) * dt / 3600)
+        source = as_batch(S_c) * dt
+
+        nx = self.state_shape[-2]
+        bounds = np.linspace(0, nx, n_strips + 1).astype(int)
+
+        self._processes = []
+        for index in range(n_strips):
+            row_min, row_max = bounds[index], bounds[index + 1]
+            window = slice(max(row_min - 1, 0), min(row_max + 1, nx))
+            strip_coefficients = {name: np.ascontiguousarray(as_batch(values)[:, window]) for name, values in coefficients.items()}
+
+            process = mp.Process(
+                target=_strip_worker,
+                args=(index, (row_min, row_max), self._shared, shapes, strip_coefficients,
+                      np.ascontiguousarray(source[:, row_min:row_max]), decay_factor, dt, max_iter, tol,
+                      self._barriers, barrier_timeout),
+                daemon=True
+            )
+            process.start()
+            self._processes.append(process)
+
+    def __call__(self, C):
+        if self._closed:
+            raise RuntimeError("ParallelStencilStepper is closed")
+
+        C = np.asarray(C, dtype=np.float64)
+        self._arrays["state"][:] = C.reshape(self.state_shape)
+
+        start_barrier, _, end_barrier = self._barriers
+        start_barrier.wait(self.barrier_timeout)
+        end_barrier.wait(self.barrier_timeout)
+
+        return self._arrays["buffers"][self._arrays["control"][1]].copy().reshape(C.shape)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        self._arrays["control"][0] = 1
+        try:
+            self._barriers[0].wait(self.barrier_timeout)
+        except BrokenBarrierError:
+            pass
+
+        for process in self._processes:
+            process.join(timeout=2)
+            if process.is_alive():
+                process.terminate()
+                process.join(timeout=1)
+
+        self._arrays.clear()
+        for shm in self._shared.values():
+            shm.close()
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+
+        if self.worker_slots is not None:
+            self.worker_slots.release(self.reserved_slots)
@@ -0,0 +1,146 @@
+"""
+Disk cache of prepared simulation fields (grid, interpolated fields, diffusion coefficients).
+
+Reruns of the same drone flight with different numSteps, decayRate, emissionRate or snapInterval reuse the fields
+instead of building the grid and interpolating again. Entries are .npz files named by hash of the measurements and
+grid parameters, written atomically (temporary file + rename), so one directory can be shared by all worker processes.
+Least recently used entries (by modification time, refreshed on every hit) are removed when the directory exceeds
+its size limit.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+
+from utils import log_with_time
+from models.euler_modified_multibox_model.grid import UniformGrid, measurement_arrays
+
+# Zmiana sposobu przygotowania pól (siatka, interpolacja, współczynniki dyfuzji) wymaga zmiany wersji
+CACHE_VERSION = 2
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "calc_module_field_cache")
+# Cache jest domyślnie wyłączony, włącza go FIELD_CACHE_MAX_MB (docker-compose.yml)
+DEFAULT_CACHE_MAX_MB = 0
+
+
+class FieldCache:
+    """
+    Content-addressed cache of prepared fields in `directory` limited to max_bytes.
+    Prepared fields are dict: grid (UniformGrid), grid_shape, temperature, pressure, u, v (flattened arrays),
+    pollutants and diffusion ({pollutant: array}).
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        """
+        Cache configured by FIELD_CACHE_DIR and FIELD_CACHE_MAX_MB, None when FIELD_CACHE_MAX_MB is 0 or not set (cache disabled).
+        """
+        max_mb = float(os.getenv("FIELD_CACHE_MAX_MB", DEFAULT_CACHE_MAX_MB))
+        if max_mb <= 0:
+            return None
+        return cls(os.getenv("FIELD_CACHE_DIR", DEFAULT_CACHE_DIR), int(max_mb * 1024**2))
+
+    @staticmethod
+    def key(data, pollutants, **parameters):
+        """
+        Hash of measurement coordinates and values of the pollutants and of the grid / interpolation parameters.
+        """
+        latitudes, longitudes, measurements = measurement_arrays(data, sorted(pollutants))
+        digest = hashlib.sha256(json.dumps({"version": CACHE_VERSION, **parameters}, sort_keys=True).encode())
+        for name, values in [("latitude", latitudes), ("longitude", longitudes), *measurements.items()]:
+            digest.update(name.encode())
+            digest.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def load(self, key):
+        """
+        Prepared fields stored under key or None. Unreadable entries (truncated or corrupted file, missing grid) are
+        removed and treated as a miss.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as stored:
+                arrays = {name: stored[name] for name in stored.files}
+            grid = UniformGrid.from_descriptor(json.loads(str(arrays.pop("grid"))))
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError, KeyError, TypeError, zipfile.BadZipFile) as error:
+            # json.JSONDecodeError dziedziczy po ValueError
+            log_with_time(f"FieldCache -> removing unreadable entry {key[:12]}: {error!r}", 'warning')
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        prepared = {"grid": grid, "grid_shape": tuple(grid.shape), "pollutants": {}, "diffusion": {}}
+        for name, values in arrays.items():
+            group, _, pollutant = name.partition(":")
+            if pollutant:
+                prepared[group][pollutant] = values
+            else:
+                prepared[name] = values
+
+        log_with_time(f"FieldCache -> prepared fields loaded from cache ({key[:12]})")
+        return prepared
+
+    def store(self, key, prepared):
+        arrays = {
+            "grid": np.array(json.dumps(prepared["grid"].to_descriptor())),
+            **{name: np.asarray(prepared[name], dtype=np.float64) for name in ("temperature", "pressure", "u", "v")},
+            **{f"pollutants:{pollutant}": np.asarray(values, dtype=np.float64) for pollutant, values in prepared["pollutants"].items()},
+            **{f"diffusion:{pollutant}": np.asarray(values, dtype=np.float64) for pollutant, values in prepared["diffusion"].items()},
+        }
+
+        file = tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False)
+        try:
+            with file:
+                np.savez(file, **arrays)
+            os.replace(file.name, self._path(key))
+        except OSError as error:
+            log_with_time(f"FieldCache -> failed to store prepared fields: {error}", 'warning')
+            if os.path.exists(file.name):
+                os.remove(file.name)
+            return
+
+        self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total_size -= size
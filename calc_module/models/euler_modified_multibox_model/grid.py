@@ -1,12 +1,303 @@
 import time
 import numpy as np
+from scipy.ndimage import maximum_filter
 
 from utils import log_with_time
 
-def create_uniform_boxes(data, pollutants, grid_density=None, urbanized=False, margin_boxes=1, max_boxes=5000):
-    
+def metric_sizes(lat_min, lat_max, lon_min, lon_max):
+    """
+    Arrays dx (east-west) and dy (north-south) of box sizes in meters,
+    one degree of latitude is ~111 320 m, degree of longitude shrinks with cos(latitude).
+    """
+    dx = (lon_max - lon_min) * 111320 * np.cos(np.radians((lat_min + lat_max) / 2))
+    dy = (lat_max - lat_min) * 111320
+    return dx, dy
+
+
+class UniformGrid:
+    """
+    Uniform lat/lon grid described by its south-west corner (lat_min, lon_min), box size in degrees and shape
+    (num_lat_boxes, num_lon_boxes). Boxes are numbered row-major (latitude index first), bounds, centers and
+    metric sizes are produced on demand as arrays. Iteration and indexing give (lat_min, lat_max, lon_min, lon_max)
+    tuples, the same as the former list of boxes.
+    """
+    __slots__ = ("lat_min", "lon_min", "box_size_lat", "box_size_lon", "shape")
+
+    def __init__(self, lat_min, lon_min, box_size_lat, box_size_lon, shape):
+        self.lat_min = float(lat_min)
+        self.lon_min = float(lon_min)
+        self.box_size_lat = float(box_size_lat)
+        self.box_size_lon = float(box_size_lon)
+        self.shape = (int(shape[0]), int(shape[1]))
+
+    def __len__(self):
+        return self.shape[0] * self.shape[1]
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError(f"Box index {index} out of range for grid of {len(self)} boxes")
+        i, j = divmod(index % len(self), self.shape[1])
+        return (self.lat_min + i * self.box_size_lat, self.lat_min + (i + 1) * self.box_size_lat,
+                self.lon_min + j * self.box_size_lon, self.lon_min + (j + 1) * self.box_size_lon)
+
+    def __iter__(self):
+        return zip(*(values.tolist() for values in self.bounds()))
+
+    def bounds(self):
+        """
+        Flattened arrays lat_min, lat_max, lon_min, lon_max of all boxes.
+        """
+        rows = np.arange(self.shape[0])
+        cols = np.arange(self.shape[1])
+        lat_min = np.repeat(self.lat_min + rows * self.box_size_lat, self.shape[1])
+        lat_max = np.repeat(self.lat_min + (rows + 1) * self.box_size_lat, self.shape[1])
+        lon_min = np.tile(self.lon_min + cols * self.box_size_lon, self.shape[0])
+        lon_max = np.tile(self.lon_min + (cols + 1) * self.box_size_lon, self.shape[0])
+        return lat_min, lat_max, lon_min, lon_max
+
+    def centers(self):
+        """
+        Flattened arrays of latitudes and longitudes of box centers.
+        """
+        lat_min, lat_max, lon_min, lon_max = self.bounds()
+        return (lat_min + lat_max) / 2, (lon_min + lon_max) / 2
+
+    def metric_sizes(self):
+        return metric_sizes(*self.bounds())
+
+    def to_descriptor(self):
+        return {
+            "type": "uniform",
+            "origin": {"lat": self.lat_min, "lon": self.lon_min},
+            "cellSize": {"lat": self.box_size_lat, "lon": self.box_size_lon},
+            "shape": list(self.shape),
+        }
+
+    @classmethod
+    def from_descriptor(cls, descriptor):
+        return cls(descriptor["origin"]["lat"], descriptor["origin"]["lon"],
+                   descriptor["cellSize"]["lat"], descriptor["cellSize"]["lon"], descriptor["shape"])
+
+    def to_boxes(self):
+        """
+        Legacy list of box dicts {"lat_min", "lat_max", "lon_min", "lon_max"}.
+        """
+        return [{"lat_min": box[0], "lat_max": box[1], "lon_min": box[2], "lon_max": box[3]} for box in self]
+
+
+class QuadtreeGrid:
+    """
+    Adaptive grid made of square blocks of the uniform grid `fine` (the finest refinement level).
+    cells - int array (n_cells, 3) of [i, j, size]: index of the first (south-west) fine box of the cell
+    and its size in fine boxes (power of two). Cells are not overlapping and cover the whole fine grid.
+    Exposes the same interface (bounds, centers, metric_sizes, descriptor, iteration) as UniformGrid.
+    """
+    __slots__ = ("fine", "cells")
+
+    def __init__(self, fine, cells):
+        self.fine = fine
+        self.cells = np.asarray(cells, dtype=np.int64).reshape(-1, 3)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __getitem__(self, index):
+        i, j, size = self.cells[index].tolist()
+        fine = self.fine
+        return (fine.lat_min + i * fine.box_size_lat, fine.lat_min + (i + size) * fine.box_size_lat,
+                fine.lon_min + j * fine.box_size_lon, fine.lon_min + (j + size) * fine.box_size_lon)
+
+    def __iter__(self):
+        return zip(*(values.tolist() for values in self.bounds()))
+
+    def bounds(self):
+        i, j, size = self.cells.T
+        fine = self.fine
+        return (fine.lat_min + i * fine.box_size_lat, fine.lat_min + (i + size) * fine.box_size_lat,
+                fine.lon_min + j * fine.box_size_lon, fine.lon_min + (j + size) * fine.box_size_lon)
+
+    def centers(self):
+        lat_min, lat_max, lon_min, lon_max = self.bounds()
+        return (lat_min + lat_max) / 2, (lon_min + lon_max) / 2
+
+    def metric_sizes(self):
+        return metric_sizes(*self.bounds())
+
+    def labels(self):
+        """
+        Index of the cell covering each box of the fine grid, array of fine.shape.
+        """
+        labels = np.empty(self.fine.shape, dtype=np.int64)
+        for index, (i, j, size) in enumerate(self.cells.tolist()):
+            labels[i:i + size, j:j + size] = index
+        return labels
+
+    def adjacency(self):
+        """
+        Neighbourhood of cells for finite volume operators, dict of arrays:
+            cell, neighbor, axis, side (-1 | 1), share - part of the cell side shared with the neighbour,
+            boundary_cell, boundary_axis, boundary_side - cell sides lying on the grid boundary.
+        Axis 0 is the latitude index, axis 1 the longitude index (the same as in the uniform grid arrays).
+        """
+        labels = self.labels()
+        sizes = self.cells[:, 2]
+        faces = []
+
+        for axis in (0, 1):
+            lower = labels[:-1, :] if axis == 0 else labels[:, :-1]
+            upper = labels[1:, :] if axis == 0 else labels[:, 1:]
+            different = lower != upper
+            pairs, length = np.unique(np.stack([lower[different], upper[different]], axis=1), axis=0, return_counts=True)
+            pairs = pairs.reshape(-1, 2)
+
+            faces.append((pairs[:, 0], pairs[:, 1], np.full(len(pairs), axis), np.full(len(pairs), 1), length / sizes[pairs[:, 0]]))
+            faces.append((pairs[:, 1], pairs[:, 0], np.full(len(pairs), axis), np.full(len(pairs), -1), length / sizes[pairs[:, 1]]))
+
+        cell, neighbor, axis, side, share = (np.concatenate(values) for values in zip(*faces))
+
+        i, j, size = self.cells.T
+        on_boundary = [(i == 0, 0, -1), (i + size == self.fine.shape[0], 0, 1),
+                       (j == 0, 1, -1), (j + size == self.fine.shape[1], 1, 1)]
+        boundary_cell = np.concatenate([np.flatnonzero(mask) for mask, _, _ in on_boundary])
+        boundary_axis = np.concatenate([np.full(np.count_nonzero(mask), axis_index) for mask, axis_index, _ in on_boundary])
+        boundary_side = np.concatenate([np.full(np.count_nonzero(mask), side_sign) for mask, _, side_sign in on_boundary])
+
+        return {
+            "cell": cell, "neighbor": neighbor, "axis": axis, "side": side, "share": share,
+            "boundary_cell": boundary_cell, "boundary_axis": boundary_axis, "boundary_side": boundary_side,
+        }
+
+    def to_descriptor(self):
+        descriptor = self.fine.to_descriptor()
+        descriptor.update(type="quadtree", cells=self.cells.tolist())
+        return descriptor
+
+    @classmethod
+    def from_descriptor(cls, descriptor):
+        return cls(UniformGrid.from_descriptor(descriptor), descriptor["cells"])
+
+    def to_boxes(self):
+        return [{"lat_min": box[0], "lat_max": box[1], "lon_min": box[2], "lon_max": box[3]} for box in self]
+
+
+def relative_gradient(fields, grid_shape):
+    """
+    Largest difference to a neighbouring box, relative to the largest absolute value of the field,
+    maximum over all fields. Used as refinement criterion.
+    """
+    gradient = np.zeros(grid_shape)
+    for values in fields:
+        values = np.asarray(values, dtype=float).reshape(grid_shape)
+        scale = np.max(np.abs(values)) or 1.0
+
+        difference = np.zeros(grid_shape)
+        for axis in (0, 1):
+            step = np.abs(np.diff(values, axis=axis)) / scale
+            lower = [slice(None), slice(None)]
+            upper = [slice(None), slice(None)]
+            lower[axis], upper[axis] = slice(None, -1), slice(1, None)
+            difference[tuple(lower)] = np.maximum(difference[tuple(lower)], step)
+            difference[tuple(upper)] = np.maximum(difference[tuple(upper)], step)
+
+        gradient = np.maximum(gradient, difference)
+    return gradient
+
+
+def refinement_levels(measured, gradient, max_level=2, refine_gradient=0.1):
+    """
+    Refinement level of every base box: max_level for boxes with measurements, max_level - 1 for boxes with
+    relative gradient above refine_gradient, 0 elsewhere. Levels of neighbouring boxes differ by at most one,
+    so a cell never borders more than two cells on one side.
+    """
+    levels = np.where(gradient > refine_gradient, max(max_level - 1, 0), 0)
+    levels[measured] = max_level
+
+    while True:
+        balanced = np.maximum(levels, maximum_filter(levels, size=3, mode='nearest') - 1)
+        if np.array_equal(balanced, levels):
+            return levels
+        levels = balanced
+
+
+def create_quadtree_grid(data, pollutants, base_grid, base_fields, max_level=2, refine_gradient=0.1):
+    """
+    Refines base_grid (UniformGrid) around measurements and in high gradient regions of the initial fields.
+
+    base_fields - dict of flattened, filled (interpolated) fields of the base grid ("temperature", "pressure", "u", "v"
+    and pollutants). Cells inherit values of their base box, cells of the finest level containing measurements get
+    the mean of their own measurements instead.
+
+    Returns:
+        QuadtreeGrid, dict of fields in cell order
+    """
     start_time = time.time()
-    
+
+    latitudes, longitudes, measurements = measurement_arrays(data, pollutants)
+
+    base_indices, inside = grid_indices(base_grid, latitudes, longitudes)
+    measured = np.zeros(base_grid.shape, dtype=bool)
+    measured.flat[base_indices] = True
+
+    gradient = relative_gradient([base_fields[pollutant] for pollutant in pollutants], base_grid.shape)
+    levels = refinement_levels(measured, gradient, max_level=max_level, refine_gradient=refine_gradient)
+    max_level = int(levels.max())
+
+    scale = 2 ** max_level
+    fine = UniformGrid(base_grid.lat_min, base_grid.lon_min, base_grid.box_size_lat / scale, base_grid.box_size_lon / scale,
+                       (base_grid.shape[0] * scale, base_grid.shape[1] * scale))
+
+    cells = []
+    base_of_cell = []
+    for base_index, level in enumerate(levels.flatten().tolist()):
+        base_i, base_j = divmod(base_index, base_grid.shape[1])
+        size = 2 ** (max_level - level)
+        for a in range(2 ** level):
+            for b in range(2 ** level):
+                cells.append((base_i * scale + a * size, base_j * scale + b * size, size))
+                base_of_cell.append(base_index)
+
+    grid = QuadtreeGrid(fine, cells)
+    base_of_cell = np.asarray(base_of_cell)
+
+    fine_indices, fine_inside = grid_indices(fine, latitudes, longitudes)
+    finest = grid.cells[:, 2] == 1
+    fine_index_of_cell = grid.cells[finest, 0] * fine.shape[1] + grid.cells[finest, 1]
+
+    fields = {}
+    for name, values in base_fields.items():
+        cell_values = np.asarray(values, dtype=float)[base_of_cell]
+        if name in measurements:
+            measured_values = bin_measurements(fine_indices, measurements[name][fine_inside], fine.shape).flatten()[fine_index_of_cell]
+            cell_values[finest] = np.where(np.isnan(measured_values), cell_values[finest], measured_values)
+        fields[name] = cell_values
+
+    log_with_time(f"create_quadtree_grid -> {len(grid)} cells (base grid {base_grid.shape[0]} x {base_grid.shape[1]}, "
+                  f"max level {max_level}, base boxes per level: {np.bincount(levels.flatten(), minlength=max_level + 1).tolist()})")
+    log_with_time(f"create_quadtree_grid -> grid creation completed within {time.time() - start_time:.3f} seconds")
+
+    return grid, fields
+
+
+def bin_measurements(cell_indices, values, grid_shape):
+    """
+    Mean of measurements falling into each box (flattened index cell_indices), NaN for boxes without measurements.
+    Missing (NaN) measurements are skipped, so every field is averaged over its own valid samples.
+    """
+    valid = ~np.isnan(values)
+    size = grid_shape[0] * grid_shape[1]
+
+    sums = np.bincount(cell_indices[valid], weights=values[valid], minlength=size)
+    counts = np.bincount(cell_indices[valid], minlength=size)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums / counts).reshape(grid_shape)
+
+
+def measurement_arrays(data, pollutants):
+    """
+    Coordinates of measurement points and measured fields (temperature, pressure, wind components u, v, pollutants)
+    as float arrays, missing values are NaN.
+    """
     latitudes = np.array([point["latitude"] for point in data])
     longitudes = np.array([point["longitude"] for point in data])
     temperatures = np.array([point["temperature"] for point in data])
@@ -14,7 +305,7 @@ def create_uniform_boxes(data, pollutants, grid_density=None, urbanized=False, m
     wind_speeds = np.array([point["windSpeed"] for point in data])
     wind_directions = np.array([point["windDirection"] for point in data])
 
-    pollutants_initial_values = {pollutant: np.array([point[f'{pollutant}'] for point in data]) for pollutant in pollutants}
+    pollutants_initial_values = {pollutant: np.array([point.get(pollutant) for point in data], dtype=float) for pollutant in pollutants}
     
     
     """
@@ -34,7 +325,27 @@ def create_uniform_boxes(data, pollutants, grid_density=None, urbanized=False, m
     u_values = np.where(np.abs(u_values) < 1e-10, 0, u_values)
     v_values = np.where(np.abs(v_values) < 1e-10, 0, v_values)
 
+    measurements = {"temperature": temperatures, "pressure": pressures, "u": u_values, "v": v_values, **pollutants_initial_values}
+    return latitudes, longitudes, {name: np.asarray(values, dtype=float) for name, values in measurements.items()}
+
+
+def grid_indices(grid, latitudes, longitudes):
+    """
+    Flattened index of the box containing each point (of the uniform grid) and mask of points inside the grid.
+    """
+    # lat - lat_min określa położenie na szerokości geograficzniej danego punktu pomiarowego jako odległość o poczatku siatki,
+    # po czym podzielenie przez szerokość pudełka i zaokraglenie w dół daje nam index pudełka do którego przypisujemy zmierzone wartości
+    lat_indices = ((latitudes - grid.lat_min) / grid.box_size_lat).astype(int)
+    lon_indices = ((longitudes - grid.lon_min) / grid.box_size_lon).astype(int)
+    inside = (0 <= lat_indices) & (lat_indices < grid.shape[0]) & (0 <= lon_indices) & (lon_indices < grid.shape[1])
+    return lat_indices[inside] * grid.shape[1] + lon_indices[inside], inside
+
 
+def create_uniform_boxes(data, pollutants, grid_density=None, urbanized=False, margin_boxes=1, max_boxes=5000):
+    
+    start_time = time.time()
+    
+    latitudes, longitudes, measurements = measurement_arrays(data, pollutants)
 
     lat_min, lat_max = np.min(latitudes), np.max(latitudes)
     lon_min, lon_max = np.min(longitudes), np.max(longitudes)
@@ -63,70 +374,26 @@ def create_uniform_boxes(data, pollutants, grid_density=None, urbanized=False, m
         raise ValueError(f"Exceeded maximum number of boxes. Generated {total_boxes} boxes, max allowed is {max_boxes}")
     
     
-    boxes = []
-    pollutant_values = {pollutant: np.full((num_lat_boxes, num_lon_boxes), None) for pollutant in pollutants}
-    temperature_values = np.full((num_lat_boxes, num_lon_boxes), None)
-    pressure_values = np.full((num_lat_boxes, num_lon_boxes), None)
-    u_grid = np.full((num_lat_boxes, num_lon_boxes), None)
-    v_grid = np.full((num_lat_boxes, num_lon_boxes), None)
-    
+    grid_shape = (num_lat_boxes, num_lon_boxes)
+    grid = UniformGrid(lat_min, lon_min, box_size_lat, box_size_lon, grid_shape)
+
     # obliczanie indeksów pudełek do których przypisujemy dane pomiarowe
-    # lat - lat_min określa położenie na szerokości geograficzniej danego punktu pomiarowego jako odległość o poczatku siatki,
-    # po czym podzielenie przez szerokość pudełka i zaokraglenie w górę daje nam index pudełka do którego przypisujemy zmierzone wartości 
-    measurements_in_boxes = [[[] for _ in range(num_lon_boxes)] for _ in range(num_lat_boxes)]
+    cell_indices, inside = grid_indices(grid, latitudes, longitudes)
+    binned = {name: bin_measurements(cell_indices, values[inside], grid_shape) for name, values in measurements.items()}
+
+    temperature_values = binned["temperature"]
+    pressure_values = binned["pressure"]
+    u_grid = binned["u"]
+    v_grid = binned["v"]
+    pollutant_values = {pollutant: binned[pollutant] for pollutant in pollutants}
+
+    u_grid = np.where(np.abs(u_grid) < 1e-10, 0, u_grid)
+    v_grid = np.where(np.abs(v_grid) < 1e-10, 0, v_grid)
 
-    
-    for lat, lon, temp, press, u, v, *pollutant_concentrations in zip(latitudes, longitudes, temperatures, pressures, u_values, v_values,  *pollutants_initial_values.values()):
-        lat_idx = int((lat - lat_min) / box_size_lat)
-        lon_idx = int((lon - lon_min) / box_size_lon)
-        
-        if 0 <= lat_idx < num_lat_boxes and 0 <= lon_idx < num_lon_boxes:
-            measurements_in_boxes[lat_idx][lon_idx].append({
-                "latitude": lat, "longitude": lon, "temperature": temp, "pressure": press,
-                "u_value": u, "v_value": v,
-                **{pollutant: concentration for pollutant, concentration in zip(pollutants, pollutant_concentrations)}
-            })
-            if temperature_values[lat_idx, lon_idx] is None:
-                temperature_values[lat_idx, lon_idx] = temp
-                pressure_values[lat_idx, lon_idx] = press
-                u_grid[lat_idx, lon_idx] = u
-                v_grid[lat_idx, lon_idx] = v
-                                
-                for pollutant, concentration in zip(pollutant_values.keys(), pollutant_concentrations):
-                    pollutant_values[pollutant][lat_idx, lon_idx] = concentration
-                    
-            else:
-                temperature_values[lat_idx, lon_idx] = (temperature_values[lat_idx, lon_idx] + temp) / 2
-                pressure_values[lat_idx, lon_idx] = (pressure_values[lat_idx, lon_idx] + press) / 2
-                u_grid[lat_idx, lon_idx] = (u_grid[lat_idx, lon_idx] + u) / 2
-                v_grid[lat_idx, lon_idx] = (v_grid[lat_idx, lon_idx] + v) / 2
-
-                u_grid[lat_idx, lon_idx] = 0 if np.abs(u_grid[lat_idx, lon_idx]) < 1e-10 else u_grid[lat_idx, lon_idx]
-                v_grid[lat_idx, lon_idx] = 0 if np.abs(v_grid[lat_idx, lon_idx]) < 1e-10 else v_grid[lat_idx, lon_idx]
-
-
-                
-                for pollutant, concentration in zip(pollutant_values.keys(), pollutant_concentrations):
-                    if pollutant_values[pollutant][lat_idx, lon_idx] is None:
-                        pollutant_values[pollutant][lat_idx, lon_idx] = concentration
-                    else:
-                        pollutant_values[pollutant][lat_idx, lon_idx] = (pollutant_values[pollutant][lat_idx, lon_idx] + concentration) / 2
-
-    for i in range(num_lat_boxes):
-      for j in range(num_lon_boxes):
-        lat_min_box = lat_min + i * box_size_lat
-        lat_max_box = lat_min + (i + 1) * box_size_lat
-        lon_min_box = lon_min + j * box_size_lon
-        lon_max_box = lon_min + (j + 1) * box_size_lon
-            
-        boxes.append((lat_min_box, lat_max_box, lon_min_box, lon_max_box))
-    
-    grid_shape = (num_lat_boxes, num_lon_boxes)
-    
     flattened_pollutant_values = {pollutant: values.flatten() for pollutant, values in pollutant_values.items()}
     
     log_with_time(f"create_uniform_boxes -> Grid created, shape: {num_lat_boxes} x {num_lon_boxes}, total boxes number: {num_lat_boxes * num_lon_boxes}")
     end_time = time.time()
     log_with_time(f"create_uniform_boxes -> gird creation completed within {end_time - start_time:.3f} seconds")
          
-    return boxes, temperature_values.flatten(), pressure_values.flatten(), u_grid.flatten(), v_grid.flatten(), flattened_pollutant_values, grid_shape
\ No newline at end of file
+    return grid, temperature_values.flatten(), pressure_values.flatten(), u_grid.flatten(), v_grid.flatten(), flattened_pollutant_values, grid_shape
\ No newline at end of file
@@ -1,117 +1,131 @@
 import time
+import numpy as np
+from scipy.signal import convolve
+from scipy.spatial import cKDTree
 from utils import log_with_time
 
 
-def chessboard_distance(i1, j1, i2, j2):
-    return max(abs(i1 - i2), abs(j1 - j2))
-
-def get_neighbors(grid_shape, i, j, distance):
-    
-    rows, cols = grid_shape
-    neighbors = []
-    
-    for di in range(-distance, distance + 1):
-        for dj in range(-distance, distance + 1):
-            if di == 0 and dj == 0:
-                continue
-            
-            new_i, new_j = i + di, j + dj
-            
-            if (0 <= new_i < rows and 
-                0 <= new_j < cols and 
-                chessboard_distance(i,j, new_i, new_j) <= distance):
-                neighbors.append((new_i, new_j))
-    
-    return neighbors
+def chessboard_weight_kernel(distance):
+    """
+    Weights 1 / (1 + d^2) of boxes within chessboard distance d <= distance from the center box (center excluded).
+    """
+    offsets = np.abs(np.arange(-distance, distance + 1))
+    dist = np.maximum(offsets[:, None], offsets[None, :])
+    kernel = 1 / (1 + dist.astype(float)**2)
+    kernel[distance, distance] = 0
+    return kernel
 
 
-def weighted_interpolation(values, grid_shape, distance, value_name=None):
-    interpolated_values = values.copy()
-    num_rows, num_cols = grid_shape
+def weighted_interpolation_stacked(stacked_values, grid_shape, distance):
+    """
+    Fills empty (NaN) boxes of fields (n_fields, cells) with weighted mean of known boxes within chessboard
+    distance `distance`, box at distance d has weight 1 / (1 + d^2). Known boxes are not changed.
+    All fields must have the same empty boxes (as the first field): weights and filled boxes are computed once
+    from the known mask, weighted sums of all fields come from one stacked convolution
+    (scipy chooses direct or FFT convolution depending on the kernel size).
+    """
+    interpolated_values = np.array(stacked_values, dtype=float).reshape((-1,) + tuple(grid_shape))
+    known = ~np.isnan(interpolated_values[0])
 
-    effective_distance = max(1, min(distance, max(num_rows, num_cols)))
+    if known.all() or not known.any():
+        return interpolated_values.reshape(len(interpolated_values), -1)
 
-    full_indices = [
-        (i, j) for i in range(num_rows) for j in range(num_cols)
-        if interpolated_values[i * num_cols + j] is not None
-    ]
+    effective_distance = max(1, min(distance, max(grid_shape)))
+    kernel = chessboard_weight_kernel(effective_distance)
 
-    updated_boxes = {}
+    weight_sum = convolve(known.astype(float), kernel, mode="same")
+    # Najmniejsza niezerowa waga to 1 / (1 + distance^2), połowa tego progu odcina błędy zaokrągleń FFT
+    fill = ~known & (weight_sum > 0.5 / (1 + effective_distance**2))
 
-    for i, j in full_indices:
-        neighbors = get_neighbors(grid_shape, i, j, effective_distance)
+    weighted_sum = convolve(np.where(known, interpolated_values, 0), kernel[None], mode="same")
+    interpolated_values[:, fill] = weighted_sum[:, fill] / weight_sum[fill]
 
-        for ni, nj in neighbors:
-            neighbor_idx = ni * num_cols + nj
+    return interpolated_values.reshape(len(interpolated_values), -1)
 
-            if interpolated_values[neighbor_idx] is None:
-                dist = chessboard_distance(i, j, ni, nj)
-                weight = 1 / (1 + dist**2)
 
-                if (ni, nj) not in updated_boxes:
-                    updated_boxes[(ni, nj)] = (interpolated_values[i * num_cols + j] * weight, weight)
-                else:
-                    existing_value, existing_weight = updated_boxes[(ni, nj)]
-                    new_value = interpolated_values[i * num_cols + j] * weight
-                    updated_boxes[(ni, nj)] = (
-                        existing_value + new_value,
-                        existing_weight + weight
-                    )
+def weighted_interpolation(values, grid_shape, distance, value_name=None):
+    return weighted_interpolation_stacked([values], grid_shape, distance)[0]
 
-    for (ni, nj), (total_value, total_weight) in updated_boxes.items():
-        interpolated_values[ni * num_cols + nj] = total_value / total_weight
 
-    return interpolated_values
+def recursive_interpolation_until_filled(boxes, temp_values, press_values, u_values, v_values, pollutant_values, grid_shape, initial_distance=1, increment=1):
+    """
+    Repeats weighted interpolation with distance growing by increment until all boxes are filled.
+    Fields with the same empty boxes (usually all of them, every measurement gives every field) are interpolated
+    together by weighted_interpolation_stacked, fields with different empty boxes form their own groups.
+    Interpolated pollutant values are written back to pollutant_values.
+    Raises ValueError when a field has no known box (nothing to interpolate from).
+    """
+    start_time = time.time()
 
+    fields = {"temperature": temp_values, "pressure": press_values, "u": u_values, "v": v_values, **pollutant_values}
+    fields = {name: np.array(values, dtype=float) for name, values in fields.items()}
 
-def recursive_interpolation_until_filled(boxes, temp_values, press_values, u_values, v_values, pollutant_values, grid_shape, initial_distance=1, increment=1):
+    empty_fields = [name for name, values in fields.items() if np.isnan(values).all()]
+    if empty_fields:
+        raise ValueError(f"No measurements to interpolate from for fields: {empty_fields}")
 
-    start_time = time.time()
+    groups = {}
+    for name, values in fields.items():
+        groups.setdefault(np.isnan(values).tobytes(), []).append(name)
+
+    for names in groups.values():
+        stacked_values = np.array([fields[name] for name in names])
+        distance = max(1, initial_distance)
+
+        while np.isnan(stacked_values[0]).any():
+            stacked_values = weighted_interpolation_stacked(stacked_values, grid_shape, distance)
+            distance += increment
+
+        fields.update(zip(names, stacked_values))
+
+    for pollutant in pollutant_values:
+        pollutant_values[pollutant] = fields[pollutant]
 
-    distance = max(1, initial_distance)
-    
-    while (
-        any(value is None for value in temp_values) or 
-        any(value is None for value in press_values) or 
-        any(value is None for value in u_values) or 
-        any(value is None for value in v_values) or 
-        any(any(value is None for value in pollutant_values[pollutant]) for pollutant in pollutant_values)
-    ):  
-            
-
-        temp_values = weighted_interpolation(
-            temp_values, grid_shape,
-            distance, 
-            value_name="temperature",
-        )
-        
-        press_values = weighted_interpolation(
-            press_values, grid_shape, 
-            distance, 
-            value_name="pressure"
-        )
-        
-        u_values = weighted_interpolation(
-            u_values, grid_shape, 
-            distance, 
-            value_name="u value"
-        )
-                
-        v_values = weighted_interpolation(
-            v_values, grid_shape,
-            distance, 
-            value_name="v value",
-        )
-                
-        for pollutant in pollutant_values:
-            pollutant_values[pollutant] = weighted_interpolation(
-                pollutant_values[pollutant], grid_shape, 
-                distance, 
-                value_name=str(pollutant)
-            )
-        
-        distance += increment
-        
     end_time = time.time()
-    log_with_time(f"recursive_interpolation_until_filled -> interpolation finished within {end_time - start_time:.3f} seconds")
-    return temp_values, press_values, u_values, v_values, pollutant_values
+    log_with_time(f"recursive_interpolation_until_filled -> {len(fields)} fields in {len(groups)} groups, interpolation finished within {end_time - start_time:.3f} seconds")
+    return fields["temperature"], fields["pressure"], fields["u"], fields["v"], pollutant_values
+
+
+def kdtree_interpolation(grid, latitudes, longitudes, measurements, fields, neighbors=8, power=2):
+    """
+    Fills empty (NaN) boxes of flattened fields {name: values} with inverse distance weighted mean (1 / d^power)
+    of `neighbors` nearest raw measurement points (measurements {name: values at points}), boxes with measurements
+    keep their values. Points are projected to meters around the grid center, one cKDTree and one batched query
+    of empty box centers is made for every distinct set of valid points (usually one for all fields).
+    Raises ValueError when a field with empty boxes has no valid measurement.
+    """
+    start_time = time.time()
+
+    center_lat, center_lon = grid.centers()
+    reference_lat = np.radians(np.mean(center_lat))
+    to_meters = lambda lat, lon: np.column_stack(((np.asarray(lon) * 111320) * np.cos(reference_lat), np.asarray(lat) * 111320))
+
+    points = to_meters(latitudes, longitudes)
+    centers = to_meters(center_lat, center_lon)
+
+    filled = {name: np.array(values, dtype=float) for name, values in fields.items()}
+
+    empty_fields = [name for name, values in filled.items() if np.isnan(values).any() and np.isnan(measurements[name]).all()]
+    if empty_fields:
+        raise ValueError(f"No measurements to interpolate from for fields: {empty_fields}")
+
+    queries = {}
+
+    for name, values in filled.items():
+        valid = ~np.isnan(measurements[name])
+        empty = np.isnan(values)
+        if not empty.any():
+            continue
+
+        key = valid.tobytes()
+        if key not in queries:
+            k = min(neighbors, int(valid.sum()))
+            distances, indices = cKDTree(points[valid]).query(centers, k=np.arange(1, k + 1))
+            weights = 1 / np.maximum(distances, 1e-6)**power
+            queries[key] = (weights / weights.sum(axis=1, keepdims=True), indices)
+
+        weights, indices = queries[key]
+        values[empty] = np.sum(weights[empty] * measurements[name][valid][indices[empty]], axis=1)
+
+    log_with_time(f"kdtree_interpolation -> {len(queries)} nearest neighbours queries, interpolation finished within {time.time() - start_time:.3f} seconds")
+    return filled
@@ -0,0 +1,114 @@
+"""
+Optional Numba compiled kernels for the Crank-Nicolson stencil (engine="numba").
+
+Kernels are compiled with cache=True, so compiled code is stored on disk (__pycache__ next to this file
+or NUMBA_CACHE_DIR) and reused by every worker process. If numba is not installed, NUMBA_AVAILABLE is False
+and diffusion_advection falls back to the vectorized NumPy engine.
+"""
+import numpy as np
+
+try:
+    import numba
+    NUMBA_AVAILABLE = True
+except ImportError:
+    numba = None
+    NUMBA_AVAILABLE = False
+
+
+if NUMBA_AVAILABLE:
+
+    @numba.njit(cache=True, inline='always')
+    def _stencil_value(C, center, x_minus, x_plus, y_minus, y_plus, p, pc, i, j, nx, ny):
+        value = center[pc, i, j] * C[p, i, j]
+        if i > 0:
+            value += x_minus[pc, i, j] * C[p, i - 1, j]
+        if i < nx - 1:
+            value += x_plus[pc, i, j] * C[p, i + 1, j]
+        if j > 0:
+            value += y_minus[pc, i, j] * C[p, i, j - 1]
+        if j < ny - 1:
+            value += y_plus[pc, i, j] * C[p, i, j + 1]
+        return value
+
+    @numba.njit(cache=True)
+    def crank_nicolson_kernel(C, center, x_minus, x_plus, y_minus, y_plus, source, decay_factor, dt, max_iter, tol, explicit_part, C_prev):
+        """
+        Fixed-point Crank-Nicolson step for state of shape (n_pollutants, nx, ny), the same iteration as
+        update_concentration_crank_nicolson_vectorized with convergence check fused into the update loop.
+        Coefficients, source and decay_factor may have leading dimension 1 when shared by all pollutants.
+        explicit_part and C_prev are preallocated work buffers, only the returned array is allocated.
+        """
+        n, nx, ny = C.shape
+        C_new = np.empty_like(C)
+
+        for p in range(n):
+            pc = p if center.shape[0] > 1 else 0
+            for i in range(nx):
+                for j in range(ny):
+                    explicit_part[p, i, j] = C[p, i, j] + 0.5 * dt * _stencil_value(C, center, x_minus, x_plus, y_minus, y_plus, p, pc, i, j, nx, ny)
+                    C_prev[p, i, j] = C[p, i, j]
+
+        for it in range(max_iter):
+            max_diff = 0.0
+            for p in range(n):
+                pc = p if center.shape[0] > 1 else 0
+                ps = p if source.shape[0] > 1 else 0
+                decay = decay_factor[p] if decay_factor.shape[0] > 1 else decay_factor[0]
+                for i in range(nx):
+                    for j in range(ny):
+                        value = (explicit_part[p, i, j] + 0.5 * dt * _stencil_value(C_prev, center, x_minus, x_plus, y_minus, y_plus, p, pc, i, j, nx, ny)) * decay + source[ps, i, j] * dt
+                        diff = abs(value - C_prev[p, i, j])
+                        if diff > max_diff:
+                            max_diff = diff
+                        C_new[p, i, j] = value
+
+            if max_diff < tol:
+                break
+
+            for p in range(n):
+                for i in range(nx):
+                    for j in range(ny):
+                        C_prev[p, i, j] = C_new[p, i, j]
+
+        return C_new
+
+
+def update_concentration_crank_nicolson_numba(C, u, v, K_x, K_y, dx, dy, dt, S_c, nx, ny, max_iter=20, tol=1e-4, decay_rate=0.01, coefficients=None, workspace=None):
+    """
+    Same contract as update_concentration_crank_nicolson_vectorized, runs crank_nicolson_kernel.
+    2D state is treated as a batch of one pollutant. All arrays are passed as contiguous 3D arrays of the state dtype
+    (float64, or float32 in single precision mode), so the kernel is compiled for one signature per precision.
+    """
+    dtype = np.float32 if np.asarray(C).dtype == np.float32 else np.float64
+    C = np.asarray(C, dtype=dtype)
+    grid_shape = C.shape[-2:]
+    batch = np.ascontiguousarray(C).reshape((-1,) + grid_shape)
+
+    if workspace is None:
+        workspace = {}
+    if workspace.get("shape") != batch.shape:
+        workspace.update(shape=batch.shape, explicit_part=np.empty_like(batch), C_prev=np.empty_like(batch))
+
+    as_batch = lambda values: np.ascontiguousarray(values, dtype=dtype).reshape((-1,) + grid_shape)
+    stencil = [as_batch(coefficients[name]) for name in ("center", "x_minus", "x_plus", "y_minus", "y_plus")]
+    decay_factor = np.exp(-np.asarray(decay_rate, dtype=np.float64) * dt / 3600).reshape(-1).astype(dtype)
+
+    C_new = crank_nicolson_kernel(batch, *stencil, as_batch(S_c), decay_factor, float(dt), max_iter, float(tol),
+                                  workspace["explicit_part"], workspace["C_prev"])
+
+    return C_new.reshape(C.shape)
+
+
+def warmup_numba_kernels():
+    """
+    Compiles (or loads from on-disk cache) kernels for the types used in simulation, so the first task
+    processed by a worker does not pay the JIT cost. Returns False when numba is not available.
+    """
+    if not NUMBA_AVAILABLE:
+        return False
+
+    for dtype in (np.float64, np.float32):
+        C = np.zeros((1, 2, 2), dtype=dtype)
+        coefficients = {name: np.zeros((2, 2), dtype=dtype) for name in ("center", "x_minus", "x_plus", "y_minus", "y_plus")}
+        update_concentration_crank_nicolson_numba(C, None, None, None, None, 1.0, 1.0, 1.0, np.zeros((2, 2), dtype=dtype), 2, 2, coefficients=coefficients)
+    return True
@@ -2,9 +2,11 @@ import traceback
 import numpy as np
 from utils import log_with_time
 from models.euler_modified_multibox_model.debug_utils.plotting import plot_concentration_grid, plot_values_grid, plot_wind_grid
-from models.euler_modified_multibox_model.diffusion_advection import calculate_diffusion_coefficients, calculate_stable_dt, update_concentration_crank_nicolson
-from models.euler_modified_multibox_model.grid import create_uniform_boxes
-from models.euler_modified_multibox_model.interpolation import recursive_interpolation_until_filled
+from models.euler_modified_multibox_model.diffusion_advection import CRANK_NICOLSON_ENGINES, calculate_diffusion_coefficients, calculate_stable_dt, compare_crank_nicolson_engines, build_quadtree_operator, factorize_operator, get_time_stepper, resolve_engine, resolve_precision, solve_steady_state, solve_steady_system, update_concentration_crank_nicolson_implicit, upwind_stencil_coefficients
+from models.euler_modified_multibox_model.domain_decomposition import ParallelStencilStepper, choose_strip_count
+from models.euler_modified_multibox_model.grid import UniformGrid, create_quadtree_grid, create_uniform_boxes, measurement_arrays
+from models.euler_modified_multibox_model.interpolation import kdtree_interpolation, recursive_interpolation_until_filled
+from models.euler_modified_multibox_model.snapshots import SnapshotStore, snapshot_count, snapshot_series
 
 
 def convert_geo_to_meters(boxes):
@@ -12,6 +14,9 @@ def convert_geo_to_meters(boxes):
     Latitude in radians is approximately 111 320 m (~111,32 km)
     Longitude lenghth in meters depends on latitude, and decreases with moving away from equator
     """
+    if isinstance(boxes, UniformGrid):
+        return boxes.metric_sizes()
+
     dx = []
     dy = []
     
@@ -31,12 +36,8 @@ def initialize_source_emission(flattened_pollutant_values, grid_shape, pollutant
     source_emission = np.zeros(grid_shape)
     pollutant_values = flattened_pollutant_values[pollutant].reshape(grid_shape)
 
-    # Create mask for original measurement points (before interpolation)
-    pollutant_array = np.array(pollutant_values, dtype=float)
-    mask = pollutant_array != None
-    pollutant_array = np.where(mask, pollutant_array, np.nan)
-    
-    original_sources_mask = ~np.isnan(pollutant_array)
+    # Create mask for original measurement points (before interpolation), empty boxes are NaN
+    original_sources_mask = ~np.isnan(pollutant_values)
        
     # Calculate emission based on initial concentration and emission rate
     # Similar to decay factor: exp(-decay_rate * dt / 3600)
@@ -57,114 +58,505 @@ def initialize_source_emission(flattened_pollutant_values, grid_shape, pollutant
 
 
 
-def simulate_pollution_spread(data, num_steps, pollutants, grid_density="medium", urbanized=False, margin_boxes=1, initial_distance=1, max_increment=1, decay_rate=0.01, emission_rate=0.01, debug=False, debug_dir=None, snap_interval=10):
+def pollutant_rate(rate, pollutant):
+    """
+    Rates (decay_rate, emission_rate) may be given as single value for all pollutants or as dict {pollutant: rate}.
+    """
+    return rate[pollutant] if isinstance(rate, dict) else rate
+
+
+def pollutant_diffusion_coefficients(pollutant, temp_values, press_values, u_values, v_values, grid_shape, box_size, surface_roughness):
+    return calculate_diffusion_coefficients(
+        pollutant=pollutant,
+        temperatures=np.array(temp_values, dtype=np.float64).reshape(grid_shape),
+        pressures=np.array(press_values, dtype=np.float64).reshape(grid_shape),
+        u_wind=np.array(u_values, dtype=np.float64).reshape(grid_shape),
+        v_wind=np.array(v_values, dtype=np.float64).reshape(grid_shape),
+        z_levels=10,  # Stała wysokość referencyjna dla turbulentnej dyfuzji
+        box_size=box_size,
+        surface_roughness=surface_roughness,
+        method="empirical") # "molecular" | "turbulent" | "empirical"
+
+
+DEFAULT_MAX_BOXES = 5000
+PARALLEL_MAX_BOXES = 100000
+GRID_TYPES = ("uniform", "quadtree")
+INTERPOLATION_METHODS = ("grid", "kdtree")
+
+
+def create_time_stepper(solver, engine, u, v, K_x, K_y, dx, dy, dt, S_c, nx, ny, decay_rate=0.01, n_strips=1, dtype=np.float64,
+                        worker_slots=None):
+    """
+    get_time_stepper extended with the "parallel" engine (fixed-point iteration split between n_strips processes).
+    With worker_slots the calling worker runs as one strip and reserves free slots of the pool for the others
+    (up to n_strips - 1), "vectorized" engine is used when no slot is free.
+    Returned stepper has to be released with release_time_stepper.
+    """
+    if solver == "fixed_point" and engine == "parallel":
+        reserved = worker_slots.reserve(n_strips - 1) if worker_slots is not None else n_strips - 1
+        if reserved >= 1:
+            log_with_time(f'Domain decomposition: grid {nx} x {ny} split into {reserved + 1} strips')
+            try:
+                return ParallelStencilStepper(upwind_stencil_coefficients(u, v, K_x, K_y, dx, dy), S_c, dt, reserved + 1, decay_rate=decay_rate,
+                                              worker_slots=worker_slots)
+            except Exception:
+                if worker_slots is not None:
+                    worker_slots.release(reserved)
+                raise
+        log_with_time('No free workers for domain decomposition, "parallel" engine falls back to "vectorized"', 'warning')
+        engine = "vectorized"
+    return get_time_stepper(solver, engine, u, v, K_x, K_y, dx, dy, dt, S_c, nx, ny, decay_rate=decay_rate, dtype=dtype)
+
+
+def release_time_stepper(update_concentration):
+    if isinstance(update_concentration, ParallelStencilStepper):
+        update_concentration.close()
+
+
+def pad_steady_snapshots(snapshots, C, last_step, num_steps, snap_interval):
+    """
+    Fills snapshots, that full run would take after last_step, with the steady state.
+    """
+    first_step = (last_step // snap_interval + 1) * snap_interval
+    steady_state = C.flatten()
+    snapshots.extend([steady_state] * len(range(first_step, num_steps, snap_interval)))
+
+
+def simulate_pollutants_batched(pollutant_values, flattened_pollutant_values, grid_shape, pollutants, temp_values, press_values, u, v, dx, dy, dt, num_steps,
+                                surface_roughness=0.1, decay_rate=0.01, emission_rate=0.01, snap_interval=10, engine="vectorized", solver="fixed_point",
+                                steady_state_tol=None, steady_state_patience=10, n_strips=1, dtype=np.float64,
+                                diffusion_coefficients=None, snapshot_callback=None, worker_slots=None):
+    """
+    Advances all pollutants together as one (n_pollutants, nx, ny) state with shared wind field.
+    Diffusion coefficients, decay and emission are stacked along the first axis and broadcast against the state,
+    when they are the same for every pollutant (i.e. "empirical" K) a single 2D field / value is shared.
+    With steady_state_tol set, stepping stops when every pollutant reached steady state.
+    diffusion_coefficients - {pollutant: K} computed earlier (prepare_fields), calculated here when not given.
+    snapshot_callback - see simulate_pollution_spread.
+    """
+    if solver == "fixed_point" and engine == "loop":
+        raise ValueError('"loop" engine is a per-pollutant reference implementation and can not be used with batched pollutants')
+
+    nx, ny = grid_shape
+    C = np.stack([np.array(pollutant_values[pollutant], dtype=dtype).reshape(grid_shape) for pollutant in pollutants])
+
+    K = np.stack([
+        diffusion_coefficients[pollutant] if diffusion_coefficients is not None else
+        pollutant_diffusion_coefficients(pollutant, temp_values, press_values, u, v, grid_shape, dx, surface_roughness)
+        for pollutant in pollutants
+    ])
+    K_x = K[0] if np.all(K == K[0]) else K
+    K_y = K_x
+
+    dt_stable = calculate_stable_dt(u, v, K_x, K_y, dx, dy, include_diffusion=solver != "adi")
+
+    if solver == "adi":
+        dt = dt_stable
+        log_with_time(f"Batched simulation of {pollutants}: ADI solver, running with step time {dt} of the advection limit.")
+    elif dt > dt_stable:
+        log_with_time(f"Batched simulation of {pollutants}: step time {dt} is unstable. Will be changed to: {dt_stable}.", 'warning')
+        dt = dt_stable
+    else:
+        log_with_time(f"Batched simulation of {pollutants}: running with step time {dt} (stability check passed: dt_stable = {dt_stable}).")
+
+    S_c = np.stack([
+        initialize_source_emission(flattened_pollutant_values, grid_shape, pollutant, dt=dt, emission_rate=pollutant_rate(emission_rate, pollutant))
+        for pollutant in pollutants
+    ]).astype(dtype)
+
+    decay_rates = np.array([pollutant_rate(decay_rate, pollutant) for pollutant in pollutants], dtype=np.float64)
+    batch_decay_rate = decay_rates[0] if np.all(decay_rates == decay_rates[0]) else decay_rates.reshape(-1, 1, 1)
+
+    log_with_time(f'Batched simulation of {pollutants}: decay_rate = {decay_rates.tolist()}, shared diffusion coefficients: {K_x.ndim == 2}')
+
+    if solver == "steady":
+        C_steady = solve_steady_state(u, v, K_x, K_y, dx, dy, dt, S_c, decay_rate=batch_decay_rate).astype(dtype)
+        log_with_time(f'Batched simulation of {pollutants}: steady state solved directly, time stepping skipped')
+
+        store = SnapshotStore(2, nx * ny, dtype)
+        snap_concentrations = {pollutant: snapshot_series(pollutant, snapshot_callback, [C[idx].copy().flatten(), C_steady[idx].flatten()], store)
+                               for idx, pollutant in enumerate(pollutants)}
+        final_concentration = {pollutant: C_steady[idx].flatten() for idx, pollutant in enumerate(pollutants)}
+        return final_concentration, snap_concentrations, {pollutant: None for pollutant in pollutants}
+
+    update_concentration = create_time_stepper(solver, engine, u, v, K_x, K_y, dx, dy, dt, S_c, nx, ny, decay_rate=batch_decay_rate, n_strips=n_strips,
+                                               dtype=dtype, worker_slots=worker_slots)
+    log_with_time(f'Batched simulation of {pollutants}: using "{solver}" solver' + (f' with "{engine}" engine' if solver == "fixed_point" else ''))
+
+    store = SnapshotStore(snapshot_count(num_steps, snap_interval), nx * ny, dtype)
+    snap_concentrations = {pollutant: snapshot_series(pollutant, snapshot_callback, [C[idx].copy().flatten()], store) for idx, pollutant in enumerate(pollutants)}
+    equilibrium_steps = {pollutant: None for pollutant in pollutants}
+    steady_counters = np.zeros(len(pollutants), dtype=int)
+
+    try:
+        for step in range(num_steps):
+
+            C_prev = C
+            C = update_concentration(C).astype(dtype, copy=False)
+
+            if step % snap_interval == 0:
+                for idx, pollutant in enumerate(pollutants):
+                    snap_concentrations[pollutant].append(C[idx].copy().flatten())
+
+            if steady_state_tol is not None:
+                change = np.max(np.abs(C - C_prev), axis=(1, 2))
+                steady_counters = np.where(change < steady_state_tol, steady_counters + 1, 0)
+
+                for idx, pollutant in enumerate(pollutants):
+                    if equilibrium_steps[pollutant] is None and steady_counters[idx] >= steady_state_patience:
+                        equilibrium_steps[pollutant] = step
+                        log_with_time(f"Batched simulation: pollutant {pollutant} reached steady state in step {step} (change < {steady_state_tol} for {steady_state_patience} steps)")
+
+                if all(equilibrium_step is not None for equilibrium_step in equilibrium_steps.values()):
+                    for idx, pollutant in enumerate(pollutants):
+                        pad_steady_snapshots(snap_concentrations[pollutant], C[idx], step, num_steps, snap_interval)
+                    log_with_time(f"Batched simulation: all pollutants reached steady state, stopping after step {step} of {num_steps}")
+                    break
+    finally:
+        release_time_stepper(update_concentration)
+
+    final_concentration = {pollutant: C[idx].flatten() for idx, pollutant in enumerate(pollutants)}
+
+    return final_concentration, snap_concentrations, equilibrium_steps
+
+
+def simulate_pollutants_quadtree(data, pollutants, base_grid, temp_values, press_values, u_values, v_values, pollutant_values, dx, dy, dt, num_steps,
+                                 surface_roughness=0.1, decay_rate=0.01, emission_rate=0.01, snap_interval=10, solver="implicit",
+                                 steady_state_tol=None, steady_state_patience=10, max_refinement_level=2, refine_gradient=0.1,
+                                 max_boxes=DEFAULT_MAX_BOXES, dtype=np.float64, snapshot_callback=None):
+    """
+    Simulation on the adaptive grid: base_grid is refined around measurements and in high gradient regions
+    (create_quadtree_grid), cells are stepped with Crank-Nicolson on the finite volume operator (build_quadtree_operator).
+    dx, dy - mean size of the base boxes in meters. Only sparse solvers can step variable size cells,
+    "implicit" is used for every solver except "steady".
+    Returns the same values as simulate_pollution_spread, fields are given in cell order of the returned QuadtreeGrid.
+    """
+    base_fields = {"temperature": temp_values, "pressure": press_values, "u": u_values, "v": v_values, **pollutant_values}
+    grid, fields = create_quadtree_grid(data, pollutants, base_grid, base_fields, max_level=max_refinement_level, refine_gradient=refine_gradient)
+
+    if len(grid) > max_boxes:
+        raise ValueError(f"Exceeded maximum number of boxes. Generated {len(grid)} quadtree cells, max allowed is {max_boxes}")
+
+    if solver not in ("implicit", "steady"):
+        log_with_time(f'Quadtree grid: "{solver}" solver can not step variable size cells, "implicit" solver is used', 'warning')
+        solver = "implicit"
+
+    n_cells = len(grid)
+    scale = grid.fine.shape[0] // base_grid.shape[0]
+    size_x = grid.cells[:, 2] * dx / scale
+    size_y = grid.cells[:, 2] * dy / scale
+    adjacency = grid.adjacency()
+
+    u = fields["u"]
+    v = fields["v"]
+
+    final_concentration = {}
+    store = SnapshotStore(2 if solver == "steady" else snapshot_count(num_steps, snap_interval), n_cells, dtype)
+    snap_concentrations = {pollutant: snapshot_series(pollutant, snapshot_callback, store=store) for pollutant in pollutants}
+    equilibrium_steps = {pollutant: None for pollutant in pollutants}
+
+    for pollutant in pollutants:
+
+        pollutant_decay_rate = pollutant_rate(decay_rate, pollutant)
+        pollutant_emission_rate = pollutant_rate(emission_rate, pollutant)
+
+        C = np.array(fields[pollutant], dtype=dtype)
+        K = pollutant_diffusion_coefficients(pollutant, fields["temperature"], fields["pressure"], u, v, (n_cells,), dx, surface_roughness)
+
+        dt_stable = calculate_stable_dt(u, v, K, K, dx / scale, dy / scale)
+        if dt > dt_stable:
+            log_with_time(f"Pollutant {pollutant} quadtree simulation: step time {dt} is unstable. Will be changed to: {dt_stable}.", 'warning')
+            dt = dt_stable
+
+        # Komórki siatki adaptacyjnej mają wartości w każdej komórce, tak jak siatka jednorodna po interpolacji
+        S_c = (C * (1 - np.exp(-pollutant_emission_rate * dt / 3600)) / dt).astype(dtype)
+        operator = build_quadtree_operator(adjacency, size_x, size_y, u, v, K)
+
+        snap_concentrations[pollutant].append(C.copy())
+
+        if solver == "steady":
+            C = solve_steady_system(operator, dt, S_c, (n_cells,), decay_rate=pollutant_decay_rate).astype(dtype)
+            log_with_time(f'Pollutant {pollutant} quadtree simulation: steady state solved directly, time stepping skipped')
+
+            snap_concentrations[pollutant].append(C)
+            final_concentration[pollutant] = C
+            continue
+
+        factorization = factorize_operator(operator, dt, (n_cells,), decay_rate=pollutant_decay_rate)
+        log_with_time(f'Pollutant {pollutant} quadtree simulation: {n_cells} cells, step time {dt}, using "implicit" solver')
+
+        steady_steps = 0
+        for step in range(num_steps):
+
+            C_prev = C
+            C = update_concentration_crank_nicolson_implicit(C, S_c, factorization).astype(dtype, copy=False)
+
+            if step % snap_interval == 0:
+                snap_concentrations[pollutant].append(C.copy())
+
+            if steady_state_tol is not None:
+                steady_steps = steady_steps + 1 if np.max(np.abs(C - C_prev)) < steady_state_tol else 0
+
+                if steady_steps >= steady_state_patience:
+                    equilibrium_steps[pollutant] = step
+                    pad_steady_snapshots(snap_concentrations[pollutant], C, step, num_steps, snap_interval)
+                    log_with_time(f"Pollutant {pollutant} quadtree simulation: steady state reached in step {step} of {num_steps}")
+                    break
+
+        final_concentration[pollutant] = C
+
+    return final_concentration, snap_concentrations, grid, fields["temperature"], fields["pressure"], u, v, equilibrium_steps
+
+
+def prepare_fields(data, pollutants, grid_density="medium", urbanized=False, margin_boxes=1, initial_distance=1, max_increment=1,
+                   max_boxes=DEFAULT_MAX_BOXES, interpolation="grid", interpolation_neighbors=8):
+    """
+    Part of the simulation that depends only on measurements and grid parameters (cached by FieldCache):
+    uniform grid, interpolated temperature, pressure, wind (u, v) and pollutant fields (flattened arrays),
+    and diffusion coefficients of every pollutant.
+    """
+    grid, temperature_values, pressure_values, u_grid, v_grid, flattened_pollutant_values, grid_shape = create_uniform_boxes(data, pollutants, grid_density=grid_density, urbanized=urbanized,
+                                                                                                                              margin_boxes=margin_boxes, max_boxes=max_boxes)
+
+    if interpolation not in INTERPOLATION_METHODS:
+        raise ValueError(f"Unsupported interpolation: {interpolation}. Available interpolation methods: {INTERPOLATION_METHODS}")
+
+    if interpolation == "kdtree":
+        latitudes, longitudes, measurements = measurement_arrays(data, pollutants)
+        fields = kdtree_interpolation(grid, latitudes, longitudes, measurements,
+                                      {"temperature": temperature_values, "pressure": pressure_values, "u": u_grid, "v": v_grid, **flattened_pollutant_values},
+                                      neighbors=interpolation_neighbors)
+        temp_values, press_values, u_values, v_values = fields["temperature"], fields["pressure"], fields["u"], fields["v"]
+        pollutant_values = {pollutant: fields[pollutant] for pollutant in pollutants}
+    else:
+        temp_values, press_values, u_values, v_values, pollutant_values = recursive_interpolation_until_filled(grid, temperature_values, pressure_values, u_grid, v_grid,
+                                                                                                              flattened_pollutant_values, grid_shape,
+                                                                                                              initial_distance=initial_distance, increment=max_increment)
+
+    dx = np.mean(convert_geo_to_meters(grid)[0])
+    surface_roughness = 1.0 if urbanized else 0.1
+    diffusion = {
+        pollutant: pollutant_diffusion_coefficients(pollutant, temp_values, press_values, u_values, v_values, grid_shape, dx, surface_roughness)
+        for pollutant in pollutants
+    }
+
+    return {
+        "grid": grid, "grid_shape": grid_shape,
+        "temperature": np.asarray(temp_values, dtype=np.float64), "pressure": np.asarray(press_values, dtype=np.float64),
+        "u": np.asarray(u_values, dtype=np.float64), "v": np.asarray(v_values, dtype=np.float64),
+        "pollutants": {pollutant: np.asarray(pollutant_values[pollutant], dtype=np.float64) for pollutant in pollutants},
+        "diffusion": diffusion,
+    }
+
+
+def simulate_pollution_spread(data, num_steps, pollutants, grid_density="medium", urbanized=False, margin_boxes=1, initial_distance=1, max_increment=1, decay_rate=0.01, emission_rate=0.01, debug=False, debug_dir=None, snap_interval=10, engine="vectorized", solver="fixed_point", batch_pollutants=False,
+                              steady_state_tol=None, steady_state_patience=10, parallel_workers=1, max_boxes=None,
+                              precision="float64", grid_type="uniform", max_refinement_level=2, refine_gradient=0.1,
+                              interpolation="grid", interpolation_neighbors=8, field_cache=None, snapshot_callback=None, worker_slots=None):
+  """
+  solver - "fixed_point" | "implicit" | "adi" | "steady" (see get_time_stepper). Steps use dt = 1 s lowered to the stability
+           limit, "adi" treats diffusion implicitly and steps with the advection limit instead, so the same num_steps
+           cover a longer time.
+  steady_state_tol - when set, stepping of a pollutant stops after max absolute change per step stays below it
+                     for steady_state_patience consecutive steps, remaining snapshots are filled with the steady state
+                     and the step is reported in equilibrium_steps (None if steady state was not reached).
+  parallel_workers - number of processes the "parallel" engine may use, the grid is split into strips of rows between them.
+  worker_slots - WorkerSlots of the worker pool, strip processes of the "parallel" engine take free slots of the pool
+                 (released after stepping), so the engine uses only workers that are really idle.
+  max_boxes - grid size limit, by default DEFAULT_MAX_BOXES (PARALLEL_MAX_BOXES for the "parallel" engine).
+  precision - "float64" | "float32", dtype of the state, stencil coefficients and snapshots. "fixed_point" solver runs
+              natively in float32, sparse solvers and the "parallel" engine compute in float64 and store float32.
+              Measured on reference flights (medium / dense grid, 30 and 300 steps, decay and emission rate 0.02) float32
+              final concentrations differ from float64 by at most 6e-6 of the maximal concentration ("fixed_point"),
+              3e-7 for "implicit". "fixed_point" error follows its absolute iteration tolerance (1e-4), so it grows
+              with higher concentrations (about 7e-6 with decay rate 0.01).
+  grid_type - "uniform" | "quadtree". "quadtree" refines boxes of the grid_density grid up to max_refinement_level times
+              (each level halves the box size) around measurements and where neighbouring boxes differ by more than
+              refine_gradient of the field maximum, see simulate_pollutants_quadtree.
+  interpolation - "grid" | "kdtree", filling of boxes without measurements. "grid" - passes of weighted mean of binned
+                  boxes within growing distance (initial_distance, max_increment), "kdtree" - inverse distance weighted
+                  mean of interpolation_neighbors nearest raw measurement points.
+  field_cache - FieldCache of prepared fields (grid, interpolated fields, diffusion coefficients), reruns of the same
+                measurements with the same grid and interpolation parameters skip straight to time stepping.
+  snapshot_callback - streaming mode, callback(pollutant, index, values) receives every snapshot as soon as it is taken,
+                      snapshots are not kept and returned snap_concentrations hold only their number (len).
+  """
     
   try:
     
-    boxes, temperature_values, pressure_values, u_grid, v_grid, flattened_pollutant_values, grid_shape = create_uniform_boxes(data,
-                                                                                                                              pollutants,
-                                                                                                                              grid_density=grid_density, urbanized=urbanized, margin_boxes=margin_boxes)
+    grid_parameters = dict(grid_density=grid_density, urbanized=urbanized, margin_boxes=margin_boxes, initial_distance=initial_distance,
+                           max_increment=max_increment, max_boxes=max_boxes or (PARALLEL_MAX_BOXES if engine == "parallel" else DEFAULT_MAX_BOXES),
+                           interpolation=interpolation, interpolation_neighbors=interpolation_neighbors)
+    
+    cache_key = field_cache.key(data, pollutants, **grid_parameters) if field_cache is not None else None
+    prepared = field_cache.load(cache_key) if cache_key is not None else None
+    
+    if prepared is None:
+      prepared = prepare_fields(data, pollutants, **grid_parameters)
+      if cache_key is not None:
+        field_cache.store(cache_key, prepared)
+    
+    grid, grid_shape = prepared["grid"], prepared["grid_shape"]
+    temp_values, press_values, u_values, v_values = prepared["temperature"], prepared["pressure"], prepared["u"], prepared["v"]
+    # Po interpolacji wartości początkowe i źródła emisji korzystają z tych samych (uzupełnionych) pól
+    pollutant_values = flattened_pollutant_values = prepared["pollutants"]
+    diffusion_coefficients = prepared["diffusion"]
     
-      
-    temp_values, press_values, u_values, v_values, pollutant_values = recursive_interpolation_until_filled(boxes,
-                                                                                                          temperature_values,
-                                                                                                          pressure_values,
-                                                                                                          u_grid,
-                                                                                                          v_grid,
-                                                                                                          flattened_pollutant_values,
-                                                                                                          grid_shape,
-                                                                                                          initial_distance=initial_distance,
-                                                                                                          increment=max_increment)      
-        
     if debug and debug_dir:
         image_path_wind_plot = f'{debug_dir}/multibox_grid_with_interpolated_wind_values.png'
         image_path_temp_plot = f'{debug_dir}/multibox_grid_with_interpolated_temp_values.png'
         image_path_press_plot = f'{debug_dir}/multibox_grid_with_interpolated_press_values.png'
           
-        plot_values_grid(boxes, temp_values, data, values_type="temperature", image_path=image_path_temp_plot)
-        plot_values_grid(boxes, press_values, data, values_type="pressure", image_path=image_path_press_plot)
-        plot_wind_grid(boxes, u_values, v_values, data, grid_shape=grid_shape, image_path=image_path_wind_plot)
+        plot_values_grid(grid, temp_values, data, values_type="temperature", image_path=image_path_temp_plot)
+        plot_values_grid(grid, press_values, data, values_type="pressure", image_path=image_path_press_plot)
+        plot_wind_grid(grid, u_values, v_values, data, grid_shape=grid_shape, image_path=image_path_wind_plot)
     
         
     # RUN SIMULATION, 
     
-    x_coords = sorted(set([box[0] for box in boxes]))
-    y_coords = sorted(set([box[2] for box in boxes]))
-    nx, ny = len(x_coords), len(y_coords)
+    dtype = resolve_precision(precision)
+    
+    if solver == "fixed_point":
+      engine = resolve_engine(engine)
     
-    dx_array, dy_array = convert_geo_to_meters(boxes)
+    nx, ny = grid.shape
+    
+    n_strips = 1
+    if solver == "fixed_point" and engine == "parallel":
+      n_strips = choose_strip_count((nx, ny), parallel_workers)
+      if n_strips < 2:
+        log_with_time(f'Grid {nx} x {ny} is too small for domain decomposition with {parallel_workers} workers, "parallel" engine falls back to "vectorized"')
+        engine = "vectorized"
+    
+    dx_array, dy_array = convert_geo_to_meters(grid)
     dx = np.mean(dx_array)
     dy = np.mean(dy_array)
     dt = 1
 
     
     final_concentration = {}
-    snap_concentrations = {pollutant: [] for pollutant in pollutants}
+    equilibrium_steps = {pollutant: None for pollutant in pollutants}
     surface_roughness = 1.0 if urbanized else 0.1
+    
+    if grid_type == "quadtree":
+      return simulate_pollutants_quadtree(data, pollutants, grid, temp_values, press_values, u_values, v_values, pollutant_values, dx, dy, dt, num_steps,
+                                          surface_roughness=surface_roughness, decay_rate=decay_rate, emission_rate=emission_rate,
+                                          snap_interval=snap_interval, solver=solver, steady_state_tol=steady_state_tol,
+                                          steady_state_patience=steady_state_patience, max_refinement_level=max_refinement_level,
+                                          refine_gradient=refine_gradient, max_boxes=max_boxes or DEFAULT_MAX_BOXES, dtype=dtype,
+                                          snapshot_callback=snapshot_callback)
+    elif grid_type != "uniform":
+      raise ValueError(f"Unsupported grid type: {grid_type}. Available grid types: {GRID_TYPES}")
+    
+    u = np.array(u_values, dtype=np.float64).reshape((nx, ny))
+    v = np.array(v_values, dtype=np.float64).reshape((nx, ny))
+    
+    if batch_pollutants:
+      final_concentration, snap_concentrations, equilibrium_steps = simulate_pollutants_batched(pollutant_values, flattened_pollutant_values, grid_shape, pollutants,
+                                                                                                temp_values, press_values, u, v, dx, dy, dt, num_steps,
+                                                                                                surface_roughness=surface_roughness, decay_rate=decay_rate, emission_rate=emission_rate,
+                                                                                                snap_interval=snap_interval, engine=engine, solver=solver,
+                                                                                                steady_state_tol=steady_state_tol, steady_state_patience=steady_state_patience,
+                                                                                                n_strips=n_strips, dtype=dtype,
+                                                                                                diffusion_coefficients=diffusion_coefficients, snapshot_callback=snapshot_callback,
+                                                                                                worker_slots=worker_slots)
+      return final_concentration, snap_concentrations, grid, temp_values, press_values, u_values, v_values, equilibrium_steps
 
+    store = SnapshotStore(2 if solver == "steady" else snapshot_count(num_steps, snap_interval), nx * ny, dtype)
+    snap_concentrations = {pollutant: snapshot_series(pollutant, snapshot_callback, store=store) for pollutant in pollutants}
+    
     for pollutant in pollutants:
       
-      C = np.array(pollutant_values[pollutant]).reshape((nx, ny))
+      pollutant_decay_rate = pollutant_rate(decay_rate, pollutant)
+      pollutant_emission_rate = pollutant_rate(emission_rate, pollutant)
       
-      K_x = calculate_diffusion_coefficients(
-          pollutant=pollutant,
-          temperatures=np.array(temp_values).reshape((nx, ny)),
-          pressures=np.array(press_values).reshape((nx, ny)),
-          u_wind=np.array(u_values).reshape((nx, ny)),
-          v_wind=np.array(v_values).reshape((nx,ny)),
-          z_levels=10,  # Stała wysokość referencyjna dla turbulentnej dyfuzji
-          box_size=dx,
-          surface_roughness=surface_roughness,
-          method="empirical") # "molecular" | "turbulent" | "empirical"
-
+      C = np.array(pollutant_values[pollutant], dtype=dtype).reshape((nx, ny))
+      
+      K_x = diffusion_coefficients[pollutant]
       K_y = K_x
-                
-      u = np.array(u_values).reshape((nx, ny))  
-      v = np.array(v_values).reshape((nx, ny)) 
                          
-      dt_stable = calculate_stable_dt(u, v, K_x, K_y, dx, dy)
+      dt_stable = calculate_stable_dt(u, v, K_x, K_y, dx, dy, include_diffusion=solver != "adi")
       
-      if dt > dt_stable:
+      if solver == "adi":
+          # Dyfuzja liczona jest niejawnie - krok czasowy ogranicza tylko warunek CFL adwekcji, a nie domyślne dt = 1
+          dt = dt_stable
+          log_with_time(f"Pollutant {pollutant} simulation: ADI solver, running with step time {dt} of the advection limit.")
+          
+      elif dt > dt_stable:
           log_with_time(f"Pollutant {pollutant} simulation: step time {dt} is unstable. Will be changed to: {dt_stable}.",'warning')          
           dt = dt_stable
           
       else:
           log_with_time(f"Pollutant {pollutant} simulation: running with step time {dt} (stability check passed: dt_stable = {dt_stable}).")
       
-      source_emission = initialize_source_emission(flattened_pollutant_values, grid_shape, pollutant, dt=dt, emission_rate=emission_rate)
-      log_with_time(f'Pollutant {pollutant} simulation: initialize_source_emission -> calculated emission_factor = {(1 - np.exp(-emission_rate * dt / 3600))} (based on emission_rate = {emission_rate})')
+      source_emission = initialize_source_emission(flattened_pollutant_values, grid_shape, pollutant, dt=dt, emission_rate=pollutant_emission_rate)
+      log_with_time(f'Pollutant {pollutant} simulation: initialize_source_emission -> calculated emission_factor = {(1 - np.exp(-pollutant_emission_rate * dt / 3600))} (based on emission_rate = {pollutant_emission_rate})')
       
-      log_with_time(f'Pollutant {pollutant} simulation: update_concentration_crank_nicolson -> calculated decay_factor = {np.exp(-decay_rate * dt / 3600)} (based on decay_rate = {decay_rate})')
+      log_with_time(f'Pollutant {pollutant} simulation: update_concentration_crank_nicolson -> calculated decay_factor = {np.exp(-pollutant_decay_rate * dt / 3600)} (based on decay_rate = {pollutant_decay_rate})')
 
 
-      S_c = np.zeros((nx, ny))
-      S_c = source_emission
+      S_c = np.zeros((nx, ny), dtype=dtype)
+      S_c = source_emission.astype(dtype)
     
       snap_concentrations[pollutant].append(C.copy().flatten())
 
       if debug and debug_dir:
         image_path = f'{debug_dir}/start_{pollutant}_concentration_grid.png'
-        plot_concentration_grid(boxes, C.flatten(), data, pollutant, image_path)
+        plot_concentration_grid(grid, C.flatten(), data, pollutant, image_path)
+      
+      if solver == "steady":
+        C = solve_steady_state(u, v, K_x, K_y, dx, dy, dt, S_c, decay_rate=pollutant_decay_rate).astype(dtype)
+        log_with_time(f'Pollutant {pollutant} simulation: steady state solved directly, time stepping skipped')
+        
+        snap_concentrations[pollutant].append(C.flatten())
+        final_concentration[pollutant] = C.flatten()
+        continue
+      
+      update_concentration = create_time_stepper(solver, engine, u, v, K_x, K_y, dx, dy, dt, S_c, nx, ny, decay_rate=pollutant_decay_rate, n_strips=n_strips,
+                                                 dtype=dtype, worker_slots=worker_slots)
+      log_with_time(f'Pollutant {pollutant} simulation: using "{solver}" solver' + (f' with "{engine}" engine' if solver == "fixed_point" else ''))
+      
+      if debug and solver == "fixed_point" and engine in CRANK_NICOLSON_ENGINES and engine != "loop":
+        max_diff = compare_crank_nicolson_engines(engine, C, u, v, K_x, K_y, dx, dy, dt, S_c, nx, ny, decay_rate=pollutant_decay_rate)
+        log_with_time(f'Pollutant {pollutant} simulation: "{engine}" engine differs from reference loop by {max_diff} after first step')
           
-      for step in range(num_steps):
+      try:
+        steady_steps = 0
+      
+        for step in range(num_steps):
         
-        C = update_concentration_crank_nicolson(C, u, v, K_x, K_y, dx, dy, dt, S_c, nx, ny, decay_rate=decay_rate)
+          C_prev = C
+          C = update_concentration(C).astype(dtype, copy=False)
         
-        if step % snap_interval == 0:
-          snap_concentrations[pollutant].append(C.copy().flatten())
+          if step % snap_interval == 0:
+            snap_concentrations[pollutant].append(C.copy().flatten())
+        
+          if steady_state_tol is not None:
+            steady_steps = steady_steps + 1 if np.max(np.abs(C - C_prev)) < steady_state_tol else 0
+          
+            if steady_steps >= steady_state_patience:
+              equilibrium_steps[pollutant] = step
+              pad_steady_snapshots(snap_concentrations[pollutant], C, step, num_steps, snap_interval)
+              log_with_time(f"Pollutant {pollutant} simulation: steady state reached in step {step} of {num_steps} (change < {steady_state_tol} for {steady_state_patience} steps)")
+              break
                 
         
-        if dt > dt_stable:
-          log_with_time(f"Pollutant {pollutant} simulation: step time {dt} becomce unstable in step: {step}. Will be changed to: {dt_stable}.", 'warning')
-          dt = min(dt, dt_stable)
+          if dt > dt_stable:
+            log_with_time(f"Pollutant {pollutant} simulation: step time {dt} becomce unstable in step: {step}. Will be changed to: {dt_stable}.", 'warning')
+            dt = min(dt, dt_stable)
+            release_time_stepper(update_concentration)
+            update_concentration = create_time_stepper(solver, engine, u, v, K_x, K_y, dx, dy, dt, S_c, nx, ny, decay_rate=pollutant_decay_rate, n_strips=n_strips,
+                                                 dtype=dtype, worker_slots=worker_slots)
+      finally:
+        release_time_stepper(update_concentration)
         
-      final_concentration[pollutant] = C.flatten().tolist()
+      final_concentration[pollutant] = C.flatten()
           
-      if debug and debug_dir and step == num_steps-1:
+      if debug and debug_dir and num_steps > 0:
         image_path = f'{debug_dir}/end_{pollutant}_concentration_grid.png'
-        plot_concentration_grid(boxes, C.flatten(), data, pollutant, image_path)
+        plot_concentration_grid(grid, C.flatten(), data, pollutant, image_path)
         
-    return final_concentration, snap_concentrations, boxes, temp_values, press_values, u_values, v_values
+    return final_concentration, snap_concentrations, grid, temp_values, press_values, u_values, v_values, equilibrium_steps
   
   except Exception as e:
     log_with_time(f"simulate_pollution_spread -> Error occurred: {str(e)}",'error')
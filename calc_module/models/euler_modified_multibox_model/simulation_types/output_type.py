@@ -8,7 +8,16 @@ class Box(TypedDict):
     lon_min: float
     lon_max: float
 
-class Grid(TypedDict):
+class GridOrigin(TypedDict):
+    lat: float
+    lon: float
+
+class Grid(TypedDict, total=False):
+    # Siatka jednorodna opisana jest przez deskryptor, lista boxes tylko w trybie legacy
+    type: str
+    origin: GridOrigin
+    cellSize: GridOrigin
+    shape: List[int]
     boxes: List[Box]
 
 class StepPollutants(TypedDict):
@@ -17,9 +26,22 @@ class StepPollutants(TypedDict):
     NO2: Optional[List[float]]
     SO2: Optional[List[float]]
 
-class PollutantsData(TypedDict):
+class EncodedSnapshots(TypedDict):
+    # snapshot_codec.encode_snapshots, data: bytes (base64 w JSON)
+    codec: str
+    version: int
+    shape: List[int]
+    scale: float
+    keyframeDtype: str
+    deltaDtype: str
+    compression: str
+    data: bytes
+
+class PollutantsData(TypedDict, total=False):
     steps: Dict[int, StepPollutants]
+    encodedSteps: Dict[str, EncodedSnapshots]
     final_step: StepPollutants
+    equilibrium_step: Dict[str, Optional[int]]
 
 class Environment(TypedDict):
     temperature: List[float]
@@ -35,22 +57,33 @@ class OutputType(TypedDict):
 def convert_to_output_type(
     concentration_data: Dict[str, List[float]], 
     snap_concentrations: Dict[str, List[List[float]]],
-    boxes: List[tuple],
+    grid: Union["UniformGrid", List[tuple]],
     temp_values: List[float],
     press_values: List[float],
     u_values: List[float],
-    v_values: List[float]
+    v_values: List[float],
+    equilibrium_steps: Optional[Dict[str, Optional[int]]] = None,
+    legacy_grid: bool = False,
+    encoded_snapshots: Optional[Dict[str, EncodedSnapshots]] = None
 ) -> OutputType:
   
-    formatted_boxes = [
-        {
-            "lat_min": box[0],
-            "lat_max": box[1],
-            "lon_min": box[2],
-            "lon_max": box[3]
+    # UniformGrid (grid.py) nie jest importowany - utils importuje ten moduł, a grid importuje utils
+    if hasattr(grid, "to_descriptor"):
+        grid_data = grid.to_descriptor()
+        if legacy_grid:
+            grid_data["boxes"] = grid.to_boxes()
+    else:
+        grid_data = {
+            "boxes": [
+                {
+                    "lat_min": box[0],
+                    "lat_max": box[1],
+                    "lon_min": box[2],
+                    "lon_max": box[3]
+                }
+                for box in grid
+            ]
         }
-        for box in boxes
-    ]
 
     wind_speed = []
     wind_direction = []
@@ -65,9 +98,7 @@ def convert_to_output_type(
         wind_direction.append(azimuth)
 
     output_data: OutputType = {
-        "grid": {
-            "boxes": formatted_boxes
-        },
+        "grid": grid_data,
         "pollutants": {
             "steps": {}
         },
@@ -79,7 +110,12 @@ def convert_to_output_type(
         }
     }
     
-    num_steps = len(next(iter(snap_concentrations.values())))
+    # Zakodowane snapshoty (snapshot_codec) zastępują listę kroków
+    if encoded_snapshots is not None:
+        output_data["pollutants"]["encodedSteps"] = encoded_snapshots
+        snap_concentrations = {}
+    
+    num_steps = len(next(iter(snap_concentrations.values()), []))
     for step_idx in range(num_steps):
         output_data["pollutants"]["steps"][step_idx] = {
             pollutant: snap_concentrations[pollutant][step_idx]
@@ -87,10 +123,11 @@ def convert_to_output_type(
         }
 
 
-    output_data["pollutants"]["final_step"] = {
-        pollutant: concentrations.tolist() if isinstance(concentrations, np.ndarray) else concentrations
-        for pollutant, concentrations in concentration_data.items()
-    }
+    # Tablice (wiersze magazynu snapshotów, pola końcowe) przekazywane są bez kopiowania, konwersję wykonuje serializacja
+    output_data["pollutants"]["final_step"] = dict(concentration_data)
+
+    if equilibrium_steps is not None:
+        output_data["pollutants"]["equilibrium_step"] = equilibrium_steps
 
 
     return output_data
@@ -120,8 +157,11 @@ def convert_to_output_type(
 """
 {
     "grid": {
-        "boxes": [
-            {"lat_min": , "lat_max": , "lon_min": , "lon_max": },
+        "type": "uniform",
+        "origin": {"lat": , "lon": },           # lat_min, lon_min of the first box
+        "cellSize": {"lat": , "lon": },
+        "shape": [num_lat_boxes, num_lon_boxes],  # boxes numbered row-major
+        "boxes": [                              # only with legacyGrid
             {"lat_min": , "lat_max": , "lon_min": , "lon_max": },
             ...
         ]
@@ -0,0 +1,115 @@
+"""
+Lossy codec of snapshot series (n_snapshots, cells) of one pollutant.
+
+Snapshots are quantized with step just below 2 * error_bound (so every value is restored with absolute error <= error_bound),
+the first snapshot is stored as keyframe of quantized values and every next one as difference of quantized values
+from the previous snapshot. Consecutive snapshots differ only slightly, so differences fit small integers, which
+(after splitting into byte planes) are compressed with zlib or lzma from the standard library.
+"""
+import base64
+import lzma
+import zlib
+
+import numpy as np
+
+CODEC_NAME = "delta-quantized"
+CODEC_VERSION = 1
+
+COMPRESSORS = {
+    "zlib": (lambda data: zlib.compress(data, 6), zlib.decompress),
+    "lzma": (lambda data: lzma.compress(data, preset=6), lzma.decompress),
+}
+
+INTEGER_DTYPES = (np.int8, np.int16, np.int32, np.int64)
+QUANTIZATION_MARGIN = 1e-6
+
+
+def _smallest_integer_dtype(values):
+    low, high = (int(values.min()), int(values.max())) if values.size else (0, 0)
+    for dtype in INTEGER_DTYPES:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return np.dtype(dtype).newbyteorder("<")
+    raise ValueError("Quantized snapshots do not fit 64-bit integers, error bound is too small")
+
+
+def _byte_planes(values):
+    # Bajty o tej samej pozycji (najpierw najmłodsze) leżą obok siebie - starsze bajty małych różnic to głównie zera
+    return values.view(np.uint8).reshape(-1, values.dtype.itemsize).T.tobytes()
+
+
+def _from_byte_planes(data, dtype, count):
+    planes = np.frombuffer(data, dtype=np.uint8, count=count * dtype.itemsize).reshape(dtype.itemsize, count)
+    return np.ascontiguousarray(planes.T).view(dtype).reshape(count)
+
+
+def encode_snapshots(snapshots, error_bound, compression="zlib"):
+    """
+    Encodes snapshots (n_snapshots, cells) with absolute error <= error_bound, returns dict with codec description
+    and compressed "data" (bytes).
+    """
+    if compression not in COMPRESSORS:
+        raise ValueError(f"Unsupported snapshot compression: {compression}. Available compressions: {list(COMPRESSORS)}")
+    if error_bound <= 0:
+        raise ValueError(f"Snapshot error bound has to be positive, got {error_bound}")
+
+    snapshots = np.asarray(snapshots, dtype=np.float64)
+    snapshots = snapshots.reshape(len(snapshots), -1)
+    if not np.isfinite(snapshots).all():
+        raise ValueError("Snapshots with NaN or infinite values can not be encoded")
+
+    # Krok nieco mniejszy niż 2 * error_bound - wartości w połowie kroku po zaokrągleniach float nie przekraczają błędu
+    scale = 2 * float(error_bound) * (1 - QUANTIZATION_MARGIN)
+    quantized = np.rint(snapshots / scale)
+    if snapshots.size and np.max(np.abs(quantized)) >= 2**63:
+        raise ValueError("Quantized snapshots do not fit 64-bit integers, error bound is too small")
+    quantized = quantized.astype(np.int64)
+    if snapshots.size and np.max(np.abs(quantized * scale - snapshots)) > error_bound:
+        raise ValueError(f"Snapshot error bound {error_bound} is too small for float precision of the snapshot values")
+    keyframe = quantized[:1].ravel()
+    deltas = np.diff(quantized, axis=0).ravel()
+
+    keyframe_dtype = _smallest_integer_dtype(keyframe)
+    delta_dtype = _smallest_integer_dtype(deltas)
+    payload = _byte_planes(keyframe.astype(keyframe_dtype)) + _byte_planes(deltas.astype(delta_dtype))
+
+    return {
+        "codec": CODEC_NAME,
+        "version": CODEC_VERSION,
+        "shape": list(snapshots.shape),
+        "scale": scale,
+        "keyframeDtype": keyframe_dtype.str,
+        "deltaDtype": delta_dtype.str,
+        "compression": compression,
+        "data": COMPRESSORS[compression][0](payload),
+    }
+
+
+def decode_snapshots(encoded):
+    """
+    Inverse of encode_snapshots, returns float64 array (n_snapshots, cells).
+    "data" may be bytes, base64 string (JSON reply) or uint8 array (binary reply).
+    """
+    if encoded.get("codec") != CODEC_NAME or encoded.get("version") != CODEC_VERSION:
+        raise ValueError(f"Unsupported snapshot codec: {encoded.get('codec')} version {encoded.get('version')}")
+
+    data = encoded["data"]
+    if isinstance(data, str):
+        data = base64.b64decode(data)
+    elif isinstance(data, np.ndarray):
+        data = data.tobytes()
+    payload = COMPRESSORS[encoded["compression"]][1](data)
+
+    n_snapshots, cells = encoded["shape"]
+    if n_snapshots == 0:
+        return np.empty((0, cells))
+
+    keyframe_dtype = np.dtype(encoded["keyframeDtype"])
+    delta_dtype = np.dtype(encoded["deltaDtype"])
+    keyframe_size = cells * keyframe_dtype.itemsize
+
+    quantized = np.empty((n_snapshots, cells), dtype=np.int64)
+    quantized[0] = _from_byte_planes(payload[:keyframe_size], keyframe_dtype, cells)
+    quantized[1:] = _from_byte_planes(payload[keyframe_size:], delta_dtype, (n_snapshots - 1) * cells).reshape(n_snapshots - 1, cells)
+
+    return np.cumsum(quantized, axis=0) * encoded["scale"]
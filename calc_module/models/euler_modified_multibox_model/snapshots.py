@@ -0,0 +1,136 @@
+"""
+Containers of concentration snapshots taken every snap_interval steps.
+
+Snapshots of a pollutant are written to rows of one preallocated (n_snapshots, cells) array of a SnapshotStore,
+stores larger than the memory budget (SNAPSHOT_MEMORY_BUDGET_MB) are backed by np.memmap of an anonymous
+temporary file in SNAPSHOT_SPILL_DIR. With a snapshot callback (streaming mode) every snapshot is handed over
+as soon as it is taken and is not kept by the simulation.
+"""
+import math
+import os
+import tempfile
+
+import numpy as np
+
+from utils import log_with_time
+
+DEFAULT_MEMORY_BUDGET_MB = 512
+
+
+def snapshot_count(num_steps, snap_interval):
+    """
+    Number of snapshots of a full run: initial state and every snap_interval-th step (0, snap_interval, ...).
+    """
+    return 1 + math.ceil(num_steps / snap_interval)
+
+
+class SnapshotStream:
+    """
+    List-like series of snapshots of one pollutant, append passes the snapshot to callback(pollutant, index, values),
+    only the number of snapshots is kept.
+    """
+
+    def __init__(self, pollutant, callback):
+        self.pollutant = pollutant
+        self.callback = callback
+        self.count = 0
+
+    def append(self, values):
+        self.callback(self.pollutant, self.count, values)
+        self.count += 1
+
+    def extend(self, snapshots):
+        for values in snapshots:
+            self.append(values)
+
+    def __len__(self):
+        return self.count
+
+
+class SnapshotSeries:
+    """
+    List-like series of snapshots of one pollutant written to rows of a preallocated array.
+    Indexing and iteration give views of the rows (no copies), array is the view of all filled rows.
+    """
+
+    def __init__(self, store, pollutant, rows):
+        self.store = store
+        self.pollutant = pollutant
+        self.rows = rows
+        self.count = 0
+
+    def append(self, values):
+        if self.count == len(self.rows):
+            self.rows = self.store.grow(self.pollutant, self.rows)
+        self.rows[self.count] = np.reshape(values, -1)
+        self.count += 1
+
+    def extend(self, snapshots):
+        for values in snapshots:
+            self.append(values)
+
+    @property
+    def array(self):
+        return self.rows[:self.count]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.array[index]
+
+    def __iter__(self):
+        return iter(self.array)
+
+
+class SnapshotStore:
+    """
+    Preallocated snapshot arrays (capacity, cells) of every pollutant, capacity is usually snapshot_count(num_steps, snap_interval).
+    When all arrays take more than memory_budget bytes they are allocated as np.memmap in spill_dir
+    (the temporary file is removed by the system when the arrays are released).
+    """
+
+    def __init__(self, capacity, cells, dtype=np.float64, memory_budget=None, spill_dir=None):
+        self.capacity = max(1, capacity)
+        self.cells = cells
+        self.dtype = np.dtype(dtype)
+        self.memory_budget = memory_budget if memory_budget is not None else float(os.getenv("SNAPSHOT_MEMORY_BUDGET_MB", DEFAULT_MEMORY_BUDGET_MB)) * 1024**2
+        self.spill_dir = spill_dir or os.getenv("SNAPSHOT_SPILL_DIR") or tempfile.gettempdir()
+        self.allocated = 0
+
+    def _allocate(self, rows):
+        nbytes = rows * self.cells * self.dtype.itemsize
+        self.allocated += nbytes
+        if self.allocated <= self.memory_budget:
+            return np.empty((rows, self.cells), dtype=self.dtype)
+
+        log_with_time(f"SnapshotStore -> {self.allocated / 1024**2:.1f} MB of snapshots exceeds memory budget, {nbytes / 1024**2:.1f} MB backed by file in {self.spill_dir}")
+        with tempfile.TemporaryFile(dir=self.spill_dir) as file:
+            return np.memmap(file, dtype=self.dtype, mode="w+", shape=(rows, self.cells))
+
+    def series(self, pollutant, initial=()):
+        series = SnapshotSeries(self, pollutant, self._allocate(self.capacity))
+        series.extend(initial)
+        return series
+
+    def grow(self, pollutant, rows):
+        # Więcej snapshotów niż przewidziano (capacity) - tablica jest powiększana dwukrotnie
+        log_with_time(f"SnapshotStore -> more than {len(rows)} snapshots of {pollutant}, snapshot array is enlarged", 'warning')
+        grown = self._allocate(2 * len(rows))
+        grown[:len(rows)] = rows
+        return grown
+
+
+def snapshot_series(pollutant, snapshot_callback=None, initial=(), store=None):
+    """
+    Series for snapshots of a pollutant: SnapshotStream when snapshot_callback is given,
+    otherwise series of the store (list without a store).
+    """
+    if snapshot_callback is not None:
+        series = SnapshotStream(pollutant, snapshot_callback)
+    elif store is not None:
+        return store.series(pollutant, initial)
+    else:
+        series = []
+    series.extend(initial)
+    return series
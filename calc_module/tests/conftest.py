@@ -0,0 +1,42 @@
+import os
+import sys
+
+# Moduły calc_module importowane są względem katalogu calc_module (tak jak w obrazie, PYTHONPATH=/app)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+POLLUTANTS = ["CO", "O3", "NO2", "SO2"]
+
+
+def drone_flight_request(n_measurements=20, seed=0, **parameters):
+    """
+    Simulation request (as sent by the backend) with a drone flight of n_measurements points
+    along a curved path over Warsaw, wind from the south.
+    """
+    rng = np.random.default_rng(seed)
+    path = np.linspace(0, 1, n_measurements)
+    measurements = [{
+        'id': index,
+        'name': f'P{index}',
+        'latitude': float(52.2297 + 0.01 * t + 0.001 * rng.standard_normal()),
+        'longitude': float(21.0122 + 0.015 * t**1.3 + 0.001 * rng.standard_normal()),
+        'temperature': float(22 + rng.standard_normal()),
+        'pressure': float(101325 + 10 * rng.standard_normal()),
+        'windSpeed': float(5 + rng.random()),
+        'windDirection': float(170 + 20 * rng.random()),
+        'pollutionMeasurements': [
+            {'type': 'CO', 'value': float(500 + 30 * rng.random())},
+            {'type': 'O3', 'value': float(120 + 30 * rng.random())},
+            {'type': 'SO2', 'value': float(20 + 5 * rng.random())},
+            {'type': 'NO2', 'value': float(40 + 5 * rng.random())},
+        ],
+    } for index, t in enumerate(path)]
+
+    request = {
+        'droneFlight': {'id': 1, 'measurements': measurements},
+        'numSteps': 30, 'pollutants': POLLUTANTS, 'gridDensity': 'medium', 'urbanized': False,
+        'marginBoxes': 1, 'initialDistance': 1, 'decayRate': 0.02, 'emissionRate': 0.02, 'snapInterval': 10,
+    }
+    request.update(parameters)
+    return request
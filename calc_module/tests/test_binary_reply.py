@@ -0,0 +1,65 @@
+import json
+import struct
+
+import numpy as np
+import pytest
+
+from utils import BINARY_ALIGNMENT, deserialize_output_binary, serialize_output_binary
+
+
+def reply(name):
+    return {
+        "status": "success",
+        "result": {
+            "name": name,
+            "grid": {"shape": [3, 4], "cells": [[0, 0, 2], [0, 2, 1], [1, 2, 1]]},
+            "temperature": np.linspace(280, 290, 12),
+            "pollutants": {"CO": [[1.5, float("nan")], [2.5, 3.5]]},
+            "snapshot": np.arange(6, dtype=np.float32).reshape(2, 3),
+            "counts": np.arange(5, dtype=np.int64),
+            "encoded": b"\x01\x02\x03",
+        },
+    }
+
+
+@pytest.mark.parametrize("name", ["x" * length for length in range(BINARY_ALIGNMENT)])
+def test_blocks_are_aligned(name):
+    body = serialize_output_binary(reply(name))
+    _, header_length = struct.unpack_from("<II", body, 4)
+    header = json.loads(body[12:12 + header_length])
+
+    assert (12 + header_length) % BINARY_ALIGNMENT == 0
+    for block in header["blocks"]:
+        assert (12 + header_length + block["offset"]) % BINARY_ALIGNMENT == 0
+
+    decoded = deserialize_output_binary(body)["result"]
+    assert decoded["temperature"].flags.aligned and decoded["snapshot"].flags.aligned
+
+
+def test_round_trip():
+    original = reply("round trip")["result"]
+    body = serialize_output_binary(reply("round trip"))
+    decoded = deserialize_output_binary(body)["result"]
+
+    assert decoded["name"] == "round trip"
+    np.testing.assert_array_equal(decoded["temperature"], original["temperature"])
+    np.testing.assert_array_equal(decoded["pollutants"]["CO"], np.array(original["pollutants"]["CO"]))
+    assert decoded["snapshot"].dtype == np.float32
+    np.testing.assert_array_equal(decoded["snapshot"], original["snapshot"])
+    np.testing.assert_array_equal(decoded["counts"], original["counts"])
+    assert decoded["encoded"].tobytes() == original["encoded"]
+
+
+def test_int_lists_stay_in_json_header():
+    body = serialize_output_binary(reply("descriptors"))
+    decoded = deserialize_output_binary(body)["result"]
+
+    # Opis siatki pozostaje listą int, tak jak w odpowiedzi JSON
+    assert decoded["grid"] == {"shape": [3, 4], "cells": [[0, 0, 2], [0, 2, 1], [1, 2, 1]]}
+
+
+def test_large_integer_arrays_stay_in_json_header():
+    values = np.array([0, 2**40], dtype=np.int64)
+    decoded = deserialize_output_binary(serialize_output_binary({"values": values}))
+
+    assert decoded["values"] == [0, 2**40]
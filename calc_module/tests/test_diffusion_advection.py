@@ -0,0 +1,194 @@
+import numpy as np
+import pytest
+
+from models.euler_modified_multibox_model import diffusion_advection
+from models.euler_modified_multibox_model.diffusion_advection import (
+    build_advection_diffusion_operator,
+    build_quadtree_operator,
+    calculate_stable_dt,
+    factorize_crank_nicolson,
+    get_crank_nicolson_engine,
+    get_time_stepper,
+    solve_steady_state,
+    update_concentration_crank_nicolson,
+    update_concentration_crank_nicolson_implicit,
+    update_concentration_crank_nicolson_vectorized,
+    upwind_stencil_coefficients,
+)
+from models.euler_modified_multibox_model.grid import QuadtreeGrid, UniformGrid
+from models.euler_modified_multibox_model.numba_kernels import NUMBA_AVAILABLE, update_concentration_crank_nicolson_numba
+
+# Tolerancja iteracji punktu stałego (update_concentration_crank_nicolson, tol=1e-4)
+FIXED_POINT_TOL = 1e-4
+
+
+@pytest.fixture
+def fields():
+    rng = np.random.default_rng(7)
+    nx, ny = 23, 31
+    # Wiatr o obu znakach (oba warianty upwind) i niejednorodna dyfuzja
+    u = rng.uniform(-4, 4, (nx, ny))
+    v = rng.uniform(-4, 4, (nx, ny))
+    K_x = rng.uniform(5, 50, (nx, ny))
+    K_y = rng.uniform(5, 50, (nx, ny))
+    C = rng.uniform(0, 2, (nx, ny))
+    S_c = np.where(rng.random((nx, ny)) < 0.1, rng.uniform(0, 1e-3, (nx, ny)), 0.0)
+    dx, dy = 120.0, 90.0
+    dt = 0.5 * calculate_stable_dt(u, v, K_x, K_y, dx, dy)
+    return dict(C=C, u=u, v=v, K_x=K_x, K_y=K_y, dx=dx, dy=dy, dt=dt, S_c=S_c, nx=nx, ny=ny)
+
+
+@pytest.mark.parametrize("decay_rate", [0.0, 0.01, 5.0])
+def test_vectorized_matches_reference_loop(fields, decay_rate):
+    reference = update_concentration_crank_nicolson(**fields, decay_rate=decay_rate)
+    result = update_concentration_crank_nicolson_vectorized(**fields, decay_rate=decay_rate)
+
+    assert result.shape == reference.shape
+    np.testing.assert_allclose(result, reference, rtol=0, atol=1e-12)
+
+
+def test_vectorized_matches_reference_loop_over_many_steps(fields):
+    reference = fields["C"]
+    result = fields["C"]
+    for _ in range(10):
+        reference = update_concentration_crank_nicolson(**dict(fields, C=reference))
+        result = update_concentration_crank_nicolson_vectorized(**dict(fields, C=result))
+
+    np.testing.assert_allclose(result, reference, rtol=0, atol=1e-11)
+
+
+def test_implicit_matches_fixed_point_loop(fields):
+    factorization = factorize_crank_nicolson(fields["u"], fields["v"], fields["K_x"], fields["K_y"], fields["dx"], fields["dy"], fields["dt"])
+    reference = converged = implicit = fields["C"]
+    for _ in range(5):
+        reference = update_concentration_crank_nicolson(**dict(fields, C=reference))
+        converged = update_concentration_crank_nicolson_vectorized(**dict(fields, C=converged), max_iter=500, tol=1e-14)
+        implicit = update_concentration_crank_nicolson_implicit(implicit, fields["S_c"], factorization)
+
+    # Pętla kończy iterację przy zmianie < tol, rozwiązanie implicit jest dokładnym punktem stałym
+    np.testing.assert_allclose(implicit, reference, rtol=0, atol=FIXED_POINT_TOL)
+    np.testing.assert_allclose(implicit, converged, rtol=0, atol=1e-12)
+
+
+def test_implicit_stepper_factorizes_once(fields, monkeypatch):
+    factorizations = []
+    splu = diffusion_advection.splu
+    monkeypatch.setattr(diffusion_advection, "splu", lambda matrix: factorizations.append(matrix) or splu(matrix))
+
+    f = fields
+    update_concentration = get_time_stepper("implicit", "vectorized", f["u"], f["v"], f["K_x"], f["K_y"], f["dx"], f["dy"], f["dt"], f["S_c"], f["nx"], f["ny"])
+    C = f["C"]
+    for _ in range(10):
+        C = update_concentration(C)
+
+    assert len(factorizations) == 1
+
+
+@pytest.mark.skipif(not NUMBA_AVAILABLE, reason="numba is not installed")
+@pytest.mark.parametrize("dtype, atol", [(np.float64, 1e-12), (np.float32, 1e-5)])
+def test_numba_matches_vectorized(fields, dtype, atol):
+    coefficients = diffusion_advection.upwind_stencil_coefficients(fields["u"], fields["v"], fields["K_x"], fields["K_y"], fields["dx"], fields["dy"], dtype=dtype)
+    vectorized = numba = fields["C"].astype(dtype)
+    workspace = {}
+    for _ in range(10):
+        vectorized = update_concentration_crank_nicolson_vectorized(**dict(fields, C=vectorized), coefficients=coefficients)
+        numba = update_concentration_crank_nicolson_numba(**dict(fields, C=numba), coefficients=coefficients, workspace=workspace)
+
+    assert numba.dtype == dtype
+    np.testing.assert_allclose(numba, vectorized, rtol=0, atol=atol)
+
+
+def test_numba_engine_falls_back_to_vectorized(fields, monkeypatch):
+    monkeypatch.setattr(diffusion_advection, "NUMBA_AVAILABLE", False)
+
+    f = fields
+    update_concentration = get_crank_nicolson_engine("numba", f["u"], f["v"], f["K_x"], f["K_y"], f["dx"], f["dy"])
+
+    assert update_concentration.func is update_concentration_crank_nicolson_vectorized
+    np.testing.assert_allclose(update_concentration(**f), update_concentration_crank_nicolson_vectorized(**f), rtol=0, atol=1e-12)
+
+
+def test_adi_is_bounded_above_diffusion_limit(fields):
+    f = dict(fields, K_x=fields["K_x"] * 60, K_y=fields["K_y"] * 60, S_c=np.zeros_like(fields["S_c"]))
+    dt = calculate_stable_dt(f["u"], f["v"], f["K_x"], f["K_y"], f["dx"], f["dy"], include_diffusion=False)
+    assert dt > 10 * calculate_stable_dt(f["u"], f["v"], f["K_x"], f["K_y"], f["dx"], f["dy"])
+
+    adi = get_time_stepper("adi", "vectorized", f["u"], f["v"], f["K_x"], f["K_y"], f["dx"], f["dy"], dt, f["S_c"], f["nx"], f["ny"])
+    fixed_point = get_time_stepper("fixed_point", "vectorized", f["u"], f["v"], f["K_x"], f["K_y"], f["dx"], f["dy"], dt, f["S_c"], f["nx"], f["ny"])
+
+    # Peaceman-Rachford jest stabilny w normie L2 (pojedynczy krok może przestrzelić maksimum szorstkiego pola)
+    C = f["C"]
+    norms = []
+    for _ in range(300):
+        C = adi(C)
+        norms.append(np.linalg.norm(C))
+    assert np.all(np.isfinite(C))
+    assert max(norms) <= np.linalg.norm(f["C"])
+    assert norms[-1] < 1e-9 * np.linalg.norm(f["C"])
+
+    # Jawna dyfuzja przy tym samym kroku jest niestabilna
+    C = f["C"]
+    with np.errstate(all="ignore"):
+        for _ in range(50):
+            C = fixed_point(C)
+    assert not np.linalg.norm(C) <= np.linalg.norm(f["C"])
+
+
+@pytest.mark.parametrize("decay_rate", [36.0, 3600.0])
+def test_steady_state_matches_long_implicit_run(fields, decay_rate):
+    # Stan (2, nx, ny) - wiele prawych stron jednego układu
+    S_c = np.stack([fields["S_c"], 3 * fields["S_c"][::-1]])
+    steady = solve_steady_state(fields["u"], fields["v"], fields["K_x"], fields["K_y"], fields["dx"], fields["dy"], fields["dt"], S_c, decay_rate=decay_rate)
+
+    update_concentration = get_time_stepper("implicit", "vectorized", fields["u"], fields["v"], fields["K_x"], fields["K_y"], fields["dx"], fields["dy"],
+                                            fields["dt"], S_c, fields["nx"], fields["ny"], decay_rate=decay_rate)
+    C = np.stack([fields["C"], fields["C"]])
+    for _ in range(3000):
+        C = update_concentration(C)
+
+    assert steady.shape == C.shape
+    np.testing.assert_allclose(steady, C, rtol=0, atol=1e-12 * np.abs(steady).max())
+
+
+def test_steady_state_falls_back_to_gmres(fields, monkeypatch):
+    arguments = (fields["u"], fields["v"], fields["K_x"], fields["K_y"], fields["dx"], fields["dy"], fields["dt"], fields["S_c"])
+    direct = solve_steady_state(*arguments, decay_rate=36.0)
+
+    monkeypatch.setattr(diffusion_advection, "spsolve", lambda system, rhs: np.full(rhs.shape, np.nan))
+    fallback = solve_steady_state(*arguments, decay_rate=36.0)
+
+    assert np.all(np.isfinite(fallback))
+    # Domyślna tolerancja względna GMRES (1e-5 normy residuum)
+    np.testing.assert_allclose(fallback, direct, rtol=0, atol=1e-4 * np.abs(direct).max())
+
+
+def test_quadtree_operator_without_refinement_matches_uniform_stencil(fields):
+    nx, ny = fields["nx"], fields["ny"]
+    grid = QuadtreeGrid(UniformGrid(52.0, 21.0, 0.001, 0.001, (nx, ny)), [[i, j, 1] for i in range(nx) for j in range(ny)])
+    K = fields["K_x"]
+
+    quadtree = build_quadtree_operator(grid.adjacency(), np.full(nx * ny, fields["dx"]), np.full(nx * ny, fields["dy"]),
+                                       fields["u"].ravel(), fields["v"].ravel(), K.ravel())
+    uniform = build_advection_diffusion_operator(upwind_stencil_coefficients(fields["u"], fields["v"], K, K, fields["dx"], fields["dy"]))
+
+    scale = np.abs(uniform).max()
+    np.testing.assert_allclose(quadtree.toarray(), uniform.toarray(), rtol=0, atol=1e-14 * scale)
+
+
+def test_quadtree_diffusion_fluxes_are_antisymmetric():
+    # Siatka 8 x 8 z komórkami 4 x 4, 2 x 2 i 1 x 1 (sąsiedzi różnych rozmiarów)
+    cells = [[0, 0, 4]] + [[i, j, 2] for i in (0, 2) for j in (4, 6)] + [[i, j, 1] for i in range(4, 8) for j in range(8)]
+    grid = QuadtreeGrid(UniformGrid(52.0, 21.0, 0.001, 0.001, (8, 8)), cells)
+    adjacency = grid.adjacency()
+    dx, dy = 120.0, 90.0
+    size_x, size_y = grid.cells[:, 2] * dx, grid.cells[:, 2] * dy
+    n_cells = len(grid)
+
+    operator = build_quadtree_operator(adjacency, size_x, size_y, np.zeros(n_cells), np.zeros(n_cells), np.full(n_cells, 30.0)).toarray()
+
+    # Strumień z komórki a do b (ważony polem komórki) jest przeciwny strumieniowi z b do a
+    area_weighted = (size_x * size_y)[:, None] * operator
+    np.testing.assert_allclose(area_weighted, area_weighted.T, rtol=1e-12, atol=0)
+    # Poza komórkami brzegowymi masa jest zachowana
+    interior = np.setdiff1d(np.arange(n_cells), adjacency["boundary_cell"])
+    np.testing.assert_allclose(area_weighted[:, interior].sum(axis=0), 0, atol=1e-12 * np.abs(area_weighted).max())
@@ -0,0 +1,82 @@
+import multiprocessing as mp
+import os
+import signal
+import time
+
+import numpy as np
+import pytest
+
+from models.euler_modified_multibox_model.diffusion_advection import update_concentration_crank_nicolson_vectorized, upwind_stencil_coefficients
+from models.euler_modified_multibox_model.domain_decomposition import ParallelStencilStepper, WorkerSlots
+
+
+def stepper_fields(nx=40, ny=30):
+    rng = np.random.default_rng(3)
+    u, v = rng.uniform(-2, 2, (2, nx, ny))
+    K = rng.uniform(5, 20, (nx, ny))
+    S_c = np.where(rng.random((nx, ny)) < 0.05, 1e-3, 0.0)
+    C = rng.uniform(0, 1, (nx, ny))
+    return C, upwind_stencil_coefficients(u, v, K, K, 100.0, 100.0), S_c
+
+
+def is_running(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            return stat.read().split(")")[-1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def test_worker_slots_reserve_only_free_slots():
+    busy, held = mp.Value('i', 3), mp.Value('i', 1, lock=False)
+    slots = WorkerSlots(busy, 4, held)
+
+    assert slots.reserve(3) == 1
+    assert (busy.value, held.value) == (4, 2)
+    assert slots.reserve(2) == 0
+
+    slots.release(1)
+    assert (busy.value, held.value) == (3, 1)
+
+
+def test_parallel_stepper_matches_vectorized_and_releases_slots():
+    C, coefficients, S_c = stepper_fields()
+    busy = mp.Value('i', 1)
+    slots = WorkerSlots(busy, 4)
+    reserved = slots.reserve(2)
+
+    stepper = ParallelStencilStepper(coefficients, S_c, 1.0, reserved + 1, worker_slots=slots)
+    try:
+        result = stepper(C)
+    finally:
+        stepper.close()
+
+    expected = update_concentration_crank_nicolson_vectorized(C, None, None, None, None, None, None, 1.0, S_c, *C.shape, coefficients=coefficients)
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-12)
+    assert busy.value == 1
+
+
+def run_stepper_until_killed(queue):
+    C, coefficients, S_c = stepper_fields()
+    stepper = ParallelStencilStepper(coefficients, S_c, 1.0, 2)
+    stepper(C)
+    queue.put(([process.pid for process in stepper._processes], [shm.name for shm in stepper._shared.values()]))
+    time.sleep(60)
+
+
+@pytest.mark.skipif(not os.path.isdir("/dev/shm"), reason="needs /proc and /dev/shm")
+def test_strips_exit_and_release_shared_memory_when_parent_is_killed():
+    queue = mp.Queue()
+    parent = mp.Process(target=run_stepper_until_killed, args=(queue,))
+    parent.start()
+    strip_pids, shm_names = queue.get(timeout=30)
+
+    os.kill(parent.pid, signal.SIGKILL)
+    parent.join()
+
+    deadline = time.time() + 10
+    while time.time() < deadline and (any(map(is_running, strip_pids)) or any(os.path.exists(f"/dev/shm/{name}") for name in shm_names)):
+        time.sleep(0.1)
+
+    assert not any(map(is_running, strip_pids))
+    assert not any(os.path.exists(f"/dev/shm/{name}") for name in shm_names)
@@ -0,0 +1,85 @@
+import io
+import os
+
+import numpy as np
+import pytest
+
+from conftest import POLLUTANTS, drone_flight_request
+from models.euler_modified_multibox_model.field_cache import FieldCache
+from models.euler_modified_multibox_model.simulation import prepare_fields
+from models.euler_modified_multibox_model.simulation_types.input_type import convert_to_input_type
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return FieldCache(str(tmp_path), 64 * 1024**2)
+
+
+@pytest.fixture(scope="module")
+def prepared():
+    return prepare_fields(convert_to_input_type(drone_flight_request()), POLLUTANTS, grid_density="medium", margin_boxes=1)
+
+
+def test_store_and_load_round_trip(cache, prepared):
+    cache.store("entry", prepared)
+    loaded = cache.load("entry")
+
+    assert loaded["grid_shape"] == tuple(prepared["grid_shape"])
+    for name in ("temperature", "pressure", "u", "v"):
+        np.testing.assert_array_equal(loaded[name], prepared[name])
+    for group in ("pollutants", "diffusion"):
+        for pollutant in POLLUTANTS:
+            np.testing.assert_array_equal(loaded[group][pollutant], prepared[group][pollutant])
+
+
+def test_missing_entry_is_miss(cache):
+    assert cache.load("missing") is None
+
+
+def truncated(data):
+    return data[:len(data) // 2]
+
+
+def garbage(data):
+    return b"not an npz file" * 10
+
+
+def without_grid(data):
+    buffer = io.BytesIO()
+    np.savez(buffer, u=np.zeros(3))
+    return buffer.getvalue()
+
+
+def invalid_grid(data):
+    buffer = io.BytesIO()
+    np.savez(buffer, grid=np.array("{not json"))
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("corrupt", [truncated, garbage, without_grid, invalid_grid])
+def test_unreadable_entry_is_removed_and_missed(cache, prepared, corrupt):
+    cache.store("entry", prepared)
+    path = cache._path("entry")
+    with open(path, "rb") as file:
+        data = file.read()
+    with open(path, "wb") as file:
+        file.write(corrupt(data))
+
+    assert cache.load("entry") is None
+    assert not os.path.exists(path)
+
+    cache.store("entry", prepared)
+    assert cache.load("entry") is not None
+
+
+def test_cache_is_disabled_unless_configured(tmp_path, monkeypatch):
+    monkeypatch.delenv("FIELD_CACHE_MAX_MB", raising=False)
+    assert FieldCache.from_env() is None
+
+    monkeypatch.setenv("FIELD_CACHE_MAX_MB", "0")
+    assert FieldCache.from_env() is None
+
+    monkeypatch.setenv("FIELD_CACHE_MAX_MB", "16")
+    monkeypatch.setenv("FIELD_CACHE_DIR", str(tmp_path))
+    cache = FieldCache.from_env()
+    assert cache.directory == str(tmp_path) and cache.max_bytes == 16 * 1024**2
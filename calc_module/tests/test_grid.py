@@ -0,0 +1,144 @@
+import json
+
+import numpy as np
+import pytest
+
+from conftest import POLLUTANTS, drone_flight_request
+from models.euler_modified_multibox_model.grid import UniformGrid, bin_measurements, create_uniform_boxes, grid_indices, measurement_arrays
+from models.euler_modified_multibox_model.simulation_types.input_type import convert_to_input_type
+from models.euler_modified_multibox_model.simulation_types.output_type import convert_to_output_type
+
+FIELDS = ["temperature", "pressure", "u", "v"] + POLLUTANTS
+
+
+def per_box_samples(grid, latitudes, longitudes, measurements):
+    """
+    Samples of every box assigned one by one as in the per-box loop from before vectorization,
+    with its running (old + new) / 2 average.
+    """
+    samples = {}
+    running_average = {}
+    for index, (lat, lon) in enumerate(zip(latitudes, longitudes)):
+        lat_idx = int((lat - grid.lat_min) / grid.box_size_lat)
+        lon_idx = int((lon - grid.lon_min) / grid.box_size_lon)
+        if not (0 <= lat_idx < grid.shape[0] and 0 <= lon_idx < grid.shape[1]):
+            continue
+
+        box = lat_idx * grid.shape[1] + lon_idx
+        values = {name: values[index] for name, values in measurements.items()}
+        samples.setdefault(box, []).append(values)
+        if box not in running_average:
+            running_average[box] = values
+        else:
+            running_average[box] = {name: (running_average[box][name] + value) / 2 for name, value in values.items()}
+    return samples, running_average
+
+
+@pytest.fixture(scope="module")
+def flight_with_repeats():
+    data = convert_to_input_type(drone_flight_request(n_measurements=40, seed=3))
+    grid = create_uniform_boxes(data, POLLUTANTS)[0]
+
+    # Powtórzone punkty (kilka próbek w pudełku) i punkty na wewnętrznych krawędziach pudełek
+    repeats = [dict(data[index], temperature=data[index]["temperature"] + shift) for index, shift in [(5, 1.0), (17, 1.0), (17, -2.0), (17, 0.5)]]
+    edges = [dict(data[k], latitude=grid.lat_min + i * grid.box_size_lat, longitude=grid.lon_min + j * grid.box_size_lon)
+             for k, (i, j) in enumerate([(3, 4), (5, 6), (6, 9), (8, 2)])]
+    return data + repeats + edges
+
+
+def test_binning_matches_per_box_loop(flight_with_repeats):
+    data = flight_with_repeats
+    grid, temperature, pressure, u, v, pollutant_values, grid_shape = create_uniform_boxes(data, POLLUTANTS)
+    binned = {"temperature": temperature, "pressure": pressure, "u": u, "v": v, **pollutant_values}
+
+    latitudes, longitudes, measurements = measurement_arrays(data, POLLUTANTS)
+    samples, running_average = per_box_samples(grid, latitudes, longitudes, measurements)
+    assert max(len(box_samples) for box_samples in samples.values()) >= 3
+
+    empty = np.setdiff1d(np.arange(len(grid)), list(samples))
+    for name in FIELDS:
+        assert binned[name].dtype == np.float64
+        assert np.isnan(binned[name][empty]).all()
+
+        for box, box_samples in samples.items():
+            values = [sample[name] for sample in box_samples]
+            if name in ("u", "v") and abs(np.mean(values)) < 1e-10:
+                assert binned[name][box] == 0
+            elif len(values) <= 2:
+                # Jedna lub dwie próbki - średnia biegnąca pętli jest średnią
+                assert binned[name][box] == running_average[box][name]
+            else:
+                assert binned[name][box] == pytest.approx(np.mean(values), rel=1e-14)
+
+
+
+def test_points_exactly_on_box_edges():
+    # Rozmiary pudełek dokładnie reprezentowalne - punkty leżą dokładnie na krawędziach
+    grid = UniformGrid(52.0, 21.0, 0.125, 0.25, (4, 5))
+    latitudes = np.array([52.0, 52.125, 52.25, 52.375, 52.5, 52.0625, 52.25, 51.875])
+    longitudes = np.array([21.0, 21.25, 21.5, 22.25, 21.25, 21.125, 21.5, 21.0])
+    values = np.array([1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 9.0, 7.0])
+
+    cell_indices, inside = grid_indices(grid, latitudes, longitudes)
+    binned = bin_measurements(cell_indices, values[inside], grid.shape).flatten()
+    samples, _ = per_box_samples(grid, latitudes, longitudes, {"value": values})
+
+    # Krawędź należy do pudełka powyżej, punkty na północnej / wschodniej granicy siatki są poza nią
+    assert sorted(samples) == [0, 1 * 5 + 1, 2 * 5 + 2]
+    assert np.flatnonzero(~np.isnan(binned)).tolist() == sorted(samples)
+    for box, box_samples in samples.items():
+        assert binned[box] == np.mean([sample["value"] for sample in box_samples])
+    assert binned[2 * 5 + 2] == 6.0
+
+
+def per_box_tuples(lat_min, lon_min, box_size_lat, box_size_lon, grid_shape):
+    """
+    List of (lat_min, lat_max, lon_min, lon_max) tuples built by create_uniform_boxes before UniformGrid.
+    """
+    boxes = []
+    for i in range(grid_shape[0]):
+        for j in range(grid_shape[1]):
+            boxes.append((lat_min + i * box_size_lat, lat_min + (i + 1) * box_size_lat,
+                          lon_min + j * box_size_lon, lon_min + (j + 1) * box_size_lon))
+    return boxes
+
+
+def expand_descriptor(descriptor):
+    """
+    The same arithmetic as expandGridBoxes of the backend (simulation.service.ts) on a descriptor read from JSON.
+    """
+    origin, cell_size = descriptor["origin"], descriptor["cellSize"]
+    return [{"lat_min": origin["lat"] + i * cell_size["lat"], "lat_max": origin["lat"] + (i + 1) * cell_size["lat"],
+             "lon_min": origin["lon"] + j * cell_size["lon"], "lon_max": origin["lon"] + (j + 1) * cell_size["lon"]}
+            for i in range(descriptor["shape"][0]) for j in range(descriptor["shape"][1])]
+
+
+@pytest.mark.parametrize("grid_density", ["sparse", "medium", "dense"])
+def test_uniform_grid_reproduces_box_list(grid_density):
+    data = convert_to_input_type(drone_flight_request(n_measurements=40, seed=3))
+    grid, *fields, grid_shape = create_uniform_boxes(data, POLLUTANTS, grid_density=grid_density)
+    expected = per_box_tuples(grid.lat_min, grid.lon_min, grid.box_size_lat, grid.box_size_lon, grid_shape)
+    expected_dicts = [dict(zip(("lat_min", "lat_max", "lon_min", "lon_max"), box)) for box in expected]
+
+    assert len(grid) == len(expected)
+    assert list(grid) == expected
+    assert [grid[index] for index in range(-len(grid), len(grid))] == expected + expected
+    assert list(zip(*(values.tolist() for values in grid.bounds()))) == expected
+    assert grid.to_boxes() == expected_dicts
+
+    temperature, pressure, u, v = fields[:4]
+    output = convert_to_output_type({}, {}, grid, temperature, pressure, u, v, legacy_grid=True)
+    assert output["grid"]["boxes"] == expected_dicts
+    assert "boxes" not in convert_to_output_type({}, {}, grid, temperature, pressure, u, v)["grid"]
+
+    # Deskryptor przesyłany w JSON i rozwijany przez backend daje te same pudełka
+    descriptor = json.loads(json.dumps(convert_to_output_type({}, {}, grid, temperature, pressure, u, v)["grid"]))
+    assert expand_descriptor(descriptor) == expected_dicts
+
+
+def test_descriptor_round_trip():
+    grid = UniformGrid(52.21345678901234, 20.98765432109876, 0.0012345678901234, 0.0023456789012345, (17, 23))
+    restored = UniformGrid.from_descriptor(json.loads(json.dumps(grid.to_descriptor())))
+
+    assert all(getattr(restored, name) == getattr(grid, name) for name in UniformGrid.__slots__)
+    assert list(restored) == list(grid)
@@ -0,0 +1,172 @@
+import numpy as np
+import pytest
+
+from models.euler_modified_multibox_model import interpolation
+from conftest import POLLUTANTS, drone_flight_request
+from models.euler_modified_multibox_model.grid import UniformGrid
+from models.euler_modified_multibox_model.interpolation import kdtree_interpolation, recursive_interpolation_until_filled, weighted_interpolation
+from models.euler_modified_multibox_model.simulation import prepare_fields
+from models.euler_modified_multibox_model.simulation_types.input_type import convert_to_input_type
+
+GRID_SHAPE = (13, 17)
+
+
+def loop_weighted_interpolation(values, grid_shape, distance):
+    """
+    Per-box weighted interpolation from before vectorization (reference implementation).
+    """
+    interpolated_values = np.array(values, dtype=float)
+    num_rows, num_cols = grid_shape
+    effective_distance = max(1, min(distance, max(num_rows, num_cols)))
+
+    updated_boxes = {}
+    for i in range(num_rows):
+        for j in range(num_cols):
+            if np.isnan(interpolated_values[i * num_cols + j]):
+                continue
+            for ni in range(max(i - effective_distance, 0), min(i + effective_distance + 1, num_rows)):
+                for nj in range(max(j - effective_distance, 0), min(j + effective_distance + 1, num_cols)):
+                    if (ni, nj) == (i, j) or not np.isnan(interpolated_values[ni * num_cols + nj]):
+                        continue
+                    weight = 1 / (1 + max(abs(i - ni), abs(j - nj))**2)
+                    total_value, total_weight = updated_boxes.get((ni, nj), (0.0, 0.0))
+                    updated_boxes[(ni, nj)] = (total_value + interpolated_values[i * num_cols + j] * weight, total_weight + weight)
+
+    for (ni, nj), (total_value, total_weight) in updated_boxes.items():
+        interpolated_values[ni * num_cols + nj] = total_value / total_weight
+    return interpolated_values
+
+
+def loop_interpolation_until_filled(values, grid_shape, initial_distance=1, increment=1):
+    values = np.array(values, dtype=float)
+    distance = max(1, initial_distance)
+    while np.isnan(values).any():
+        values = loop_weighted_interpolation(values, grid_shape, distance)
+        distance += increment
+    return values
+
+
+def sparse_field(rng, known):
+    values = np.full(int(np.prod(GRID_SHAPE)), np.nan)
+    values[known] = rng.uniform(10, 100, known.sum())
+    return values
+
+
+def interpolate(fields, **parameters):
+    temperature, pressure, u, v, pollutants = (fields[name] for name in ("temperature", "pressure", "u", "v", "pollutants"))
+    temp_values, press_values, u_values, v_values, pollutant_values = recursive_interpolation_until_filled(None, temperature, pressure, u, v, dict(pollutants),
+                                                                                                          GRID_SHAPE, **parameters)
+    return {"temperature": temp_values, "pressure": press_values, "u": u_values, "v": v_values, **pollutant_values}
+
+
+@pytest.mark.parametrize("initial_distance, increment", [(1, 1), (2, 3)])
+def test_interpolation_matches_loop(initial_distance, increment):
+    rng = np.random.default_rng(3)
+    known = rng.random(int(np.prod(GRID_SHAPE))) < 0.08
+    fields = {name: sparse_field(rng, known) for name in ("temperature", "pressure", "u", "v")}
+    fields["pollutants"] = {pollutant: sparse_field(rng, known) for pollutant in ("CO", "O3")}
+
+    expected = {name: loop_interpolation_until_filled(values, GRID_SHAPE, initial_distance, increment)
+                for name, values in {**fields, **fields["pollutants"]}.items() if name != "pollutants"}
+    result = interpolate(fields, initial_distance=initial_distance, increment=increment)
+
+    for name, values in expected.items():
+        assert not np.isnan(result[name]).any()
+        np.testing.assert_allclose(result[name], values, rtol=1e-12)
+        np.testing.assert_array_equal(result[name][known], fields.get(name, fields["pollutants"].get(name))[known])
+
+
+def test_single_field_interpolation_matches_loop():
+    rng = np.random.default_rng(5)
+    values = sparse_field(rng, rng.random(int(np.prod(GRID_SHAPE))) < 0.1)
+
+    for distance in (1, 2, 4, 40):
+        np.testing.assert_allclose(weighted_interpolation(values, GRID_SHAPE, distance), loop_weighted_interpolation(values, GRID_SHAPE, distance),
+                                   rtol=1e-12)
+
+
+def test_field_without_measurements_is_rejected():
+    rng = np.random.default_rng(7)
+    known = rng.random(int(np.prod(GRID_SHAPE))) < 0.1
+    fields = {name: sparse_field(rng, known) for name in ("temperature", "pressure", "u", "v")}
+    fields["pollutants"] = {"CO": sparse_field(rng, known), "O3": np.full(int(np.prod(GRID_SHAPE)), np.nan)}
+
+    with pytest.raises(ValueError, match="O3"):
+        interpolate(fields)
+
+
+def test_grouped_interpolation_matches_separate_fields(monkeypatch):
+    rng = np.random.default_rng(11)
+    size = int(np.prod(GRID_SHAPE))
+    shared = rng.random(size) < 0.08
+    fields = {name: sparse_field(rng, shared) for name in ("temperature", "pressure", "u", "v")}
+    # CO z tą samą maską co pola meteorologiczne, O3 i NO2 z własnymi (np. brakujące pomiary)
+    fields["pollutants"] = {"CO": sparse_field(rng, shared), "O3": sparse_field(rng, shared & (rng.random(size) < 0.6)),
+                            "NO2": sparse_field(rng, rng.random(size) < 0.15)}
+
+    stacked_calls = []
+    original = interpolation.weighted_interpolation_stacked
+    monkeypatch.setattr(interpolation, "weighted_interpolation_stacked",
+                        lambda stacked_values, *args: stacked_calls.append(len(stacked_values)) or original(stacked_values, *args))
+
+    result = interpolate(fields, initial_distance=1, increment=2)
+
+    for name, values in {**fields, **fields["pollutants"]}.items():
+        if name == "pollutants":
+            continue
+        np.testing.assert_allclose(result[name], loop_interpolation_until_filled(values, GRID_SHAPE, 1, 2), rtol=1e-12)
+
+    # Pola ze wspólną maską (temperature, pressure, u, v, CO) interpolowane razem, O3 i NO2 osobno
+    assert sorted(set(stacked_calls)) == [1, 5]
+
+
+@pytest.fixture
+def scattered_points():
+    rng = np.random.default_rng(13)
+    grid = UniformGrid(52.2, 21.0, 0.002, 0.003, GRID_SHAPE)
+    latitudes = rng.uniform(52.2, 52.2 + 0.002 * GRID_SHAPE[0], 30)
+    longitudes = rng.uniform(21.0, 21.0 + 0.003 * GRID_SHAPE[1], 30)
+    measurements = {"CO": rng.uniform(100, 500, 30), "O3": np.where(rng.random(30) < 0.3, np.nan, rng.uniform(20, 80, 30))}
+
+    # Pola po binowaniu: część pudełek ze zmierzoną wartością, reszta NaN
+    measured = rng.random(int(np.prod(GRID_SHAPE))) < 0.1
+    fields = {name: np.where(measured, rng.uniform(0, 1000, measured.shape), np.nan) for name in measurements}
+    return grid, latitudes, longitudes, measurements, fields, measured
+
+
+def test_kdtree_keeps_measured_boxes(scattered_points):
+    grid, latitudes, longitudes, measurements, fields, measured = scattered_points
+    filled = kdtree_interpolation(grid, latitudes, longitudes, measurements, fields, neighbors=5)
+
+    for name, values in fields.items():
+        assert not np.isnan(filled[name]).any()
+        np.testing.assert_array_equal(filled[name][measured], values[measured])
+
+
+@pytest.mark.parametrize("neighbors, power", [(1, 2), (5, 2), (8, 1)])
+def test_kdtree_matches_hand_computed_idw(scattered_points, neighbors, power):
+    grid, latitudes, longitudes, measurements, fields, measured = scattered_points
+    filled = kdtree_interpolation(grid, latitudes, longitudes, measurements, fields, neighbors=neighbors, power=power)
+
+    center_lat, center_lon = grid.centers()
+    cos_reference = np.cos(np.radians(np.mean(center_lat)))
+    for name, values in measurements.items():
+        valid = ~np.isnan(values)
+        for box in np.flatnonzero(~measured)[::7]:
+            distances = np.hypot((longitudes[valid] - center_lon[box]) * 111320 * cos_reference, (latitudes[valid] - center_lat[box]) * 111320)
+            nearest = np.argsort(distances)[:neighbors]
+            weights = 1 / distances[nearest]**power
+            assert filled[name][box] == pytest.approx(np.sum(weights * values[valid][nearest]) / np.sum(weights), rel=1e-10)
+
+
+def test_kdtree_field_without_measurements_is_rejected(scattered_points):
+    grid, latitudes, longitudes, measurements, fields, measured = scattered_points
+    measurements = dict(measurements, O3=np.full(len(latitudes), np.nan))
+
+    with pytest.raises(ValueError, match="O3"):
+        kdtree_interpolation(grid, latitudes, longitudes, measurements, fields)
+
+
+def test_invalid_interpolation_is_rejected():
+    with pytest.raises(ValueError, match="Available interpolation methods"):
+        prepare_fields(convert_to_input_type(drone_flight_request()), POLLUTANTS, interpolation="nearest")
@@ -0,0 +1,455 @@
+import asyncio
+import json
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from multiprocessing import Pipe
+
+import pytest
+
+from conftest import POLLUTANTS, drone_flight_request
+import main
+from main import REPLY_SHM_PREFIX, RESULT_SHM_THRESHOLD, SHM_DIRECTORY, RabbitMQHandler, SimulationPool, release_worker_replies, share_reply, take_reply
+from models.euler_modified_multibox_model.snapshots import snapshot_count
+
+
+class StubExchange:
+    def __init__(self, events):
+        self.events = events
+
+    async def publish(self, message, routing_key):
+        self.events.append(("publish", message, routing_key))
+
+
+class StubChannel:
+    def __init__(self, events):
+        self.default_exchange = StubExchange(events)
+        self.is_closed = False
+
+
+class StubMessage:
+    """
+    Incoming RabbitMQ message recording ack / nack in the shared list of events.
+    """
+
+    def __init__(self, data, events, correlation_id="task-1", redelivered=False):
+        self.body = json.dumps(data).encode()
+        self.correlation_id = correlation_id
+        self.reply_to = "reply-queue"
+        self.headers = {}
+        self.redelivered = redelivered
+        self.events = events
+
+    async def ack(self):
+        self.events.append(("ack", self.correlation_id))
+
+    async def nack(self, requeue=True):
+        self.events.append(("nack", self.correlation_id, requeue))
+
+
+@pytest.fixture
+def events():
+    return []
+
+
+@pytest.fixture
+def handler(events, monkeypatch):
+    # Workery bez cache pól (FieldCache.from_env)
+    monkeypatch.setenv("FIELD_CACHE_MAX_MB", "0")
+    handler = RabbitMQHandler("amqp://localhost", "simulation_request_queue")
+    handler.simulation_pool = SimulationPool(max_workers=1)
+    handler._channel = StubChannel(events)
+    return handler
+
+
+async def run_with_pool(handler, messages, settled, timeout=60):
+    """
+    Runs the worker pool and result delivery of handler until `settled` messages are acked or nacked.
+    """
+    handler.simulation_pool.start()
+    reader = asyncio.create_task(handler.check_results())
+    try:
+        for message in messages:
+            await handler.process_message(message)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while sum(event[0] in ("ack", "nack") for event in messages[0].events) < settled:
+            assert loop.time() < deadline, "messages were not settled in time"
+            await asyncio.sleep(0.05)
+    finally:
+        handler.stop_result_reader()
+        await asyncio.wait_for(reader, timeout=5)
+        handler.simulation_pool.cleanup()
+
+
+def published(events):
+    return [event[1] for event in events if event[0] == "publish"]
+
+
+def test_streamed_snapshots_are_numbered_and_end_with_result(handler, events):
+    num_steps, snap_interval = 20, 5
+    request = drone_flight_request(numSteps=num_steps, snapInterval=snap_interval, streamSnapshots=True)
+    asyncio.run(run_with_pool(handler, [StubMessage(request, events)], settled=1))
+
+    messages = published(events)
+    kinds = [message.headers["x-message-type"] for message in messages]
+    sequence = [message.headers["x-sequence"] for message in messages]
+
+    # Numery kolejne od 0, wynik końcowy po ostatnim snapshocie, potwierdzenie po wyniku
+    assert sequence == list(range(len(messages)))
+    assert kinds == ["snapshot"] * (len(messages) - 1) + ["result"]
+    assert len(messages) - 1 == len(POLLUTANTS) * snapshot_count(num_steps, snap_interval)
+    assert [event[0] for event in events] == ["publish"] * len(messages) + ["ack"]
+    assert all(message.correlation_id == "task-1" for message in messages)
+
+    snapshots = [json.loads(message.body)["snapshot"] for message in messages[:-1]]
+    for pollutant in POLLUTANTS:
+        assert [snapshot["index"] for snapshot in snapshots if snapshot["pollutant"] == pollutant] == list(range(snapshot_count(num_steps, snap_interval)))
+    assert json.loads(messages[-1].body)["status"] == "completed"
+    # Numeracja strumienia jest zwalniana po wyniku końcowym
+    assert handler._sequence_numbers == {}
+
+
+def send_results(connection, count):
+    for index in range(count):
+        connection.send({'type': 'result', 'index': index})
+
+
+def test_results_are_received_in_order_and_exit_after_them():
+    pool = SimulationPool(max_workers=1)
+    reader, writer = Pipe(duplex=False)
+    sender = mp.Process(target=send_results, args=(writer, 3))
+    sender.start()
+    writer.close()
+    pool.result_connections[reader] = "worker"
+
+    received = []
+    while not received or received[-1]['type'] != 'exit':
+        received += pool.receive_results()
+    sender.join()
+
+    assert [result['index'] for result in received[:-1]] == [0, 1, 2]
+    assert received[-1] == {'type': 'exit', 'worker': "worker"}
+    assert pool.result_connections == {}
+
+
+def test_stop_receiving_wakes_blocked_reader():
+    pool = SimulationPool(max_workers=1)
+    received = []
+    reader = threading.Thread(target=lambda: received.append(pool.receive_results()))
+    reader.start()
+    time.sleep(0.1)
+    assert reader.is_alive()
+
+    pool.stop_receiving()
+    reader.join(timeout=2)
+    assert not reader.is_alive() and received == [None]
+
+
+class ScriptedPool:
+    """
+    Pool stub returning prepared batches of results, a batch is returned only after its gate is set.
+    """
+
+    def __init__(self, batches):
+        self.batches = batches
+
+    def receive_results(self):
+        if not self.batches:
+            return None
+        gate, batch = self.batches.pop(0)
+        if gate is not None:
+            gate.wait(timeout=5)
+        return batch
+
+    def stop_receiving(self):
+        pass
+
+
+def test_results_are_published_as_soon_as_they_arrive(handler, events, monkeypatch):
+    first_published = threading.Event()
+    result = {'correlation_id': "task-1", 'reply_to': "reply-queue", 'reply_format': 'json', 'type': 'result', 'task_id': 0,
+              'status': 'completed', 'body': b'{"status": "completed"}'}
+    handler.simulation_pool = ScriptedPool([(None, [result]), (first_published, [{'type': 'exit', 'worker': "worker"}])])
+
+    exits = []
+
+    async def handle_worker_exit(worker):
+        exits.append((worker, len(published(events))))
+    monkeypatch.setattr(handler, "handle_worker_exit", handle_worker_exit)
+
+    async def run():
+        reader = asyncio.create_task(handler.check_results())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + 5
+        # Drugi pakiet (koniec workera) powstaje dopiero po opublikowaniu pierwszego wyniku
+        while not published(events):
+            assert loop.time() < deadline
+            await asyncio.sleep(0.01)
+        first_published.set()
+        await asyncio.wait_for(reader, timeout=5)
+
+    asyncio.run(run())
+    assert [message.body for message in published(events)] == [result['body']]
+    assert exits == [("worker", 1)]
+
+
+class StubPool:
+    """
+    Pool without worker processes: tasks stay in task_queue, replace_worker returns the task of the exited worker.
+    """
+
+    def __init__(self, queue_size=1):
+        self.max_workers = queue_size
+        self.task_queue = queue.Queue(maxsize=queue_size)
+        self.replaced = []
+
+    def replace_worker(self, worker):
+        self.replaced.append(worker)
+        return worker.task_id
+
+
+class StubWorker:
+    def __init__(self, task_id, deadline_exceeded=False):
+        self.task_id = task_id
+        self.deadline_exceeded = deadline_exceeded
+
+    def join(self):
+        pass
+
+
+@pytest.fixture
+def stub_handler(handler):
+    handler.simulation_pool = StubPool()
+    return handler
+
+
+def accepted_task(handler, message):
+    asyncio.run(handler.process_message(message))
+    return handler.simulation_pool.task_queue.get_nowait()
+
+
+def test_message_is_acked_after_result_is_published(stub_handler, events):
+    task = accepted_task(stub_handler, StubMessage(drone_flight_request(), events))
+    assert events == []
+
+    asyncio.run(stub_handler.publish_result({
+        'correlation_id': task.correlation_id, 'reply_to': task.reply_to, 'reply_format': 'json', 'type': 'result',
+        'task_id': task.task_id, 'streamed': False, 'status': 'completed', 'body': b'{"status": "completed"}'
+    }))
+
+    assert [event[0] for event in events] == ["publish", "ack"]
+    assert stub_handler._pending_messages == {} and stub_handler._pending_tasks == {}
+
+
+def test_task_of_dead_worker_is_requeued(stub_handler, events):
+    task = accepted_task(stub_handler, StubMessage(drone_flight_request(streamSnapshots=True), events))
+    stub_handler._sequence_numbers[task.correlation_id] = 3
+
+    asyncio.run(stub_handler.handle_worker_exit(StubWorker(task.task_id)))
+
+    assert events == [("nack", task.correlation_id, True)]
+    # Ponowione zadanie numeruje strumień od początku
+    assert task.correlation_id not in stub_handler._sequence_numbers
+    assert stub_handler._pending_messages == {}
+
+
+def test_redelivered_task_of_dead_worker_fails(stub_handler, events):
+    task = accepted_task(stub_handler, StubMessage(drone_flight_request(), events, redelivered=True))
+
+    asyncio.run(stub_handler.handle_worker_exit(StubWorker(task.task_id)))
+
+    assert [event[0] for event in events] == ["publish", "ack"]
+    assert json.loads(events[0][1].body) == {"status": "failed", "result": None}
+    assert events[0][2] == task.reply_to
+
+
+def test_exit_of_idle_worker_settles_nothing(stub_handler, events):
+    accepted_task(stub_handler, StubMessage(drone_flight_request(), events))
+
+    asyncio.run(stub_handler.handle_worker_exit(StubWorker(-1)))
+
+    assert events == [] and len(stub_handler._pending_messages) == 1
+
+
+def test_full_queue_retries_with_backoff_instead_of_requeue(stub_handler, events, monkeypatch):
+    stub_handler.ENQUEUE_RETRY_DELAY = 0.01
+    stub_handler.ENQUEUE_MAX_RETRY_DELAY = 0.04
+    stub_handler.simulation_pool.task_queue.put_nowait("queued task")
+    delays = []
+    wait_for = asyncio.wait_for
+    monkeypatch.setattr(asyncio, "wait_for", lambda awaitable, timeout: delays.append(timeout) or wait_for(awaitable, timeout))
+
+    async def run():
+        processing = asyncio.create_task(stub_handler.process_message(StubMessage(drone_flight_request(), events)))
+        await asyncio.sleep(0.2)
+        # Wiadomość czeka niepotwierdzona, nie wraca do RabbitMQ
+        assert events == [] and not processing.done()
+        stub_handler.simulation_pool.task_queue.get_nowait()
+        await asyncio.wait_for(processing, timeout=1)
+
+    asyncio.run(run())
+    assert events == []
+    assert stub_handler.simulation_pool.task_queue.get_nowait().correlation_id == "task-1"
+    assert delays[:4] == [0.01, 0.02, 0.04, 0.04]
+
+
+def test_full_queue_returns_message_on_shutdown(stub_handler, events):
+    stub_handler.simulation_pool.task_queue.put_nowait("queued task")
+
+    async def run():
+        processing = asyncio.create_task(stub_handler.process_message(StubMessage(drone_flight_request(), events)))
+        await asyncio.sleep(0.05)
+        stub_handler._shutdown_event.set()
+        await asyncio.wait_for(processing, timeout=1)
+
+    asyncio.run(run())
+    assert events == [("nack", "task-1", True)]
+
+
+def test_overdue_task_replies_time_exceeded(stub_handler, events):
+    task = accepted_task(stub_handler, StubMessage(drone_flight_request(), events))
+
+    asyncio.run(stub_handler.handle_worker_exit(StubWorker(task.task_id, deadline_exceeded=True)))
+
+    assert [event[0] for event in events] == ["publish", "ack"]
+    assert json.loads(events[0][1].body) == {"status": "timeExceeded", "result": None}
+
+
+class DeadlineWorker:
+    """
+    Worker stub with a deadline of its current task (0 when idle), records terminate.
+    """
+
+    def __init__(self, task_id, deadline):
+        self.pid = task_id
+        self.current_task = mp.Value('q', task_id)
+        self.task_deadline = mp.Value('d', deadline)
+        self.deadline_exceeded = False
+        self.terminated = False
+
+    def is_alive(self):
+        return not self.terminated
+
+    def terminate(self):
+        self.terminated = True
+
+    def join(self, timeout=None):
+        pass
+
+
+def test_only_overdue_workers_are_terminated():
+    pool = SimulationPool(max_workers=3)
+    overdue = DeadlineWorker(7, time.time() - 1)
+    running = DeadlineWorker(8, time.time() + 60)
+    idle = DeadlineWorker(-1, 0.0)
+    pool.workers = [overdue, running, idle]
+
+    assert pool.terminate_overdue_workers() == [7]
+    assert overdue.terminated and overdue.deadline_exceeded
+    assert not running.terminated and not running.deadline_exceeded
+    assert not idle.terminated
+
+    # Po zamknięciu puli workery nie są już zatrzymywane
+    pool.shutdown_event.set()
+    running.task_deadline.value = time.time() - 1
+    assert pool.terminate_overdue_workers() == []
+
+
+def test_simulation_past_deadline_is_stopped_and_worker_replaced(handler, events, monkeypatch):
+    request = drone_flight_request(numSteps=10**6, gridDensity='dense', timeoutSeconds=1)
+
+    async def run():
+        watcher = asyncio.create_task(handler.watch_workers())
+        try:
+            await run_with_pool(handler, [StubMessage(request, events)], settled=1)
+        finally:
+            handler._shutdown_event.set()
+            await asyncio.wait_for(watcher, timeout=5)
+
+    pool = handler.simulation_pool
+    replaced = []
+    replace_worker = pool.replace_worker
+    monkeypatch.setattr(pool, "replace_worker", lambda worker: replaced.append((worker, worker.is_alive())) or replace_worker(worker))
+    asyncio.run(run())
+
+    assert [event[0] for event in events] == ["publish", "ack"]
+    assert json.loads(events[0][1].body) == {"status": "timeExceeded", "result": None}
+    assert [(worker.deadline_exceeded, alive) for worker, alive in replaced] == [(True, False)]
+    assert pool.workers[0] is not replaced[0][0]
+
+
+def reply_segments():
+    return sorted(name for name in os.listdir(SHM_DIRECTORY) if name.startswith(REPLY_SHM_PREFIX))
+
+
+def share_and_exit(connection, size):
+    connection.send(share_reply(bytes(size))['shm'])
+
+
+@pytest.mark.skipif(not os.path.isdir(SHM_DIRECTORY), reason="needs /dev/shm")
+def test_large_reply_goes_through_shared_memory():
+    small = share_reply(b"x" * (RESULT_SHM_THRESHOLD - 1))
+    assert set(small) == {'body'} and take_reply(small) == b"x" * (RESULT_SHM_THRESHOLD - 1)
+
+    body = os.urandom(RESULT_SHM_THRESHOLD + 123)
+    shared = share_reply(body)
+    assert set(shared) == {'shm', 'size'} and shared['shm'] in reply_segments()
+
+    assert take_reply(shared) == body
+    assert reply_segments() == []
+
+
+@pytest.mark.skipif(not os.path.isdir(SHM_DIRECTORY), reason="needs /dev/shm")
+def test_replies_of_dead_worker_are_released():
+    reader, writer = Pipe(duplex=False)
+    # Worker tworzy segment i kończy się, zanim ktokolwiek odbierze odpowiedź
+    worker = mp.Process(target=share_and_exit, args=(writer, RESULT_SHM_THRESHOLD))
+    worker.start()
+    name = reader.recv()
+    worker.join()
+    other = share_reply(bytes(RESULT_SHM_THRESHOLD))
+    try:
+        assert reply_segments() == sorted([name, other['shm']])
+
+        release_worker_replies(worker.pid)
+        assert reply_segments() == [other['shm']]
+    finally:
+        take_reply(other)
+    assert reply_segments() == []
+
+
+@pytest.mark.skipif(not os.path.isdir(SHM_DIRECTORY), reason="needs /dev/shm")
+def test_simulation_reply_through_shared_memory_leaves_no_segments(handler, events, monkeypatch):
+    # Każda odpowiedź (snapshoty i wynik) przez pamięć współdzieloną, workery dziedziczą próg po fork
+    monkeypatch.setattr(main, "RESULT_SHM_THRESHOLD", 0)
+    taken = []
+    monkeypatch.setattr(main, "take_reply", lambda result: taken.append(result.get('shm')) or take_reply(result))
+
+    request = drone_flight_request(streamSnapshots=True)
+    asyncio.run(run_with_pool(handler, [StubMessage(request, events)], settled=1))
+
+    assert len(taken) == len(published(events)) and all(taken)
+    assert json.loads(published(events)[-1].body)["status"] == "completed"
+    assert reply_segments() == []
+
+
+def test_max_boxes_is_limited(monkeypatch):
+    monkeypatch.setattr(main, "SIMULATION_MAX_BOXES", 2000)
+
+    assert main.limit_max_boxes(None, "vectorized") == 2000
+    assert main.limit_max_boxes(1500, "parallel") == 1500
+    assert main.limit_max_boxes(2000, "vectorized") == 2000
+    for requested in (2001, 0, -5, 10.5, "100", True):
+        with pytest.raises(ValueError, match="maxBoxes"):
+            main.limit_max_boxes(requested, "vectorized")
+
+
+def test_request_above_max_boxes_fails_before_simulation(monkeypatch):
+    monkeypatch.setattr(main, "SIMULATION_MAX_BOXES", 2000)
+    monkeypatch.setattr(main, "simulate_pollution_spread", lambda *args, **kwargs: pytest.fail("simulation was started"))
+    worker = main.SimulationWorker(mp.Queue(), None, mp.Event())
+
+    assert worker.run_simulation(drone_flight_request(maxBoxes=10**9)) == (None, "failed")
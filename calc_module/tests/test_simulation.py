@@ -0,0 +1,175 @@
+import numpy as np
+import pytest
+
+from conftest import POLLUTANTS, drone_flight_request
+from models.euler_modified_multibox_model import simulation
+from models.euler_modified_multibox_model.diffusion_advection import calculate_stable_dt
+from models.euler_modified_multibox_model.grid import QuadtreeGrid
+from models.euler_modified_multibox_model.simulation import convert_geo_to_meters, prepare_fields, simulate_pollutants_batched, simulate_pollution_spread
+from models.euler_modified_multibox_model.simulation_types.input_type import convert_to_input_type
+from models.euler_modified_multibox_model.simulation_types.output_type import convert_to_output_type
+from models.euler_modified_multibox_model.snapshots import snapshot_count
+
+DECAY_RATES = {"CO": 0.01, "O3": 0.5, "NO2": 2.0, "SO2": 0.1}
+
+
+@pytest.fixture(scope="module")
+def flight_data():
+    return convert_to_input_type(drone_flight_request())
+
+
+@pytest.fixture(scope="module")
+def prepared(flight_data):
+    return prepare_fields(flight_data, POLLUTANTS)
+
+
+class PreparedFields:
+    """
+    Field cache returning given prepared fields, lets tests change fields (e.g. diffusion coefficients) of a real flight.
+    """
+
+    def __init__(self, prepared):
+        self.prepared = prepared
+
+    def key(self, data, pollutants, **parameters):
+        return "prepared"
+
+    def load(self, key):
+        return self.prepared
+
+    def store(self, key, prepared):
+        pass
+
+
+def per_pollutant_diffusion(prepared):
+    # Różne K dla każdego zanieczyszczenia (empiryczne K zależy tylko od wiatru, więc jest wspólne)
+    scales = {"CO": 1.0, "O3": 0.5, "NO2": 2.0, "SO2": 1.5}
+    return dict(prepared, diffusion={pollutant: K * scales[pollutant] for pollutant, K in prepared["diffusion"].items()})
+
+
+def simulate(data, prepared, **parameters):
+    result = simulate_pollution_spread(data, parameters.pop("num_steps", 30), POLLUTANTS, field_cache=PreparedFields(prepared), **parameters)
+    assert result is not None
+    return result
+
+
+@pytest.mark.parametrize("diffusion", ["shared", "per_pollutant"])
+@pytest.mark.parametrize("solver, atol", [("fixed_point", 1e-4), ("implicit", 1e-9), ("adi", 1e-9)])
+def test_batched_matches_per_pollutant(flight_data, prepared, solver, atol, diffusion):
+    if diffusion == "per_pollutant":
+        prepared = per_pollutant_diffusion(prepared)
+
+    sequential = simulate(flight_data, prepared, solver=solver, decay_rate=DECAY_RATES)
+    batched = simulate(flight_data, prepared, solver=solver, decay_rate=DECAY_RATES, batch_pollutants=True)
+
+    for pollutant in POLLUTANTS:
+        # Punkt stały sprawdza zbieżność na całym batchu, wyniki różnią się w granicach tolerancji iteracji
+        np.testing.assert_allclose(batched[0][pollutant], sequential[0][pollutant], rtol=0, atol=atol)
+        np.testing.assert_allclose(np.asarray(batched[1][pollutant]), np.asarray(sequential[1][pollutant]), rtol=0, atol=atol)
+
+
+def test_batched_loop_engine_is_rejected(prepared):
+    with pytest.raises(ValueError, match="loop"):
+        simulate_pollutants_batched(prepared["pollutants"], prepared["pollutants"], prepared["grid_shape"], POLLUTANTS, prepared["temperature"],
+                                    prepared["pressure"], prepared["u"], prepared["v"], 100.0, 100.0, 1, 10, engine="loop")
+
+
+@pytest.mark.parametrize("batch_pollutants", [False, True])
+def test_adi_steps_with_advection_limit(flight_data, prepared, monkeypatch, batch_pollutants):
+    step_times = []
+    create_time_stepper = simulation.create_time_stepper
+    monkeypatch.setattr(simulation, "create_time_stepper", lambda *args, **kwargs: step_times.append(args[8]) or create_time_stepper(*args, **kwargs))
+
+    final_concentration = simulate(flight_data, prepared, solver="adi", batch_pollutants=batch_pollutants)[0]
+
+    shape = prepared["grid_shape"]
+    dx, dy = (np.mean(sizes) for sizes in convert_geo_to_meters(prepared["grid"]))
+    K = prepared["diffusion"]["CO"]
+    u, v = prepared["u"].reshape(shape), prepared["v"].reshape(shape)
+    advection_limit = calculate_stable_dt(u, v, K, K, dx, dy, include_diffusion=False)
+
+    assert advection_limit > 1
+    assert step_times and all(dt == pytest.approx(advection_limit) for dt in step_times)
+    assert all(np.all(np.isfinite(values)) for values in final_concentration.values())
+
+
+@pytest.mark.parametrize("interpolation", ["grid", "kdtree"])
+def test_pollutant_without_measurements_is_rejected(interpolation):
+    request = drone_flight_request()
+    for measurement in request['droneFlight']['measurements']:
+        measurement['pollutionMeasurements'] = [pollution for pollution in measurement['pollutionMeasurements'] if pollution['type'] != 'O3']
+
+    with pytest.raises(ValueError, match="O3"):
+        prepare_fields(convert_to_input_type(request), POLLUTANTS, interpolation=interpolation)
+
+
+@pytest.mark.parametrize("batch_pollutants", [False, True])
+@pytest.mark.parametrize("solver", ["fixed_point", "implicit"])
+def test_steady_state_stops_early_and_pads_snapshots(flight_data, prepared, solver, batch_pollutants):
+    num_steps, snap_interval = 200, 10
+    # Szybki rozpad (1/s) - stan ustalony po kilkunastu krokach
+    concentrations, snapshots, *_, equilibrium_steps = simulate(flight_data, prepared, num_steps=num_steps, snap_interval=snap_interval, solver=solver,
+                                                                decay_rate=3600.0, steady_state_tol=1e-3, steady_state_patience=10,
+                                                                batch_pollutants=batch_pollutants)
+
+    for pollutant in POLLUTANTS:
+        equilibrium_step = equilibrium_steps[pollutant]
+        assert equilibrium_step is not None and equilibrium_step < num_steps // 2
+
+        series = np.asarray(getattr(snapshots[pollutant], "array", snapshots[pollutant]))
+        assert len(series) == snapshot_count(num_steps, snap_interval)
+
+        # Klatki po zatrzymaniu (pierwsza wielokrotność snap_interval po ostatnim kroku) to stan końcowy
+        last_step = max(equilibrium_steps.values()) if batch_pollutants else equilibrium_step
+        padded = series[1 + last_step // snap_interval + 1:]
+        assert len(padded) > 0
+        np.testing.assert_array_equal(padded, np.broadcast_to(concentrations[pollutant], padded.shape))
+
+
+@pytest.mark.parametrize("batch_pollutants", [False, True])
+@pytest.mark.parametrize("solver, max_error", [("fixed_point", 6e-6), ("implicit", 3e-7)])
+def test_float32_state_stays_single_precision(flight_data, prepared, monkeypatch, solver, max_error, batch_pollutants):
+    step_dtypes = set()
+    create_time_stepper = simulation.create_time_stepper
+
+    def recording_time_stepper(*args, **kwargs):
+        update_concentration = create_time_stepper(*args, **kwargs)
+
+        def step(C):
+            step_dtypes.add(C.dtype)
+            return update_concentration(C)
+        return step
+
+    # Parametry lotów referencyjnych z dokumentacji precision (decay / emission rate 0.02)
+    parameters = dict(solver=solver, batch_pollutants=batch_pollutants, num_steps=300, decay_rate=0.02, emission_rate=0.02)
+    reference = simulate(flight_data, prepared, **parameters)
+    monkeypatch.setattr(simulation, "create_time_stepper", recording_time_stepper)
+    result = simulate(flight_data, prepared, precision="float32", **parameters)
+
+    assert step_dtypes == {np.dtype(np.float32)}
+    for pollutant in POLLUTANTS:
+        assert result[0][pollutant].dtype == np.float32
+        series = np.asarray(getattr(result[1][pollutant], "array", result[1][pollutant]))
+        assert series.dtype == np.float32
+
+        # Udokumentowany błąd float32 względem float64 (simulate_pollution_spread, precision)
+        scale = np.abs(reference[0][pollutant]).max()
+        assert np.abs(result[0][pollutant] - reference[0][pollutant]).max() <= max_error * scale
+
+
+@pytest.mark.parametrize("solver", ["implicit", "steady"])
+def test_quadtree_simulation_runs_end_to_end(flight_data, prepared, solver):
+    concentrations, snapshots, grid, temperature, pressure, u, v, equilibrium_steps = simulate_pollution_spread(
+        flight_data, 30, POLLUTANTS, grid_type="quadtree", solver=solver, max_refinement_level=2)
+
+    assert isinstance(grid, QuadtreeGrid)
+    assert len(grid) > np.prod(prepared["grid_shape"])
+    for values in (temperature, pressure, u, v):
+        assert len(values) == len(grid)
+    for pollutant in POLLUTANTS:
+        assert concentrations[pollutant].shape == (len(grid),)
+        assert np.all(np.isfinite(concentrations[pollutant])) and np.all(concentrations[pollutant] >= 0)
+        assert len(snapshots[pollutant]) == (2 if solver == "steady" else snapshot_count(30, 10))
+
+    output = convert_to_output_type(concentrations, snapshots, grid, temperature, pressure, u, v, equilibrium_steps)
+    assert output["grid"]["type"] == "quadtree" and len(output["grid"]["cells"]) == len(grid)
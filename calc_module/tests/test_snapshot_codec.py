@@ -0,0 +1,88 @@
+import json
+
+import numpy as np
+import pytest
+
+from models.euler_modified_multibox_model.snapshot_codec import COMPRESSORS, decode_snapshots, encode_snapshots
+from utils import deserialize_output_binary, serialize_output, serialize_output_binary
+
+
+def plume_snapshots(n_snapshots=12, shape=(30, 40), seed=0):
+    # Smuga przesuwająca się z wiatrem z szumem - typowe snapshoty symulacji
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing="ij")
+    return np.stack([
+        500 * np.exp(-((x - 5 - step) ** 2 + (y - 10 - 0.5 * step) ** 2) / 40) + rng.random(shape)
+        for step in range(n_snapshots)
+    ]).reshape(n_snapshots, -1)
+
+
+def json_reply(encoded):
+    return json.loads(serialize_output({"status": "success", "result": {"pollutants": {"encodedSteps": {"CO": encoded}}}}))
+
+
+def binary_reply(encoded):
+    return deserialize_output_binary(serialize_output_binary({"status": "success", "result": {"pollutants": {"encodedSteps": {"CO": encoded}}}}))
+
+
+def direct_reply(encoded):
+    return {"result": {"pollutants": {"encodedSteps": {"CO": encoded}}}}
+
+
+REPLIES = {"direct": direct_reply, "json": json_reply, "binary": binary_reply}
+
+SNAPSHOTS = {
+    "plume": plume_snapshots(),
+    "constant": np.full((8, 1200), 42.123456),
+    "single": plume_snapshots(n_snapshots=1),
+}
+
+
+@pytest.mark.parametrize("reply", REPLIES)
+@pytest.mark.parametrize("compression", COMPRESSORS)
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("snapshots", SNAPSHOTS)
+@pytest.mark.parametrize("error_bound", [1e-3, 0.05, 2.0])
+def test_decoded_snapshots_are_within_error_bound(snapshots, dtype, compression, reply, error_bound):
+    original = SNAPSHOTS[snapshots].astype(dtype)
+
+    encoded = encode_snapshots(original, error_bound, compression=compression)
+    decoded = decode_snapshots(REPLIES[reply](encoded)["result"]["pollutants"]["encodedSteps"]["CO"])
+
+    assert decoded.shape == original.shape
+    assert np.max(np.abs(decoded - original.astype(np.float64))) <= error_bound
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("error_bound", [1e-3, 0.05, 1 / 3, 2.0])
+def test_values_halfway_between_quantization_levels(dtype, error_bound):
+    rng = np.random.default_rng(1)
+    original = ((rng.integers(0, 10**6, (5, 1000)) + 0.5) * 2 * error_bound).astype(dtype)
+
+    decoded = decode_snapshots(encode_snapshots(original, error_bound))
+
+    assert np.max(np.abs(decoded - original.astype(np.float64))) <= error_bound
+
+
+def test_error_bound_below_float_precision_is_rejected():
+    with pytest.raises(ValueError):
+        encode_snapshots(1e12 * (1 + np.random.default_rng(0).random((2, 1000))), 1e-6)
+    with pytest.raises(ValueError):
+        encode_snapshots(np.full((2, 3), 1e12), 1e-9)
+
+
+def test_constant_field_compresses_to_keyframe():
+    encoded = encode_snapshots(SNAPSHOTS["constant"], 0.01)
+
+    # Same zerowe różnice między snapshotami
+    assert encoded["deltaDtype"] == "|i1"
+    assert len(encoded["data"]) < SNAPSHOTS["constant"].shape[1] * 2
+
+
+def test_invalid_parameters_are_rejected():
+    with pytest.raises(ValueError):
+        encode_snapshots(SNAPSHOTS["plume"], 0)
+    with pytest.raises(ValueError):
+        encode_snapshots(SNAPSHOTS["plume"], 0.1, compression="bz2")
+    with pytest.raises(ValueError):
+        encode_snapshots(np.full((2, 3), np.nan), 0.1)
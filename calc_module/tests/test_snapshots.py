@@ -0,0 +1,73 @@
+import gc
+import os
+
+import numpy as np
+import pytest
+
+from conftest import POLLUTANTS, drone_flight_request
+from models.euler_modified_multibox_model.simulation import simulate_pollution_spread
+from models.euler_modified_multibox_model.simulation_types.input_type import convert_to_input_type
+from models.euler_modified_multibox_model.snapshots import SnapshotStore
+
+
+def mapped_files(directory):
+    """
+    Files of directory mapped into this process (spilled snapshot arrays), also the already unlinked ones.
+    """
+    with open("/proc/self/maps") as maps:
+        return [line.split(maxsplit=5)[-1].strip() for line in maps if f" {directory}/" in line]
+
+
+@pytest.fixture
+def spill_dir(tmp_path, monkeypatch):
+    # Budżet 1 kB - każda tablica snapshotów trafia do pliku
+    monkeypatch.setenv("SNAPSHOT_MEMORY_BUDGET_MB", str(1 / 1024))
+    monkeypatch.setenv("SNAPSHOT_SPILL_DIR", str(tmp_path))
+    return str(tmp_path)
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/maps"), reason="needs /proc/self/maps")
+def test_store_spills_to_spill_dir_and_removes_file(spill_dir):
+    rng = np.random.default_rng(0)
+    snapshots = rng.random((12, 500))
+
+    store = SnapshotStore(8, 500)
+    series = store.series("CO", snapshots[:3])
+    series.extend(snapshots[3:])
+
+    assert isinstance(series.rows, np.memmap)
+    assert len(series) == 12
+    np.testing.assert_array_equal(series.array, snapshots)
+    np.testing.assert_array_equal(np.stack(list(series)), snapshots)
+    assert mapped_files(spill_dir)
+    # Plik tymczasowy jest usunięty z katalogu od razu, istnieje tylko jego mapowanie
+    assert os.listdir(spill_dir) == []
+
+    del series, store
+    gc.collect()
+    assert mapped_files(spill_dir) == []
+    assert os.listdir(spill_dir) == []
+
+
+def test_store_stays_in_memory_within_budget(tmp_path):
+    store = SnapshotStore(4, 100, memory_budget=4 * 100 * 8, spill_dir=str(tmp_path))
+    series = store.series("CO", np.ones((4, 100)))
+
+    assert not isinstance(series.rows, np.memmap)
+    # Powiększenie tablicy przekracza budżet
+    series.append(np.zeros(100))
+    assert isinstance(series.rows, np.memmap)
+    np.testing.assert_array_equal(series.array, np.vstack([np.ones((4, 100)), np.zeros((1, 100))]))
+
+
+def test_spilled_simulation_matches_in_memory(spill_dir, monkeypatch):
+    data = convert_to_input_type(drone_flight_request())
+    spilled = simulate_pollution_spread(data, 30, POLLUTANTS, snap_interval=5)
+
+    monkeypatch.delenv("SNAPSHOT_MEMORY_BUDGET_MB")
+    in_memory = simulate_pollution_spread(data, 30, POLLUTANTS, snap_interval=5)
+
+    for pollutant in POLLUTANTS:
+        assert isinstance(spilled[1][pollutant].rows, np.memmap)
+        assert not isinstance(in_memory[1][pollutant].rows, np.memmap)
+        np.testing.assert_array_equal(spilled[1][pollutant].array, in_memory[1][pollutant].array)
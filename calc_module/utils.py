@@ -1,5 +1,7 @@
+import base64
 import json
 import logging
+import struct
 import threading
 from typing import Any, Dict, Union
 
@@ -80,6 +82,9 @@ class NpEncoder(json.JSONEncoder):
             return float(obj)
         if isinstance(obj, np.ndarray):
             return obj.tolist()
+        if isinstance(obj, bytes):
+            # Dane binarne (np. zakodowane snapshoty) w JSON przesyłane są jako base64
+            return base64.b64encode(obj).decode('ascii')
         return super(NpEncoder, self).default(obj)
     
 
@@ -95,17 +100,127 @@ def serialize_output(output_data: Union[OutputType, Dict[str, Any]]) -> str:
         str: Serialized JSON data as a string.
     """
     try:
-        if isinstance(output_data, dict) and 'status' in output_data:
-            if output_data.get('result') is not None:
-                serialized_result = json.dumps(output_data, cls=NpEncoder)
-            else:
-                serialized_result = json.dumps(output_data)
-        else:
-            serialized_result = json.dumps(output_data, cls=NpEncoder)
+        # Odpowiedzi ze statusem mogą zawierać wynik lub snapshot (tryb strumieniowy) z tablicami numpy
+        serialized_result = json.dumps(output_data, cls=NpEncoder)
         
         log_with_time(f"Serialized data types: {str(type(output_data))}")
         
         return serialized_result
     except Exception as e:
         log_with_time(f"Error during serialization: {str(e)}")
-        raise
\ No newline at end of file
+        raise
+
+
+
+##############################################################################################
+#                            Binary serialization                                            #
+##############################################################################################
+
+"""
+Binary reply format (reply header x-reply-format: binary):
+    b"APTB" | uint32 version | uint32 header length | JSON header | array blocks
+All integers and arrays are little-endian. JSON header is the reply with every numeric array replaced by
+{"$block": index}, header["blocks"][index] = {"dtype": "<f8" | "<f4" | "<i4" | "|u1", "shape": [...], "offset": ..., "length": ...}
+with offset counted from the start of the blocks section. JSON header is padded with spaces, so the blocks section
+and every block start at a multiple of 8 bytes from the start of the reply.
+Blocks hold numpy arrays, bytes and lists of floats. Lists of Python ints (shapes, quadtree cells) are small
+descriptors and stay in the JSON header as ints, integer numpy arrays become "<i4" blocks when their values fit.
+"""
+BINARY_MAGIC = b"APTB"
+BINARY_VERSION = 1
+BINARY_CONTENT_TYPE = "application/x-apt-binary"
+BINARY_ALIGNMENT = 8
+REPLY_FORMATS = ("json", "binary")
+INT32_RANGE = np.iinfo(np.int32)
+
+
+def _binary_block(value):
+    # Listy liczb zmiennoprzecinkowych (również zagnieżdżone) zamieniane są na bloki, listy int zostają w JSON
+    if isinstance(value, bytes):
+        return np.frombuffer(value, dtype=np.uint8)
+    if isinstance(value, np.ndarray):
+        array = value
+    elif isinstance(value, list) and value and not isinstance(value[0], (dict, str)):
+        try:
+            array = np.asarray(value)
+        except ValueError:
+            return None
+        if array.dtype.kind != "f":
+            return None
+    else:
+        return None
+
+    if array.ndim == 0 or array.dtype.kind not in "fiu":
+        return None
+    if array.dtype.kind == "f":
+        return array.astype("<f4" if array.dtype.itemsize == 4 else "<f8", copy=False)
+    if array.dtype == np.uint8:
+        return array
+    if array.size and (array.min() < INT32_RANGE.min or array.max() > INT32_RANGE.max):
+        return None
+    return array.astype("<i4")
+
+
+def serialize_output_binary(output_data: Dict[str, Any]) -> bytes:
+    """
+    Serializes the output data to the binary reply format, metadata stays JSON, arrays are packed as typed blocks.
+    """
+    blocks = []
+    offset = 0
+
+    def replace_arrays(value):
+        nonlocal offset
+        array = _binary_block(value)
+        if array is not None:
+            array = np.ascontiguousarray(array)
+            blocks.append((array, {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset, "length": array.nbytes}))
+            offset += -(-array.nbytes // BINARY_ALIGNMENT) * BINARY_ALIGNMENT
+            return {"$block": len(blocks) - 1}
+        if isinstance(value, dict):
+            return {key: replace_arrays(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [replace_arrays(item) for item in value]
+        return value
+
+    header = replace_arrays(output_data)
+    header = json.dumps({"data": header, "blocks": [description for _, description in blocks]}, cls=NpEncoder).encode()
+    # Spacje na końcu nagłówka wyrównują początek sekcji bloków (12 bajtów prefiksu + nagłówek)
+    header += b" " * (-(12 + len(header)) % BINARY_ALIGNMENT)
+
+    body = bytearray(BINARY_MAGIC + struct.pack("<II", BINARY_VERSION, len(header)) + header)
+    blocks_start = len(body)
+    body.extend(bytes(offset))
+    for array, description in blocks:
+        start = blocks_start + description["offset"]
+        body[start:start + description["length"]] = array.tobytes()
+
+    log_with_time(f"Serialized binary reply: {len(blocks)} array blocks, {len(body)} bytes (header {len(header)} bytes)")
+    return bytes(body)
+
+
+def deserialize_output_binary(body: bytes) -> Dict[str, Any]:
+    """
+    Inverse of serialize_output_binary, arrays are returned as numpy arrays.
+    """
+    if body[:4] != BINARY_MAGIC:
+        raise ValueError("Not a binary reply")
+    version, header_length = struct.unpack_from("<II", body, 4)
+    if version != BINARY_VERSION:
+        raise ValueError(f"Unsupported binary reply version: {version}")
+
+    header = json.loads(body[12:12 + header_length])
+    blocks_start = 12 + header_length
+
+    def restore_arrays(value):
+        if isinstance(value, dict):
+            if "$block" in value:
+                block = header["blocks"][value["$block"]]
+                return np.frombuffer(body, dtype=block["dtype"], count=int(np.prod(block["shape"])),
+                                     offset=blocks_start + block["offset"]).reshape(block["shape"])
+            return {key: restore_arrays(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [restore_arrays(item) for item in value]
+        return value
+
+    return restore_arrays(header["data"])
+